@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# _batch.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Batched writes to the local database.
+"""
+from leap.soledad.common import soledad_assert
+
+
+class SoledadBatch(object):
+    """
+    Collect document writes to be applied to the local database in a single
+    transaction.
+
+    Operations are queued in memory and nothing is written until commit() is
+    called:
+
+        batch = soledad.batch()
+        batch.create_doc({'some': 'content'})
+        batch.put_doc(doc)
+        d = batch.commit()
+
+    A batch can also be used as a context manager. In that case it is
+    committed when the block exits without errors, and the resulting deferred
+    is available as `batch.deferred`.
+    """
+
+    def __init__(self, soledad):
+        """
+        :param soledad: The soledad instance to write to.
+        :type soledad: leap.soledad.client.api.Soledad
+        """
+        self._soledad = soledad
+        self._operations = []
+        self.deferred = None
+
+    def __len__(self):
+        return len(self._operations)
+
+    def create_doc(self, content, doc_id=None):
+        """
+        Queue the creation of a new document.
+
+        :param content: A Python dictionary.
+        :type content: dict
+        :param doc_id: An optional identifier specifying the document id.
+        :type doc_id: str
+        """
+        self._operations.append(('create', content, doc_id))
+
+    def put_doc(self, doc):
+        """
+        Queue an update of a document.
+
+        :param doc: A document with new content.
+        :type doc: leap.soledad.common.document.SoledadDocument
+        """
+        self._operations.append(('put', doc))
+
+    def delete_doc(self, doc):
+        """
+        Queue the deletion of a document.
+
+        :param doc: A document to be deleted.
+        :type doc: leap.soledad.common.document.SoledadDocument
+        """
+        soledad_assert(doc is not None, "delete_doc doesn't accept None.")
+        self._operations.append(('delete', doc))
+
+    def commit(self):
+        """
+        Apply all queued operations in a single transaction.
+
+        :return: A deferred whose callback will be invoked with the list of
+            resulting documents, in the order the operations were queued.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        soledad_assert(self.deferred is None, "Batch already committed.")
+        self.deferred = self._soledad._defer("apply_batch", self._operations)
+        return self.deferred
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
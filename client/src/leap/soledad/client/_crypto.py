@@ -153,6 +153,43 @@ class SoledadCrypto(object):
         d.addCallback(put_raw)
         return d
 
+    def encrypt_doc_blocking(self, doc):
+        """
+        Encrypt the document without producing the cleartext in the reactor.
+        This blocks until the whole document is encrypted, so it is meant to
+        be run in a worker thread.
+
+        :param doc: the document to be encrypted.
+        :type doc: SoledadDocument
+        :return: A JSON string containing the ciphertext as the value of "raw"
+            key.
+        :rtype: str
+        """
+        content = BytesIO(str(doc.get_json()))
+        info = DocInfo(doc.doc_id, doc.rev)
+        del doc
+        encryptor = BlobEncryptor(info, content, secret=self.secret)
+        raw = encryptor.encrypt_blocking().getvalue()
+        return '{"raw": "' + raw + '"}'
+
+    def encrypt_raw_blocking(self, doc):
+        """
+        Encrypt the document like encrypt_doc_blocking(), but without armoring
+        the ciphertext with base64 nor wrapping the result in JSON, so it can
+        be sent with binary framing.
+
+        :param doc: the document to be encrypted.
+        :type doc: SoledadDocument
+        :return: The base64 encoded preamble and the raw ciphertext.
+        :rtype: str
+        """
+        content = BytesIO(str(doc.get_json()))
+        info = DocInfo(doc.doc_id, doc.rev)
+        del doc
+        encryptor = BlobEncryptor(
+            info, content, secret=self.secret, armor=False)
+        return encryptor.encrypt_blocking().getvalue()
+
     def decrypt_doc(self, doc):
         """
         Creates and configures a BlobDecryptor, asking it decrypt and returning
@@ -171,6 +208,47 @@ class SoledadCrypto(object):
         decryptor = BlobDecryptor(info, ciphertext, secret=self.secret)
         return decryptor.decrypt()
 
+    def decrypt_doc_blocking(self, doc):
+        """
+        Decrypt the document without producing the ciphertext in the reactor.
+        This blocks until the whole document is decrypted, so it is meant to
+        be run in a worker thread.
+
+        :param doc: the document to be decrypted.
+        :type doc: SoledadDocument
+        :return: The decrypted cleartext content of the document.
+        :rtype: str
+        """
+        info = DocInfo(doc.doc_id, doc.rev)
+        ciphertext = BytesIO()
+        payload = doc.content['raw']
+        del doc
+        ciphertext.write(str(payload))
+        decryptor = BlobDecryptor(
+            info, ciphertext, secret=self.secret, start_stream=False)
+        return decryptor.decrypt_blocking().getvalue()
+
+    def decrypt_raw_blocking(self, doc, payload):
+        """
+        Decrypt a payload produced by encrypt_raw_blocking(). This blocks until
+        the whole payload is decrypted, so it is meant to be run in a worker
+        thread.
+
+        :param doc: the document the payload belongs to.
+        :type doc: SoledadDocument
+        :param payload: the base64 encoded preamble and the raw ciphertext.
+        :type payload: str
+        :return: The decrypted cleartext content of the document.
+        :rtype: str
+        """
+        info = DocInfo(doc.doc_id, doc.rev)
+        ciphertext = BytesIO()
+        ciphertext.write(str(payload))
+        decryptor = BlobDecryptor(
+            info, ciphertext, secret=self.secret, armor=False,
+            start_stream=False)
+        return decryptor.decrypt_blocking().getvalue()
+
 
 def encrypt_sym(data, key, method=ENC_METHOD.aes_256_gcm):
     """
@@ -303,7 +381,21 @@ class BlobEncryptor(object):
             self._content_size)
         return preamble
 
+    def encrypt_blocking(self):
+        """
+        Encrypt all the cleartext data at once, without using the reactor.
+        This is meant to be run in a worker thread.
+
+        :return: The resulting ciphertext.
+        :rtype: BytesIO
+        """
+        self._aes.write(self._content_fd.read())
+        return self._encode_result()
+
     def _end_crypto_stream_and_encode_result(self):
+        return defer.succeed(self._encode_result())
+
+    def _encode_result(self):
 
         # TODO ---- this needs to be refactored to allow PROPER streaming
         # We should write the preamble as soon as possible,
@@ -324,7 +416,7 @@ class BlobEncryptor(object):
             result.write(encrypted + self.tag)
 
         result.seek(0)
-        return defer.succeed(result)
+        return result
 
 
 # TODO maybe rename this to just Decryptor, since it will be used by blobs
@@ -444,6 +536,17 @@ class BlobDecryptor(object):
         d.addCallback(lambda _: self._end_stream())
         return d
 
+    def decrypt_blocking(self):
+        """
+        Decrypt all the ciphertext at once, without using the reactor. This
+        is meant to be run in a worker thread.
+
+        :return: The resulting cleartext.
+        :rtype: BytesIO
+        """
+        self._aes.write(self.fd.read())
+        return self._end_stream()
+
     def startProducing(self):
         if not self._producer:
             self._start_stream()
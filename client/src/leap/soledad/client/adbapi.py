@@ -99,6 +99,7 @@ class U1DBConnection(adbapi.Connection):
         :type init_u1db: bool
         """
         self.init_u1db = init_u1db
+        self._u1db = None
         try:
             adbapi.Connection.__init__(self, pool)
         except dbapi2.DatabaseError as e:
@@ -119,6 +120,21 @@ class U1DBConnection(adbapi.Connection):
                 self._connection,
                 self._pool.opts)
 
+    def is_healthy(self):
+        """
+        Check whether the underlying connection still answers queries.
+
+        :return: Whether the connection can still be used.
+        :rtype: bool
+        """
+        try:
+            cursor = self._connection.cursor()
+            cursor.execute(self._pool.good_sql)
+            cursor.close()
+            return True
+        except dbapi2.Error:
+            return False
+
     def __getattr__(self, name):
         """
         Route the requested attribute either to the U1DB wrapper or to the
@@ -176,6 +192,9 @@ class U1DBConnectionPool(adbapi.ConnectionPool):
         # all u1db connections, hashed by thread-id
         self._u1dbconnections = {}
 
+        # all initialized adbapi connections, hashed by thread-id
+        self._threadconnections = {}
+
         # The replica uid, primed by the connections on init.
         self.replica_uid = ProxyBase(None)
 
@@ -254,18 +273,7 @@ class U1DBConnectionPool(adbapi.ConnectionPool):
         :rtype: twisted.internet.defer.Deferred
         """
         tid = self.threadID()
-        u1db = self._u1dbconnections.get(tid)
-        conn = self.connectionFactory(
-            self, init_u1db=not bool(u1db))
-
-        if self.replica_uid is None:
-            replica_uid = conn._u1db._real_replica_uid
-            setProxiedObject(self.replica_uid, replica_uid)
-
-        if u1db is None:
-            self._u1dbconnections[tid] = conn._u1db
-        else:
-            conn._u1db = u1db
+        conn = self._getThreadConnection(tid)
 
         trans = self.transactionFactory(self, conn)
         try:
@@ -279,8 +287,55 @@ class U1DBConnectionPool(adbapi.ConnectionPool):
                 conn.rollback()
             except:
                 logger.error(None, "Rollback failed")
+            if not conn.is_healthy():
+                logger.warn("discarding broken connection")
+                self._discardThreadConnection(tid)
             raise excType(excValue, excTraceback)
 
+    def _getThreadConnection(self, tid):
+        """
+        Return the connection owned by the thread with id C{tid}, creating
+        and initializing it on first use.
+
+        Setting up a SQLCipher connection (key derivation, cipher pragmas and
+        u1db schema checks) is expensive, so each worker thread keeps both the
+        raw connection and its u1db wrapper for the lifetime of the pool.
+
+        :param tid: The id of the current thread.
+        :type tid: int
+
+        :return: The connection for the current thread.
+        :rtype: U1DBConnection
+        """
+        conn = self._threadconnections.get(tid)
+        if conn is None:
+            conn = self.connectionFactory(self, init_u1db=True)
+            self._threadconnections[tid] = conn
+            self._u1dbconnections[tid] = conn._u1db
+            if self.replica_uid is None:
+                replica_uid = conn._u1db._real_replica_uid
+                setProxiedObject(self.replica_uid, replica_uid)
+        return conn
+
+    def _discardThreadConnection(self, tid):
+        """
+        Close and forget the connection owned by the thread with id C{tid}, so
+        the next interaction in that thread reconnects.
+
+        :param tid: The id of the current thread.
+        :type tid: int
+        """
+        conn = self._threadconnections.pop(tid, None)
+        self._u1dbconnections.pop(tid, None)
+        if conn is not None:
+            try:
+                self.disconnect(conn._connection)
+            except Exception:
+                logger.error(None, "Disconnect failed")
+            # the wrapper shares the handle closed above, it is closed for its
+            # own cleanup
+            self._close(conn._u1db)
+
     def finalClose(self):
         """
         A final close, only called by the shutdown trigger.
@@ -294,3 +349,5 @@ class U1DBConnectionPool(adbapi.ConnectionPool):
         for u1db in self._u1dbconnections.values():
             self._close(u1db)
         self.connections.clear()
+        self._u1dbconnections.clear()
+        self._threadconnections.clear()
@@ -55,6 +55,7 @@ from leap.soledad.client import adbapi
 from leap.soledad.client import events as soledad_events
 from leap.soledad.client import interfaces as soledad_interfaces
 from leap.soledad.client import sqlcipher
+from leap.soledad.client._batch import SoledadBatch
 from leap.soledad.client._recovery_code import RecoveryCode
 from leap.soledad.client._secrets import Secrets
 from leap.soledad.client._crypto import SoledadCrypto
@@ -315,6 +316,21 @@ class Soledad(object):
         d = self._defer("put_doc", doc)
         return d
 
+    def put_docs(self, docs):
+        """
+        Update many documents in a single transaction.
+
+        See put_doc() for the semantics of each update. If any of the updates
+        fails, none of them is applied.
+
+        :param docs: A list of documents with new content.
+        :type docs: list
+        :return: A deferred whose callback will be invoked with the list of
+            updated documents.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._defer("put_docs", docs)
+
     def delete_doc(self, doc):
         """
         Mark a document as deleted.
@@ -330,6 +346,21 @@ class Soledad(object):
         soledad_assert(doc is not None, "delete_doc doesn't accept None.")
         return self._defer("delete_doc", doc)
 
+    def delete_docs(self, docs):
+        """
+        Mark many documents as deleted in a single transaction.
+
+        If any of the deletions fails, none of them is applied.
+
+        :param docs: A list of documents to be deleted.
+        :type docs: list
+        :return: A deferred whose callback will be invoked with the list of
+            deleted documents.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        soledad_assert(None not in docs, "delete_docs doesn't accept None.")
+        return self._defer("delete_docs", docs)
+
     def get_doc(self, doc_id, include_deleted=False):
         """
         Get the JSON string for the given document.
@@ -387,6 +418,52 @@ class Soledad(object):
         """
         return self._defer("get_all_docs", include_deleted)
 
+    def iter_all_docs(self, callback, include_deleted=False, page_size=1000):
+        """
+        Call a function with every page of the documents in the database.
+
+        Pages are read one at a time and in document id order, so that only
+        one of them is held in memory.
+
+        :param callback: A function called with the list of documents of
+            each page. If it returns a deferred, the next page is only read
+            after it fires.
+        :type callback: callable
+        :param include_deleted: If set to True, deleted documents will be
+            passed with empty content. Otherwise deleted documents will be
+            skipped.
+        :type include_deleted: bool
+        :param page_size: The maximum number of documents in each page.
+        :type page_size: int
+        :return: A deferred which will fire after the last page is handled.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        def get_page(after):
+            return self._defer(
+                "get_all_docs_page", page_size, after=after,
+                include_deleted=include_deleted)
+        return self._iter_pages(get_page, callback)
+
+    @defer.inlineCallbacks
+    def _iter_pages(self, get_page, callback):
+        """
+        Call a function with the documents of each page until the last one.
+
+        :param get_page: A function that takes the position where the
+            previous page ended, or None, and returns a deferred which will
+            fire with a tuple of ([Document], position).
+        :type get_page: callable
+        :param callback: A function called with the documents of each page.
+        :type callback: callable
+        """
+        after = None
+        while True:
+            docs, after = yield get_page(after)
+            if docs:
+                yield callback(docs)
+            if after is None:
+                break
+
     def create_doc(self, content, doc_id=None):
         """
         Create a new document.
@@ -411,6 +488,29 @@ class Soledad(object):
         d = self._defer("create_doc", content, doc_id=doc_id)
         return d
 
+    def create_docs(self, contents):
+        """
+        Create many new documents in a single transaction.
+
+        If any of the creations fails, none of them is applied.
+
+        :param contents: A list of Python dictionaries.
+        :type contents: list
+        :return: A deferred whose callback will be invoked with the list of
+            created documents.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self._defer("create_docs", contents)
+
+    def batch(self):
+        """
+        Return a new batch of writes to be applied in a single transaction.
+
+        :return: An empty batch bound to this instance.
+        :rtype: leap.soledad.client._batch.SoledadBatch
+        """
+        return SoledadBatch(self)
+
     def create_doc_from_json(self, json, doc_id=None):
         """
         Create a new document.
@@ -478,7 +578,7 @@ class Soledad(object):
         """
         return self._defer("list_indexes")
 
-    def get_from_index(self, index_name, *key_values):
+    def get_from_index(self, index_name, *key_values, **kwargs):
         """
         Return documents that match the keys supplied.
 
@@ -489,17 +589,68 @@ class Soledad(object):
         It is also possible to append a '*' to the last supplied value (eg
         'val*', '*', '*' or 'val', 'val*', '*', but not 'val*', 'val', '*')
 
+        If a limit is given, only a page of the documents is returned, along
+        with the position to pass as `after` to get the next page. Pages are
+        ordered by the first indexed value and then by document id, and each
+        one is read with a single index lookup.
+
         :param index_name: The index to query
         :type index_name: str
         :param key_values: values to match. eg, if you have
             an index with 3 fields then you would have:
             get_from_index(index_name, val1, val2, val3)
         :type key_values: list
+        :param limit: The maximum number of documents to return.
+        :type limit: int
+        :param after: The position where the previous page ended.
+        :type after: tuple
         :return: A deferred whose callback will be invoked with a list of
-            [Document].
+            [Document], or with a tuple of ([Document], position) if a limit
+            is given. The position is None when there are no more documents.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        limit = kwargs.pop('limit', None)
+        after = kwargs.pop('after', None)
+        if kwargs:
+            raise TypeError(
+                "get_from_index() got unexpected keyword arguments: %s"
+                % ', '.join(kwargs))
+        if limit is None:
+            return self._defer("get_from_index", index_name, *key_values)
+        return self._defer(
+            "get_from_index_page", index_name, key_values, limit, after=after)
+
+    def iter_from_index(self, callback, index_name, *key_values, **kwargs):
+        """
+        Call a function with every page of the documents that match the keys
+        supplied.
+
+        See get_from_index() for the keys and the order of the pages. Pages
+        are read one at a time, so that only one of them is held in memory.
+
+        :param callback: A function called with the list of documents of
+            each page. If it returns a deferred, the next page is only read
+            after it fires.
+        :type callback: callable
+        :param index_name: The index to query
+        :type index_name: str
+        :param key_values: values to match.
+        :type key_values: list
+        :param page_size: The maximum number of documents in each page.
+        :type page_size: int
+        :return: A deferred which will fire after the last page is handled.
         :rtype: twisted.internet.defer.Deferred
         """
-        return self._defer("get_from_index", index_name, *key_values)
+        page_size = kwargs.pop('page_size', 1000)
+        if kwargs:
+            raise TypeError(
+                "iter_from_index() got unexpected keyword arguments: %s"
+                % ', '.join(kwargs))
+
+        def get_page(after):
+            return self.get_from_index(
+                index_name, *key_values, limit=page_size, after=after)
+        return self._iter_pages(get_page, callback)
 
     def get_count_from_index(self, index_name, *key_values):
         """
@@ -519,7 +670,8 @@ class Soledad(object):
         """
         return self._defer("get_count_from_index", index_name, *key_values)
 
-    def get_range_from_index(self, index_name, start_value, end_value):
+    def get_range_from_index(self, index_name, start_value, end_value,
+                             limit=None, after=None):
         """
         Return documents that fall within the specified range.
 
@@ -543,13 +695,53 @@ class Soledad(object):
             range. eg, if you have an index with 3 fields then you would have:
             (val1, val2, val3)
         :type end_values: tuple
+        :param limit: The maximum number of documents to return, see
+            get_from_index().
+        :type limit: int
+        :param after: The position where the previous page ended.
+        :type after: tuple
         :return: A deferred whose callback will be invoked with a list of
-            [Document].
+            [Document], or with a tuple of ([Document], position) if a limit
+            is given.
         :rtype: twisted.internet.defer.Deferred
         """
-
+        if limit is None:
+            return self._defer(
+                "get_range_from_index", index_name, start_value, end_value)
         return self._defer(
-            "get_range_from_index", index_name, start_value, end_value)
+            "get_range_from_index_page", index_name, start_value, end_value,
+            limit, after=after)
+
+    def iter_range_from_index(self, callback, index_name, start_value,
+                              end_value, page_size=1000):
+        """
+        Call a function with every page of the documents that fall within
+        the specified range.
+
+        See get_range_from_index() for the range and get_from_index() for the
+        order of the pages. Pages are read one at a time, so that only one of
+        them is held in memory.
+
+        :param callback: A function called with the list of documents of
+            each page. If it returns a deferred, the next page is only read
+            after it fires.
+        :type callback: callable
+        :param index_name: The index to query
+        :type index_name: str
+        :param start_value: The lower bound of the range.
+        :type start_value: tuple
+        :param end_value: The upper bound of the range.
+        :type end_value: tuple
+        :param page_size: The maximum number of documents in each page.
+        :type page_size: int
+        :return: A deferred which will fire after the last page is handled.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        def get_page(after):
+            return self.get_range_from_index(
+                index_name, start_value, end_value, limit=page_size,
+                after=after)
+        return self._iter_pages(get_page, callback)
 
     def get_index_keys(self, index_name):
         """
@@ -77,6 +77,8 @@ class SoledadHTTPSyncTarget(SyncTargetAPI, HTTPDocSender, HTTPDocFetcher):
         if url.endswith("/"):
             url = url[:-1]
         self._url = str(url) + "/sync-from/" + str(source_replica_uid)
+        # the changes resource lives beside the user database
+        self._changes_url = str(url).rsplit('/', 1)[0] + '/changes/'
         self.source_replica_uid = source_replica_uid
         self._auth_header = None
         self._uuid = None
@@ -85,6 +87,7 @@ class SoledadHTTPSyncTarget(SyncTargetAPI, HTTPDocSender, HTTPDocFetcher):
         # TODO: DEPRECATED CRYPTO
         self._deprecated_crypto = old_crypto.SoledadCrypto(crypto.secret)
         self._insert_doc_cb = None
+        self._insert_docs_cb = None
 
         # Twisted default Agent with our own ssl context factory
         factory = get_compatible_ssl_context_factory(cert_file)
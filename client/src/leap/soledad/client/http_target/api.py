@@ -25,7 +25,10 @@ from twisted.internet import defer
 from twisted.web.http_headers import Headers
 from twisted.web.client import FileBodyProducer
 
+from leap.soledad.client.http_target import fetch_protocol
+from leap.soledad.client.http_target.send_protocol import DocStreamProducer
 from leap.soledad.client.http_target.support import readBody
+from leap.soledad.client.http_target.support import FramedRequestBody
 from leap.soledad.common.errors import InvalidAuthTokenError
 from leap.soledad.common.l2db.errors import HTTPError
 from leap.soledad.common.l2db import SyncTarget
@@ -42,6 +45,10 @@ class SyncTargetAPI(SyncTarget):
     Declares public methods and implements u1db.SyncTarget.
     """
 
+    # Whether the server said it supports syncing in a single request, in its
+    # last response to get_sync_info().
+    single_request_sync = False
+
     @property
     def uuid(self):
         return self._uuid
@@ -101,6 +108,8 @@ class SyncTargetAPI(SyncTarget):
         """
         raw = yield self._http_request(self._url)
         res = json.loads(raw)
+        self.single_request_sync = res.get('single_request_sync', False)
+        self.binary_framing = res.get('binary_framing', False)
         defer.returnValue((
             res['target_replica_uid'],
             res['target_replica_generation'],
@@ -148,11 +157,63 @@ class SyncTargetAPI(SyncTarget):
             body=data,
             content_type='application/json')
 
+    @defer.inlineCallbacks
+    def has_changes(self, last_known_generation, last_known_trans_id):
+        """
+        Ask whether the remote database changed since the given generation.
+
+        The sync info is requested conditionally, so the server doesn't have
+        to look it up if nothing changed.
+
+        :param last_known_generation: The last target replica generation the
+                                      source replica knows about.
+        :type last_known_generation: int
+        :param last_known_trans_id: The last target replica transaction id the
+                                    source replica knows about.
+        :type last_known_trans_id: str
+
+        :return: A deferred which fires with whether the remote database
+                 changed.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        headers = self._base_header
+        headers['if-none-match'] = [
+            '"%d-%s"' % (last_known_generation, last_known_trans_id)]
+        try:
+            yield self._http_request(self._url, headers=headers)
+        except HTTPError as e:
+            if e.status != 304:
+                raise
+            defer.returnValue(False)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def wait_for_changes(self, last_known_generation):
+        """
+        Wait until the remote database advances past the given generation.
+
+        The server answers as soon as the remote database changes, or after a
+        timeout, in which case the returned generation may be the given one.
+
+        :param last_known_generation: The last target replica generation the
+                                      source replica knows about.
+        :type last_known_generation: int
+
+        :return: A deferred which fires with the generation and transaction id
+                 of the remote database.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        url = '%s%s?generation=%d' % (
+            self._changes_url, self._uuid, last_known_generation)
+        raw = yield self._http_request(url)
+        res = json.loads(raw)
+        defer.returnValue((res['generation'], res['transaction_id']))
+
     @defer.inlineCallbacks
     def sync_exchange(self, docs_by_generation, source_replica_uid,
                       last_known_generation, last_known_trans_id,
                       insert_doc_cb, ensure_callback=None,
-                      sync_id=None):
+                      sync_id=None, insert_docs_cb=None, received=0):
         """
         Find out which documents the remote database does not know about,
         encrypt and send them. After that, receive documents from the remote
@@ -184,6 +245,20 @@ class SyncTargetAPI(SyncTarget):
                                 created.
         :type ensure_callback: function
 
+        :param sync_id: The id of the current sync session.
+        :type sync_id: str
+
+        :param insert_docs_cb: An optional callback for inserting many
+                               received documents at once, given a list of
+                               (doc, gen, trans_id) tuples. If given, it is
+                               used instead of insert_doc_cb.
+        :type insert_docs_cb: function
+
+        :param received: How many documents were already received from the
+                         target in a previous, interrupted, run of the sync
+                         session identified by sync_id.
+        :type received: int
+
         :return: A deferred which fires with the new generation and
                  transaction id of the target replica.
         :rtype: twisted.internet.defer.Deferred
@@ -201,6 +276,7 @@ class SyncTargetAPI(SyncTarget):
 
         # save a reference to the callback so we can use it after decrypting
         self._insert_doc_cb = insert_doc_cb
+        self._insert_docs_cb = insert_docs_cb
 
         gen_after_send, trans_id_after_send = yield self._send_docs(
             docs_by_generation,
@@ -215,7 +291,7 @@ class SyncTargetAPI(SyncTarget):
 
         cur_target_gen, cur_target_trans_id = yield self._receive_docs(
             last_known_generation, last_known_trans_id,
-            ensure_callback, sync_id)
+            ensure_callback, sync_id, received)
 
         # update gen and trans id info in case we just sent and did not
         # receive docs.
@@ -230,6 +306,112 @@ class SyncTargetAPI(SyncTarget):
 
         defer.returnValue([cur_target_gen, cur_target_trans_id])
 
+    @defer.inlineCallbacks
+    def sync_in_single_request(
+            self, docs_by_generation, source_replica_uid, target_replica_uid,
+            last_known_generation, last_known_trans_id,
+            source_known_generation, source_known_trans_id,
+            insert_docs_cb, sync_id, source_generation=None,
+            source_trans_id=None, received=0):
+        """
+        Send documents to the remote database and receive documents from it
+        in a single request, without asking for the sync info first.
+
+        The server checks that it knows the given source generation before
+        inserting the sent documents, and records the pending one, if given,
+        so the sync info doesn't have to be recorded in another request.
+
+        Servers that support single request syncs also support binary framing,
+        so documents are exchanged with it.
+
+        :param docs_by_generations: A list of (doc_id, generation, trans_id)
+                                    of local documents that were changed since
+                                    the last local generation the remote
+                                    replica knows about.
+        :type docs_by_generations: list of tuples
+        :param source_replica_uid: The uid of the source replica.
+        :type source_replica_uid: str
+        :param target_replica_uid: The uid the target replica is expected to
+                                   have.
+        :type target_replica_uid: str
+        :param last_known_generation: Target's last known generation.
+        :type last_known_generation: int
+        :param last_known_trans_id: Target's last known transaction id.
+        :type last_known_trans_id: str
+        :param source_known_generation: The source generation the target is
+                                        expected to have recorded.
+        :type source_known_generation: int
+        :param source_known_trans_id: The source transaction id the target is
+                                      expected to have recorded.
+        :type source_known_trans_id: str
+        :param insert_docs_cb: A callback for inserting many received
+                               documents at once, given a list of
+                               (doc, gen, trans_id) tuples.
+        :type insert_docs_cb: function
+        :param sync_id: The id of the current sync session.
+        :type sync_id: str
+        :param source_generation: A later source generation for the target to
+                                  record, if any.
+        :type source_generation: int
+        :param source_trans_id: The source transaction id for the target to
+                                record with source_generation.
+        :type source_trans_id: str
+        :param received: How many documents were already received from the
+                         target in a previous, interrupted, run of the sync
+                         session identified by sync_id.
+        :type received: int
+
+        :return: A deferred which fires with the new generation and
+                 transaction id of the target replica, and the source
+                 generation and transaction id that it has recorded.
+        :rtype: twisted.internet.defer.Deferred
+
+        :raise SyncStateMismatchError: If the target knows another source
+                                       generation, or has another uid.
+        """
+        self._ensure_callback = None
+        self.source_replica_uid = source_replica_uid
+        self._insert_doc_cb = None
+        self._insert_docs_cb = insert_docs_cb
+        self.binary_framing = True
+
+        header = dict(
+            last_known_generation=last_known_generation,
+            last_known_trans_id=last_known_trans_id,
+            sync_id=sync_id,
+            target_replica_uid=target_replica_uid,
+            source_known_generation=source_known_generation,
+            source_known_trans_id=source_known_trans_id)
+        if source_generation is not None:
+            header.update(
+                source_generation=source_generation,
+                source_trans_id=source_trans_id)
+        if received:
+            header['received'] = received
+        body = FramedRequestBody(**header)
+        queue = self._prepare_docs(docs_by_generation)
+        self._start_receiving()
+
+        metadata = yield self._http_request(
+            self._url,
+            method='POST',
+            body=(body, queue),
+            content_type=body.framed_content_type(
+                'application/x-soledad-sync-exchange'),
+            body_producer=DocStreamProducer,
+            body_reader=fetch_protocol.build_body_reader(self._doc_parser))
+        _, new_gen, new_trans_id = self._parse_metadata(metadata)
+        metadata = json.loads(metadata)
+
+        # wait for pending decryptions and inserts
+        yield self._inserter.wait()
+
+        self.single_request_sync = True
+        defer.returnValue((
+            new_gen, new_trans_id,
+            metadata['source_generation'],
+            metadata['source_transaction_id']))
+
 
 def _unauth_to_invalid_token_error(failure):
     """
@@ -20,11 +20,12 @@ from twisted.internet import threads
 
 from leap.soledad.client.events import SOLEDAD_SYNC_RECEIVE_STATUS
 from leap.soledad.client.events import emit_async
-from leap.soledad.client.http_target.support import RequestBody
+from leap.soledad.client.http_target.support import build_request_body
 from leap.soledad.common.log import getLogger
 from leap.soledad.client._crypto import is_symmetrically_encrypted
 from leap.soledad.common.document import SoledadDocument
 from leap.soledad.common.l2db import errors
+from leap.soledad.common.l2db.remote.utils import RawContent
 from leap.soledad.client import crypto as old_crypto
 
 from . import fetch_protocol
@@ -40,6 +41,8 @@ class HTTPDocFetcher(object):
     * Fetch the total on response and prepare to ask all remaining
     * (async) Documents will come encrypted.
               So we parse, decrypt and insert locally as they arrive.
+              Decryption runs concurrently in worker threads, and decrypted
+              documents are inserted in batches, in the order they arrived.
     """
 
     # The uuid of the local replica.
@@ -49,25 +52,31 @@ class HTTPDocFetcher(object):
     uuid = 'undefined'
     userid = 'undefined'
 
+    # The maximum number of documents being decrypted at the same time.
+    decrypt_workers = 4
+
+    # The maximum number of documents inserted by a single call to a worker
+    # thread.
+    insert_batch_size = 100
+
+    # Whether sync streams are sent with binary framing, which the server
+    # supports if it says so in its sync info.
+    binary_framing = False
+
     @defer.inlineCallbacks
     def _receive_docs(self, last_known_generation, last_known_trans_id,
-                      ensure_callback, sync_id):
+                      ensure_callback, sync_id, received=0):
         new_generation = last_known_generation
         new_transaction_id = last_known_trans_id
-        # Acts as a queue, ensuring line order on async processing
-        # as `self._insert_doc_cb` cant be run concurrently or out of order.
-        # DeferredSemaphore solves the concurrency and its implementation uses
-        # a queue, solving the ordering.
-        # FIXME: Find a proper solution to avoid surprises on Twisted changes
-        self.semaphore = defer.DeferredSemaphore(1)
+        self._start_receiving()
 
         metadata = yield self._fetch_all(
             last_known_generation, last_known_trans_id,
-            sync_id)
+            sync_id, received)
         number_of_changes, ngen, ntrans = self._parse_metadata(metadata)
 
-        # wait for pending inserts
-        yield self.semaphore.acquire()
+        # wait for pending decryptions and inserts
+        yield self._inserter.wait()
 
         if ngen:
             new_generation = ngen
@@ -75,15 +84,29 @@ class HTTPDocFetcher(object):
 
         defer.returnValue([new_generation, new_transaction_id])
 
+    def _start_receiving(self):
+        # `self._insert_doc_cb` cant be run concurrently or out of order, so
+        # documents are decrypted concurrently and then handed to an inserter
+        # that puts them back in the order they were received.
+        self._decrypt_semaphore = defer.DeferredSemaphore(
+            self.decrypt_workers)
+        self._inserter = _OrderedBatchInserter(
+            self._insert_batch, self.insert_batch_size)
+        self._received_docs = 0
+
     def _fetch_all(self, last_known_generation,
-                   last_known_trans_id, sync_id):
+                   last_known_trans_id, sync_id, received=0):
         # add remote replica metadata to the request
-        body = RequestBody(
+        header = dict(
             last_known_generation=last_known_generation,
             last_known_trans_id=last_known_trans_id,
             sync_id=sync_id,
             ensure=self._ensure_callback is not None)
-        self._received_docs = 0
+        # only resumed syncs send the offset, so servers that don't know
+        # about it can still serve every other sync
+        if received:
+            header['received'] = received
+        body = build_request_body(self.binary_framing, **header)
         # build a stream reader with _doc_parser as a callback
         body_reader = fetch_protocol.build_body_reader(self._doc_parser)
         # start download stream
@@ -91,10 +114,10 @@ class HTTPDocFetcher(object):
             self._url,
             method='POST',
             body=str(body),
-            content_type='application/x-soledad-sync-get',
+            content_type=body.framed_content_type(
+                'application/x-soledad-sync-get'),
             body_reader=body_reader)
 
-    @defer.inlineCallbacks
     def _doc_parser(self, doc_info, content, total):
         """
         Insert a received document into the local replica, decrypting
@@ -103,33 +126,62 @@ class HTTPDocFetcher(object):
 
         :param doc_info: Dictionary representing Document information.
         :type doc_info: dict
-        :param content: The Document's content.
+        :param content: The Document's content, which is raw if it was
+                        received with binary framing.
         :type idx: str
         :param total: The total number of operations.
         :type total: int
+
+        :return: A deferred which fires when the document is decrypted and
+                 queued for insertion.
+        :rtype: twisted.internet.defer.Deferred
         """
-        yield self.semaphore.run(self.__atomic_doc_parse, doc_info, content,
-                                 total)
+        self._total_docs = total
+        idx = self._inserter.reserve()
+        d = self._decrypt_semaphore.run(
+            threads.deferToThread, self._decrypt_doc, doc_info, content)
+        d.addCallback(lambda doc: self._inserter.put(
+            idx, (doc, doc_info['gen'], doc_info['trans_id'])))
+        d.addErrback(self._inserter.fail)
+        return d
 
-    @defer.inlineCallbacks
-    def __atomic_doc_parse(self, doc_info, content, total):
+    def _decrypt_doc(self, doc_info, content):
+        # runs in a worker thread, so it must not touch the local replica
+        if isinstance(content, RawContent):
+            doc = SoledadDocument(doc_info['id'], doc_info['rev'])
+            doc.set_json(self._crypto.decrypt_raw_blocking(doc, content))
+            return doc
         doc = SoledadDocument(doc_info['id'], doc_info['rev'], content)
         if is_symmetrically_encrypted(content):
-            content = (yield self._crypto.decrypt_doc(doc)).getvalue()
+            content = self._crypto.decrypt_doc_blocking(doc)
         elif old_crypto.is_symmetrically_encrypted(doc):
             content = self._deprecated_crypto.decrypt_doc(doc)
         doc.set_json(content)
+        return doc
 
+    def _insert_batch(self, batch):
         # TODO insert blobs here on the blob backend
         # FIXME: This is wrong. Using the very same SQLite connection object
         # from multiple threads is dangerous. We should bring the dbpool here
         # or find an alternative.  Deferring to a thread only helps releasing
         # the reactor for other tasks as this is an IO intensive call.
-        yield threads.deferToThread(self._insert_doc_cb,
-                                    doc, doc_info['gen'], doc_info['trans_id'])
-        self._received_docs += 1
+        d = threads.deferToThread(self._insert_docs, batch)
+        d.addCallback(lambda _: self._emit_batch_status(len(batch)))
+        return d
+
+    def _insert_docs(self, batch):
+        if self._insert_docs_cb is not None:
+            self._insert_docs_cb(batch)
+            return
+        for doc, gen, trans_id in batch:
+            self._insert_doc_cb(doc, gen, trans_id)
+
+    def _emit_batch_status(self, inserted):
         user_data = {'uuid': self.uuid, 'userid': self.userid}
-        _emit_receive_status(user_data, self._received_docs, total=total)
+        for _ in xrange(inserted):
+            self._received_docs += 1
+            _emit_receive_status(
+                user_data, self._received_docs, total=self._total_docs)
 
     def _parse_metadata(self, metadata):
         """
@@ -159,3 +211,105 @@ def _emit_receive_status(user_data, received_docs, total):
     if received_docs % 20 == 0:
         msg = "%d/%d" % (received_docs, total)
         logger.debug("Sync receive status: %s" % msg)
+
+
+class _OrderedBatchInserter(object):
+    """
+    Insert items in the order in which their positions were reserved, even if
+    they are put out of order. Consecutive items that are ready are inserted
+    together, and only one batch is inserted at a time.
+    """
+
+    def __init__(self, insert, batch_size):
+        """
+        :param insert: A function that receives a list of items and returns
+                       a deferred that fires when they have been inserted.
+        :type insert: function
+        :param batch_size: The maximum number of items in a batch.
+        :type batch_size: int
+        """
+        self._insert = insert
+        self._batch_size = batch_size
+        self._ready = {}
+        self._reserved = 0
+        self._next = 0
+        self._running = False
+        self._failure = None
+        self._waiting = []
+
+    def reserve(self):
+        """
+        Reserve the next position in the insertion order.
+
+        :return: The reserved position.
+        :rtype: int
+        """
+        idx = self._reserved
+        self._reserved += 1
+        return idx
+
+    def put(self, idx, item):
+        """
+        Put the item for a reserved position, inserting it as soon as all the
+        items before it have been inserted.
+        """
+        self._ready[idx] = item
+        self._flush()
+
+    def fail(self, failure):
+        """
+        Stop inserting items and make waiters fail with the given failure.
+
+        :return: The failure, so this can be used as an errback.
+        """
+        if self._failure is None:
+            self._failure = failure
+        self._fire_waiting()
+        return failure
+
+    def wait(self):
+        """
+        :return: A deferred which fires when the items for all reserved
+                 positions have been inserted, or fails with the first
+                 failure.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        d = defer.Deferred()
+        self._waiting.append(d)
+        self._fire_waiting()
+        return d
+
+    def _flush(self):
+        if self._running:
+            return
+        batch = []
+        while self._failure is None and self._next in self._ready \
+                and len(batch) < self._batch_size:
+            batch.append(self._ready.pop(self._next))
+            self._next += 1
+        if not batch:
+            self._fire_waiting()
+            return
+        self._running = True
+        d = self._insert(batch)
+        d.addCallbacks(self._inserted, self._insert_failed)
+
+    def _inserted(self, _):
+        self._running = False
+        self._flush()
+
+    def _insert_failed(self, failure):
+        self._running = False
+        self.fail(failure)
+
+    def _fire_waiting(self):
+        if self._running:
+            return
+        if self._failure is None and self._next < self._reserved:
+            return
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            if self._failure is None:
+                d.callback(None)
+            else:
+                d.errback(self._failure)
@@ -20,6 +20,7 @@ from six import StringIO
 from twisted.web._newclient import ResponseDone
 from leap.soledad.common.l2db import errors
 from leap.soledad.common.l2db.remote import utils
+from leap.soledad.common.l2db.remote.utils import RawContent
 from leap.soledad.common.log import getLogger
 from .support import ReadBodyProtocol
 from .support import readBody
@@ -51,6 +52,9 @@ class DocStreamReceiver(ReadBodyProtocol):
         self.delimiter = '\r\n'
         self.metadata = ''
         self._doc_reader = doc_reader
+        # error responses are not a stream, they are handled by the parent
+        # class once they are completely received
+        self._failed = self.status not in (None, 200, 201)
         self.reset()
 
     def reset(self):
@@ -66,7 +70,9 @@ class DocStreamReceiver(ReadBodyProtocol):
         if self.deferred.called:
             return
         try:
-            if reason.check(ResponseDone):
+            if self._failed:
+                self.dataBuffer = self._buffer.getvalue()
+            elif reason.check(ResponseDone):
                 self.dataBuffer = self.metadata
             else:
                 self.dataBuffer = self.finish()
@@ -91,7 +97,7 @@ class DocStreamReceiver(ReadBodyProtocol):
         the incoming data for efficiency.
         """
         self._buffer.write(data)
-        if '\n' not in data:
+        if self._failed or '\n' not in data:
             return
         lines = self.consumeBufferLines()
         while lines:
@@ -140,6 +146,86 @@ class DocStreamReceiver(ReadBodyProtocol):
         return content
 
 
+class DocFrameReceiver(DocStreamReceiver):
+    """
+    A protocol implementation that parses incoming data from server sent with
+    binary framing, in the same order as DocStreamReceiver does:
+
+    {metadata} frame
+    {doc_info} frame
+    content frame, either JSON or raw
+    ...
+    {doc_info} frame
+    content frame, either JSON or raw
+    end frame
+    """
+
+    def reset(self):
+        DocStreamReceiver.reset(self)
+        # there is no stream start in binary framing
+        self._line = 1
+        self._frame_size = utils.FRAME_HEADER.size
+
+    def dataReceived(self, data):
+        """
+        Buffer incoming data until a whole frame comes in.
+        """
+        self._buffer.write(data)
+        if self._failed or self._buffer.tell() < self._frame_size:
+            return
+        for frame_type, payload in self.consumeBufferFrames():
+            self.frameReceived(frame_type, payload)
+            self._line += 1
+
+    def consumeBufferFrames(self):
+        """
+        Consumes whole frames from buffer and rewind it, writing remaining
+        data that didn't form a frame back into buffer.
+        """
+        content = self._buffer.getvalue()[0:self._buffer.tell()]
+        header_size = utils.FRAME_HEADER.size
+        frames = []
+        start = 0
+        while len(content) - start >= header_size:
+            frame_type, size = utils.FRAME_HEADER.unpack_from(content, start)
+            end = start + header_size + size
+            if end > len(content):
+                break
+            frames.append((frame_type, content[start + header_size:end]))
+            start = end
+        # wait for the whole next frame before consuming the buffer again
+        self._frame_size = header_size
+        if len(content) - start >= header_size:
+            self._frame_size += utils.FRAME_HEADER.unpack_from(
+                content, start)[1]
+        self._buffer.seek(0)
+        self._buffer.write(content[start:])
+        return frames
+
+    def frameReceived(self, frame_type, payload):
+        """
+        Protocol implementation.
+        1:      {metadata}
+        (even): {doc_info}
+        (odd):  {data}
+        (last): end
+        """
+        if self._properly_finished:
+            raise errors.BrokenSyncStream("Reading a finished stream")
+        if frame_type == utils.FRAME_END:
+            self._properly_finished = True
+        elif frame_type == utils.FRAME_RAW and self._line % 2 == 1 \
+                and self._line > 1:
+            d = self._doc_reader(
+                self.current_doc, RawContent(payload), self.total)
+            d.addErrback(self.deferred.errback)
+        elif frame_type == utils.FRAME_JSON:
+            self.lineReceived(payload)
+        else:
+            raise errors.BrokenSyncStream(
+                "Unexpected frame type: %r" % frame_type)
+
+
 def build_body_reader(doc_reader):
     """
     Get the documents from a sync stream and call doc_reader on each
@@ -151,7 +237,14 @@ def build_body_reader(doc_reader):
     @type doc_reader: function
 
     @return: A function that can be called by the http Agent to create and
-    configure the proper protocol.
+    configure the proper protocol, depending on the framing of the response.
     """
-    protocolClass = partial(DocStreamReceiver, doc_reader=doc_reader)
-    return partial(readBody, protocolClass=protocolClass)
+    def body_reader(response):
+        protocolClass = DocStreamReceiver
+        content_type = response.headers.getRawHeaders('content-type', [''])
+        if utils.is_binary_framing(content_type[0]):
+            protocolClass = DocFrameReceiver
+        return readBody(
+            response,
+            protocolClass=partial(protocolClass, doc_reader=doc_reader))
+    return body_reader
@@ -17,11 +17,13 @@
 import json
 
 from twisted.internet import defer
+from twisted.internet import threads
 
 from leap.soledad.common.log import getLogger
 from leap.soledad.client.events import emit_async
 from leap.soledad.client.events import SOLEDAD_SYNC_SEND_STATUS
-from leap.soledad.client.http_target.support import RequestBody
+from leap.soledad.client.http_target.support import build_request_body
+from leap.soledad.common.l2db.remote.utils import RawContent
 from .send_protocol import DocStreamProducer
 
 logger = getLogger(__name__)
@@ -31,6 +33,10 @@ class HTTPDocSender(object):
     """
     Handles Document uploading from Soledad server, using HTTP as transport.
     They need to be encrypted and metadata prepared before sending.
+
+    Documents are read and encrypted ahead of the request body, with several
+    encryptions running concurrently in worker threads, and wait in a
+    bounded queue until the body producer writes them in order.
     """
 
     # The uuid of the local replica.
@@ -40,6 +46,17 @@ class HTTPDocSender(object):
     uuid = 'undefined'
     userid = 'undefined'
 
+    # The maximum number of documents being encrypted at the same time.
+    encrypt_workers = 4
+
+    # The maximum number of documents prepared ahead of the request body,
+    # including the ones being encrypted.
+    send_queue_size = 16
+
+    # Whether sync streams are sent with binary framing, which the server
+    # supports if it says so in its sync info.
+    binary_framing = False
+
     @defer.inlineCallbacks
     def _send_docs(self, docs_by_generation, last_known_generation,
                    last_known_trans_id, sync_id):
@@ -48,7 +65,8 @@ class HTTPDocSender(object):
             defer.returnValue([None, None])
 
         # add remote replica metadata to the request
-        body = RequestBody(
+        body = build_request_body(
+            self.binary_framing,
             last_known_generation=last_known_generation,
             last_known_trans_id=last_known_trans_id,
             sync_id=sync_id,
@@ -61,32 +79,46 @@ class HTTPDocSender(object):
 
     @defer.inlineCallbacks
     def _send_batch(self, body, docs):
-        total, calls = len(docs), []
-        for i, entry in enumerate(docs):
-            calls.append((self._prepare_one_doc,
-                         entry, body, i + 1, total))
-        result = yield self._send_request(body, calls)
-        _emit_send_status(self.uuid, body.consumed, total)
+        queue = self._prepare_docs(docs)
+        result = yield self._send_request(body, queue)
+        _emit_send_status(self.uuid, body.consumed, len(docs))
 
         defer.returnValue(result)
 
-    def _send_request(self, body, calls):
+    def _prepare_docs(self, docs):
+        """
+        Start reading and encrypting the documents to be sent.
+
+        :return: A queue of request body entries, to be written by a
+                 DocStreamProducer.
+        :rtype: _PreparedDocQueue
+        """
+        total = len(docs)
+        calls = [(self._prepare_one_doc, entry, i + 1, total)
+                 for i, entry in enumerate(docs)]
+        self._prepared_docs = 0
+        return _PreparedDocQueue(
+            calls, self.encrypt_workers, self.send_queue_size)
+
+    def _send_request(self, body, queue):
         return self._http_request(
             self._url,
             method='POST',
-            body=(body, calls),
-            content_type='application/x-soledad-sync-put',
+            body=(body, queue),
+            content_type=body.framed_content_type(
+                'application/x-soledad-sync-put'),
             body_producer=DocStreamProducer)
 
     @defer.inlineCallbacks
-    def _prepare_one_doc(self, entry, body, idx, total):
+    def _prepare_one_doc(self, entry, idx, total):
         get_doc_call, gen, trans_id = entry
         doc, content = yield self._encrypt_doc(get_doc_call)
-        body.insert_info(
-            id=doc.doc_id, rev=doc.rev, content=content, gen=gen,
-            trans_id=trans_id, number_of_docs=total,
-            doc_idx=idx)
-        _emit_send_status(self.uuid, body.consumed, total)
+        _emit_send_status(self.uuid, self._prepared_docs, total)
+        self._prepared_docs += 1
+        defer.returnValue({
+            'id': doc.doc_id, 'rev': doc.rev, 'content': content,
+            'gen': gen, 'trans_id': trans_id, 'number_of_docs': total,
+            'doc_idx': idx})
 
     @defer.inlineCallbacks
     def _encrypt_doc(self, get_doc_call):
@@ -94,11 +126,73 @@ class HTTPDocSender(object):
         doc = yield f(*args, **kwargs)
         if doc.is_tombstone():
             defer.returnValue((doc, None))
+        elif self.binary_framing:
+            content = yield threads.deferToThread(
+                self._crypto.encrypt_raw_blocking, doc)
+            defer.returnValue((doc, RawContent(content)))
         else:
-            content = yield self._crypto.encrypt_doc(doc)
+            content = yield threads.deferToThread(
+                self._crypto.encrypt_doc_blocking, doc)
             defer.returnValue((doc, content))
 
 
+class _PreparedDocQueue(object):
+    """
+    A bounded queue of request body entries, prepared concurrently and handed
+    out in order.
+    """
+
+    def __init__(self, calls, workers, size):
+        """
+        :param calls: A list of (function, *args) tuples, each one returning a
+                      deferred that fires with a body entry as a dict.
+        :type calls: list
+        :param workers: The maximum number of calls running at the same time.
+        :type workers: int
+        :param size: The maximum number of entries prepared ahead of get(),
+                     including the ones being prepared.
+        :type size: int
+        """
+        self._calls = list(reversed(calls))
+        self._workers = workers
+        self._size = size
+        self._pending = []
+        self._running = 0
+        self._fill()
+
+    def __len__(self):
+        return len(self._calls) + len(self._pending)
+
+    def get(self):
+        """
+        Take the next entry out of the queue.
+
+        :return: A deferred which fires with the next entry, or with None if
+                 the queue is empty.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        if not self._pending:
+            return defer.succeed(None)
+        d = self._pending.pop(0)
+        self._fill()
+        return d
+
+    def _fill(self):
+        while self._calls and self._running < self._workers \
+                and len(self._pending) < self._size:
+            call = self._calls.pop()
+            fun, args = call[0], call[1:]
+            self._running += 1
+            d = defer.maybeDeferred(fun, *args)
+            d.addBoth(self._call_finished)
+            self._pending.append(d)
+
+    def _call_finished(self, result):
+        self._running -= 1
+        self._fill()
+        return result
+
+
 def _emit_send_status(user_data, idx, total):
     content = {'sent': idx, 'total': total}
     emit_async(SOLEDAD_SYNC_SEND_STATUS, user_data, content)
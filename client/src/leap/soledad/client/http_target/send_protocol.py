@@ -16,7 +16,6 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 from zope.interface import implementer
 from twisted.internet import defer
-from twisted.internet import reactor
 from twisted.web.iweb import IBodyProducer
 from twisted.web.iweb import UNKNOWN_LENGTH
 
@@ -31,13 +30,16 @@ class DocStreamProducer(object):
         """
         Initialize the string produer.
 
-        :param producer: A RequestBody instance and a list of producer calls
-        :type producer: (.support.RequestBody, [(function, *args)])
+        :param producer: A RequestBody instance and a queue of entries, whose
+            get() method returns a deferred that fires with the next entry as
+            a dict, or with None when there are no more entries.
+        :type producer: (.support.RequestBody, .send._PreparedDocQueue)
         """
         self.body, self.producer = producer
         self.length = UNKNOWN_LENGTH
         self.pause = False
         self.stop = False
+        self._resumed = None
 
     @defer.inlineCallbacks
     def startProducing(self, consumer):
@@ -50,26 +52,31 @@ class DocStreamProducer(object):
         :return: A Deferred that fires when production ends.
         :rtype: twisted.internet.defer.Deferred
         """
-        while self.producer and not self.stop:
+        while not self.stop:
             if self.pause:
-                yield self.sleep(0.001)
+                # wait for the consumer to call resumeProducing()
+                self._resumed = defer.Deferred()
+                yield self._resumed
                 continue
-            call = self.producer.pop(0)
-            fun, args = call[0], call[1:]
-            yield fun(*args)
+            entry = yield self.producer.get()
+            if entry is None:
+                break
+            self.body.insert_info(**entry)
             consumer.write(self.body.pop(1, leave_open=True))
         consumer.write(self.body.pop(0))  # close stream
 
-    def sleep(self, secs):
-        d = defer.Deferred()
-        reactor.callLater(secs, d.callback, None)
-        return d
-
     def pauseProducing(self):
         self.pause = True
 
     def stopProducing(self):
         self.stop = True
+        self._resume()
 
     def resumeProducing(self):
         self.pause = False
+        self._resume()
+
+    def _resume(self):
+        if self._resumed is not None:
+            d, self._resumed = self._resumed, None
+            d.callback(None)
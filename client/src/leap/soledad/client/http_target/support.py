@@ -25,6 +25,7 @@ from twisted.web._newclient import PotentialDataLoss
 
 from leap.soledad.common.l2db import errors
 from leap.soledad.common.l2db.remote import http_errors
+from leap.soledad.common.l2db.remote import utils
 
 # we want to make sure that HTTP errors will raise appropriate u1db errors,
 # that is, fire errbacks with the appropriate failures, in the context of
@@ -218,3 +219,76 @@ class RequestBody(object):
         if end:
             data += '\r\n]'
         return data
+
+    def framed_content_type(self, content_type):
+        """
+        Return the content type to send this body with.
+
+        :param content_type: The content type of the sync stream.
+        :type content_type: str
+
+        :rtype: str
+        """
+        return content_type
+
+
+class FramedRequestBody(RequestBody):
+    """
+    A RequestBody that sends the headers and entries with binary framing
+    instead of lines of JSON. The content of an entry is sent in its own frame
+    after it, and raw contents are sent without armor.
+    """
+
+    def insert_info(self, **entry_dict):
+        """
+        Frame an entry and add it to entries list.
+        Adds 'content' key in a frame of its own if it's present.
+
+        :param entry_dict: Entry as a dictionary
+        :type entry_dict: dict
+        """
+        has_content = 'content' in entry_dict
+        content = entry_dict.pop('content', None)
+        entry = utils.frame_entry(entry_dict)
+        if has_content:
+            entry += utils.frame_entry(content)
+        self.entries.append(entry)
+
+    def entries_to_str(self, entries=None, start=True, end=True):
+        """
+        Format a list of entries into the binary framing expected by the
+        server.
+
+        :param entries: entries to format
+        :type entries: list
+
+        :return: formatted body ready to be sent
+        :rtype: str
+        """
+        data = ''
+        if start:
+            data = utils.frame_entry(self.headers)
+        data += ''.join(entries)
+        if end:
+            data += utils.frame(utils.FRAME_END)
+        return data
+
+    def framed_content_type(self, content_type):
+        return content_type + '; ' + utils.BINARY_FRAMING
+
+
+def build_request_body(binary_framing, **header_dict):
+    """
+    Build the body of a sync request.
+
+    :param binary_framing: Whether to use binary framing instead of lines of
+                           JSON.
+    :type binary_framing: bool
+    :param header_dict: A dictionary with the headers.
+    :type header_dict: dict
+
+    :rtype: RequestBody
+    """
+    if binary_framing:
+        return FramedRequestBody(**header_dict)
+    return RequestBody(**header_dict)
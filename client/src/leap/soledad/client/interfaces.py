@@ -77,6 +77,19 @@ class ILocalStorage(Interface):
         :rtype: Deferred
         """
 
+    def put_docs(self, docs):
+        """
+        Update many documents in the local encrypted database in a single
+        transaction.
+
+        :param docs: the documents to update
+        :type docs: list
+
+        :return:
+            a deferred that will fire with the list of updated documents
+        :rtype: Deferred
+        """
+
     def delete_doc(self, doc):
         """
         Delete a document from the local encrypted database.
@@ -137,6 +150,25 @@ class ILocalStorage(Interface):
         :rtype: Deferred
         """
 
+    def iter_all_docs(self, callback, include_deleted=False, page_size=1000):
+        """
+        Call a function with every page of the documents in the database.
+
+        :param callback: the function called with the list of documents of
+                         each page. If it returns a deferred, the next page
+                         is only read after it fires.
+        :type callback: callable
+        :param include_deleted: If set to True, deleted documents will be
+                                passed with empty content. Otherwise deleted
+                                documents will be skipped.
+        :type include_deleted: bool
+        :param page_size: the maximum number of documents in each page
+        :type page_size: int
+
+        :return: A deferred that will fire after the last page is handled.
+        :rtype: Deferred
+        """
+
     def create_doc(self, content, doc_id=None):
         """
         Create a new document in the local encrypted database.
@@ -152,6 +184,42 @@ class ILocalStorage(Interface):
         :rtype: Deferred
         """
 
+    def create_docs(self, contents):
+        """
+        Create many new documents in the local encrypted database in a single
+        transaction.
+
+        :param contents: the contents of the new documents
+        :type contents: list
+
+        :return:
+            A deferred that will fire with the list of new documents
+            (SoledadDocument instances).
+        :rtype: Deferred
+        """
+
+    def delete_docs(self, docs):
+        """
+        Delete many documents from the local encrypted database in a single
+        transaction.
+
+        :param docs: the documents to delete
+        :type docs: list
+
+        :return:
+            a deferred that will fire with the list of deleted documents
+        :rtype: Deferred
+        """
+
+    def batch(self):
+        """
+        Return a batch of writes to be applied to the local encrypted database
+        in a single transaction.
+
+        :return: an empty batch
+        :rtype: SoledadBatch
+        """
+
     def create_doc_from_json(self, json, doc_id=None):
         """
         Create a new document.
@@ -211,7 +279,7 @@ class ILocalStorage(Interface):
         :rtype: Deferred
         """
 
-    def get_from_index(self, index_name, *key_values):
+    def get_from_index(self, index_name, *key_values, **kwargs):
         """
         Return documents that match the keys supplied.
 
@@ -222,16 +290,47 @@ class ILocalStorage(Interface):
         It is also possible to append a '*' to the last supplied value (eg
         'val*', '*', '*' or 'val', 'val*', '*', but not 'val*', 'val', '*')
 
+        If a limit is given, only a page of the documents is returned, along
+        with the position to pass as `after` to get the next page. Pages are
+        ordered by the first indexed value and then by document id.
+
         :param index_name: The index to query
         :type index_name: str
         :param key_values: values to match. eg, if you have
                            an index with 3 fields then you would have:
                            get_from_index(index_name, val1, val2, val3)
         :type key_values: tuple
-        :return: List of [Document]
+        :param limit: the maximum number of documents to return
+        :type limit: int
+        :param after: the position where the previous page ended
+        :type after: tuple
+        :return: List of [Document], or a tuple of ([Document], position)
+                 if a limit is given. The position is None when there are no
+                 more documents.
         :rtype: list
         """
 
+    def iter_from_index(self, callback, index_name, *key_values, **kwargs):
+        """
+        Call a function with every page of the documents that match the keys
+        supplied.
+
+        See get_from_index() for the keys and the order of the pages.
+
+        :param callback: the function called with the list of documents of
+                         each page. If it returns a deferred, the next page
+                         is only read after it fires.
+        :type callback: callable
+        :param index_name: The index to query
+        :type index_name: str
+        :param key_values: values to match
+        :type key_values: tuple
+        :param page_size: the maximum number of documents in each page
+        :type page_size: int
+        :return: A deferred that will fire after the last page is handled.
+        :rtype: Deferred
+        """
+
     def get_count_from_index(self, index_name, *key_values):
         """
         Return the count of the documents that match the keys and
@@ -247,7 +346,8 @@ class ILocalStorage(Interface):
         :rtype: int
         """
 
-    def get_range_from_index(self, index_name, start_value, end_value):
+    def get_range_from_index(self, index_name, start_value, end_value,
+                             limit=None, after=None):
         """
         Return documents that fall within the specified range.
 
@@ -271,7 +371,38 @@ class ILocalStorage(Interface):
             range. eg, if you have an index with 3 fields then you would have:
             (val1, val2, val3)
         :type end_values: tuple
-        :return: A deferred that will fire with a list of [Document]
+        :param limit: the maximum number of documents to return, see
+                      get_from_index()
+        :type limit: int
+        :param after: the position where the previous page ended
+        :type after: tuple
+        :return: A deferred that will fire with a list of [Document], or
+                 with a tuple of ([Document], position) if a limit is given.
+        :rtype: Deferred
+        """
+
+    def iter_range_from_index(self, callback, index_name, start_value,
+                              end_value, page_size=1000):
+        """
+        Call a function with every page of the documents that fall within
+        the specified range.
+
+        See get_range_from_index() for the range and get_from_index() for the
+        order of the pages.
+
+        :param callback: the function called with the list of documents of
+                         each page. If it returns a deferred, the next page
+                         is only read after it fires.
+        :type callback: callable
+        :param index_name: The index to query
+        :type index_name: str
+        :param start_value: the lower bound of the range
+        :type start_value: tuple
+        :param end_value: the upper bound of the range
+        :type end_value: tuple
+        :param page_size: the maximum number of documents in each page
+        :type page_size: int
+        :return: A deferred that will fire after the last page is handled.
         :rtype: Deferred
         """
 
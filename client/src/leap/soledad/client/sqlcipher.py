@@ -347,6 +347,19 @@ class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
         c.execute('UPDATE document SET syncable=? WHERE doc_id=?',
                   (doc.syncable, doc.doc_id))
 
+    def _put_many_and_update_indexes(self, changes):
+        """
+        Update many documents and all indexes related to them.
+
+        :param changes: A list of (old_doc, doc) tuples.
+        :type changes: list
+        """
+        sqlite_backend.SQLitePartialExpandDatabase \
+            ._put_many_and_update_indexes(self, changes)
+        c = self._db_handle.cursor()
+        c.executemany('UPDATE document SET syncable=? WHERE doc_id=?',
+                      [(doc.syncable, doc.doc_id) for _, doc in changes])
+
     def _get_doc(self, doc_id, check_for_conflicts=False):
         """
         Get just the document content, without fancy handling.
@@ -371,6 +384,28 @@ class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
             doc.syncable = bool(result[0])
         return doc
 
+    def _get_docs(self, doc_ids, check_for_conflicts=False):
+        """
+        Get documents in bulk, including their "syncable" property.
+
+        :param doc_ids: The unique document identifiers.
+        :type doc_ids: list
+        :param check_for_conflicts: Whether to set the documents'
+            has_conflicts property.
+        :type check_for_conflicts: bool
+
+        :return: The documents that exist, keyed by doc_id.
+        :rtype: dict
+        """
+        docs = sqlite_backend.SQLitePartialExpandDatabase._get_docs(
+            self, doc_ids, check_for_conflicts)
+        c = self._db_handle.cursor()
+        for doc_id, syncable in self._select_by_doc_ids(
+                c, 'SELECT doc_id, syncable FROM document'
+                ' WHERE doc_id IN (%s)', list(docs)):
+            docs[doc_id].syncable = bool(syncable)
+        return docs
+
     def __del__(self):
         """
         Free resources when deleting or garbage collecting the database.
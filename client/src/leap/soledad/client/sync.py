@@ -19,12 +19,14 @@ Soledad synchronization utilities.
 """
 import os
 
+from uuid import uuid4
 from twisted.internet import defer
 
 from leap.soledad.common.log import getLogger
 from leap.soledad.common.l2db import errors
 from leap.soledad.common.l2db.sync import Synchronizer
 from leap.soledad.common.errors import BackendNotReadyError
+from leap.soledad.common.errors import SyncStateMismatchError
 
 
 logger = getLogger(__name__)
@@ -49,6 +51,13 @@ class SoledadSynchronizer(Synchronizer):
     """
     received_docs = []
 
+    # The id of the current sync session with the target.
+    _sync_id = None
+
+    # The number of documents to be sent that are read from the local
+    # replica with a single get_docs() call.
+    get_docs_chunk_size = 100
+
     def __init__(self, *args, **kwargs):
         Synchronizer.__init__(self, *args, **kwargs)
         if DO_STATS:
@@ -60,13 +69,126 @@ class SoledadSynchronizer(Synchronizer):
         """
         Synchronize documents between source and target.
 
+        If the source knows what the target knew about it at the end of the
+        last sync, the whole sync is done in a single request, or skipped if
+        neither of them changed since then. Otherwise, or if the target
+        doesn't agree, the sync info is exchanged in separate requests.
+
+        :return: A deferred which will fire after the sync has finished with
+                 the local generation before the synchronization was performed.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        self.received_docs = []
+        target_info = self.source._get_sync_target_info(self.sync_target._url)
+        if target_info is not None:
+            try:
+                if (yield self._nothing_to_sync(target_info)):
+                    logger.debug("nothing to sync")
+                    defer.returnValue(self.source._get_generation())
+                my_gen = yield self._sync_in_single_request(target_info)
+                # the target recorded what it knows about the source, so
+                # older entries it can no longer validate can be removed
+                self.source.compact_transaction_log()
+                defer.returnValue(my_gen)
+            except SyncStateMismatchError:
+                logger.info("target sync state changed, getting sync info")
+            except errors.HTTPError as e:
+                if e.status != 400:
+                    raise
+                logger.info("target does not support single request syncs")
+        my_gen = yield self._sync_in_many_requests()
+        self.source.compact_transaction_log()
+        defer.returnValue(my_gen)
+
+    @defer.inlineCallbacks
+    def _nothing_to_sync(self, target_info):
+        """
+        Check whether neither the source nor the target changed since the last
+        sync, asking the target conditionally so it doesn't have to look up
+        the whole sync info.
+
+        :param target_info: What the target knows about the source, as
+                            returned by the source's _get_sync_target_info().
+        :type target_info: tuple
+
+        :return: A deferred which fires with whether there is nothing to sync.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        target_replica_uid, known_gen, _, pending_gen, _ = target_info
+        if pending_gen is not None or \
+                self.source._get_generation() != known_gen:
+            defer.returnValue(False)
+        target_gen, target_trans_id = \
+            self.source._get_replica_gen_and_trans_id(target_replica_uid)
+        changed = yield self.sync_target.has_changes(
+            target_gen, target_trans_id)
+        defer.returnValue(not changed)
+
+    @defer.inlineCallbacks
+    def _sync_in_single_request(self, target_info):
+        """
+        Synchronize documents between source and target in a single request,
+        based on what the target knew about the source at the end of the last
+        sync.
+
+        :param target_info: What the target knows about the source, as
+                            returned by the source's _get_sync_target_info().
+        :type target_info: tuple
+
         :return: A deferred which will fire after the sync has finished with
                  the local generation before the synchronization was performed.
         :rtype: twisted.internet.defer.Deferred
         """
+        (self.target_replica_uid, known_gen, known_trans_id,
+         pending_gen, pending_trans_id) = target_info
+        # the target records the pending generation before inserting the
+        # docs we send
+        since_gen = known_gen if pending_gen is None else pending_gen
+        my_gen, _, changes = self.source.whats_changed(since_gen)
+        logger.debug("there are %d documents to send" % len(changes))
+        target_last_known_gen, target_last_known_trans_id = \
+            self.source._get_replica_gen_and_trans_id(self.target_replica_uid)
 
+        docs_by_generation = self._docs_by_gen_from_changes(changes)
+        self._sync_id, received = self._start_sync_session()
+        new_gen, new_trans_id, source_gen, source_trans_id = yield \
+            self.sync_target.sync_in_single_request(
+                docs_by_generation, self.source._replica_uid,
+                self.target_replica_uid,
+                target_last_known_gen, target_last_known_trans_id,
+                known_gen, known_trans_id, self._insert_docs_from_target,
+                self._sync_id, source_generation=pending_gen,
+                source_trans_id=pending_trans_id, received=received)
+        logger.debug("target gen after sync: %d" % new_gen)
+        if hasattr(self.source, 'commit'):  # sqlcipher backend speed up
+            self.source.commit()  # insert it all in a single transaction
+
+        self.source._set_replica_gen_and_trans_id(
+            self.target_replica_uid, new_gen, new_trans_id)
+        self.source._clear_sync_checkpoint(self.target_replica_uid)
+        # the generation reached by inserting the received docs will be
+        # recorded with the target by the next sync
+        self._save_sync_target_info(
+            source_gen, source_trans_id,
+            self._get_gapless_generation_info(my_gen))
+
+        ids_sent = set(doc_id for doc_id, _, _ in changes)
+        _, _, changes = self.source.whats_changed(since_gen)
+        self.received_docs = list(
+            set(doc_id for doc_id, _, _ in changes) - ids_sent)
+        defer.returnValue(my_gen)
+
+    @defer.inlineCallbacks
+    def _sync_in_many_requests(self):
+        """
+        Synchronize documents between source and target, getting and recording
+        the sync info in separate requests.
+
+        :return: A deferred which will fire after the sync has finished with
+                 the local generation before the synchronization was performed.
+        :rtype: twisted.internet.defer.Deferred
+        """
         sync_target = self.sync_target
-        self.received_docs = []
 
         # ---------- phase 1: get sync info from server ----------------------
         if DO_STATS:
@@ -115,7 +237,8 @@ class SoledadSynchronizer(Synchronizer):
         # --------------------------------------------------------------------
 
         # what's changed since that generation and this current gen
-        my_gen, _, changes = self.source.whats_changed(target_my_gen)
+        my_gen, my_trans_id, changes = self.source.whats_changed(
+            target_my_gen)
         logger.debug("there are %d documents to send" % len(changes))
 
         # get source last-seen database generation for the target
@@ -134,6 +257,7 @@ class SoledadSynchronizer(Synchronizer):
         if not changes and target_last_known_gen == target_gen:
             if target_trans_id != target_last_known_trans_id:
                 raise errors.InvalidTransactionId
+            self._save_sync_target_info(target_my_gen, target_my_trans_id)
             defer.returnValue(my_gen)
 
         # ---------- phase 3: sync exchange ----------------------------------
@@ -143,12 +267,19 @@ class SoledadSynchronizer(Synchronizer):
 
         docs_by_generation = self._docs_by_gen_from_changes(changes)
 
+        # resume the last sync session with the target if it was interrupted:
+        # the target already recorded the docs it acknowledged from us, and
+        # it will skip the docs we already received from it.
+        self._sync_id, received = self._start_sync_session()
+
         # exchange documents and try to insert the returned ones with
         # the target, return target synced-up-to gen.
         new_gen, new_trans_id = yield sync_target.sync_exchange(
             docs_by_generation, self.source._replica_uid,
             target_last_known_gen, target_last_known_trans_id,
-            self._insert_doc_from_target, ensure_callback=ensure_callback)
+            self._insert_doc_from_target, ensure_callback=ensure_callback,
+            sync_id=self._sync_id,
+            insert_docs_cb=self._insert_docs_from_target, received=received)
         ids_sent = [doc_id for doc_id, _, _ in changes]
         logger.debug("target gen after sync: %d" % new_gen)
         logger.debug("target trans_id after sync: %s" % new_trans_id)
@@ -168,6 +299,15 @@ class SoledadSynchronizer(Synchronizer):
         # --------------------------------------------------------------------
 
         yield self.complete_sync()
+        if self._sync_id is not None:
+            self.source._clear_sync_checkpoint(self.target_replica_uid)
+        # the target recorded the generation we reached if there were no
+        # gaps, or else the last one we sent
+        known = self._get_gapless_generation_info(my_gen)
+        if known is None:
+            known = (my_gen, my_trans_id) if ids_sent \
+                else (target_my_gen, target_my_trans_id)
+        self._save_sync_target_info(*known)
 
         _, _, changes = self.source.whats_changed(target_my_gen)
         changed_doc_ids = [doc_id for doc_id, _, _ in changes]
@@ -182,11 +322,54 @@ class SoledadSynchronizer(Synchronizer):
 
         defer.returnValue(my_gen)
 
+    def _start_sync_session(self):
+        """
+        Get the id of the sync session with the target, and how many
+        documents were already received in it.
+
+        The session is persisted in the local replica, so a sync that is
+        interrupted continues where it stopped the next time it is run.
+
+        :return: A (sync_id, received) tuple. The sync_id is None if the
+                 target replica does not exist yet.
+        :rtype: tuple
+        """
+        if self.target_replica_uid is None:
+            return None, 0
+        checkpoint = self.source._get_sync_checkpoint(self.target_replica_uid)
+        if checkpoint is not None:
+            logger.debug("resuming sync %s after %d received docs"
+                         % checkpoint)
+            return checkpoint
+        sync_id = str(uuid4())
+        self.source._set_sync_checkpoint(self.target_replica_uid, sync_id)
+        return sync_id, 0
+
+    def _insert_docs_from_target(self, docs):
+        """
+        Insert many documents received from the target at once, with the
+        same TAKE OTHER semantics of _insert_doc_from_target().
+
+        :param docs: A list of (doc, gen, trans_id) tuples, in the order in
+                     which they were received.
+        :type docs: list
+        """
+        states = self.source._put_docs_if_newer(
+            docs, save_conflict=True, replica_uid=self.target_replica_uid,
+            sync_id=self._sync_id)
+        # conflicted documents were saved as conflicts, so the database was
+        # updated for them too
+        self.num_inserted += len(
+            [state for state in states
+             if state in ('inserted', 'conflicted')])
+
     def _docs_by_gen_from_changes(self, changes):
         docs_by_generation = []
-        kwargs = {'include_deleted': True}
+        getter = _ChunkedDocGetter(
+            self.source, [doc_id for doc_id, _, _ in changes],
+            self.get_docs_chunk_size)
         for doc_id, gen, trans in changes:
-            get_doc = (self.source.get_doc, (doc_id,), kwargs)
+            get_doc = (getter.get_doc, (doc_id,), {})
             docs_by_generation.append((get_doc, gen, trans))
         return docs_by_generation
 
@@ -223,9 +406,80 @@ class SoledadSynchronizer(Synchronizer):
                  completed.
         :rtype: twisted.internet.defer.Deferred
         """
-        cur_gen, trans_id = self.source._get_generation_info()
-        if (cur_gen == start_generation + self.num_inserted and
-                self.num_inserted > 0):
+        gen_info = self._get_gapless_generation_info(start_generation)
+        if gen_info is not None:
+            cur_gen, trans_id = gen_info
             return self.sync_target.record_sync_info(
                 self.source._replica_uid, cur_gen, trans_id)
         return defer.succeed(None)
+
+    def _get_gapless_generation_info(self, start_generation):
+        """
+        Get the current generation of the source, if the documents received
+        from the target are its only changes since the sync was started.
+
+        :param start_generation: The local generation when the sync was
+                                 started.
+        :type start_generation: int
+
+        :return: The current generation and transaction id of the source, or
+                 None if nothing was inserted or other changes happened.
+        :rtype: tuple
+        """
+        cur_gen, trans_id = self.source._get_generation_info()
+        if (cur_gen == start_generation + self.num_inserted and
+                self.num_inserted > 0):
+            return cur_gen, trans_id
+        return None
+
+    def _save_sync_target_info(self, known_gen, known_trans_id, pending=None):
+        """
+        Remember what the target knows about the source after a sync, so the
+        next one can be done in a single request.
+
+        :param known_gen: The source generation recorded by the target.
+        :type known_gen: int
+        :param known_trans_id: The source transaction id recorded by the
+                               target.
+        :type known_trans_id: str
+        :param pending: The source generation and transaction id that have
+                        yet to be recorded with the target, if any.
+        :type pending: tuple
+        """
+        url = self.sync_target._url
+        if self.target_replica_uid is None or \
+                not self.sync_target.single_request_sync:
+            self.source._clear_sync_target_info(url)
+            return
+        pending_gen, pending_trans_id = pending or (None, None)
+        self.source._set_sync_target_info(
+            url, self.target_replica_uid, known_gen, known_trans_id,
+            pending_gen, pending_trans_id)
+
+
+class _ChunkedDocGetter(object):
+    """
+    Get documents from a replica in the order they were listed, reading them
+    in chunks with a single get_docs() call each, and keeping only the
+    documents that were read but not yet asked for.
+    """
+
+    def __init__(self, db, doc_ids, chunk_size):
+        self._db = db
+        self._doc_ids = doc_ids
+        self._chunk_size = chunk_size
+        self._next = 0
+        self._docs = {}
+
+    def get_doc(self, doc_id):
+        while doc_id not in self._docs and self._next < len(self._doc_ids):
+            chunk = self._doc_ids[self._next:self._next + self._chunk_size]
+            self._next += len(chunk)
+            for doc in self._db.get_docs(
+                    chunk, check_for_conflicts=False, include_deleted=True):
+                self._docs[doc.doc_id] = doc
+        doc = self._docs.pop(doc_id, None)
+        if doc is None:
+            # asked twice or out of the list, so read it on its own
+            doc = self._db.get_doc(doc_id, include_deleted=True)
+        return doc
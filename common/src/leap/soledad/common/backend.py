@@ -59,12 +59,20 @@ class SoledadBackend(CommonBackend):
         if replica_uid is not None:
             self._set_replica_uid(replica_uid)
 
-    def batch_start(self):
+    def batch_start(self, doc_ids=None):
+        """
+        Start staging document changes, to be saved together when the batch
+        ends.
+
+        :param doc_ids: The ids of the documents that will be changed in the
+                        batch, if known.
+        :type doc_ids: list
+        """
         if not self.BATCH_SUPPORT:
             return
         self.batching = True
         self.after_batch_callbacks = {}
-        self._database.batch_start()
+        self._database.batch_start(doc_ids)
         if not self._cache:
             # batching needs cache
             self._cache = {}
@@ -331,6 +339,22 @@ class SoledadBackend(CommonBackend):
         """
         return self._database.whats_changed(old_generation)
 
+    def iter_whats_changed(self, old_generation=0):
+        """
+        Return an iterable over the documents that have changed since
+        old_generation, which fetches them as it is iterated over.
+
+        :param old_generation: The generation of the database in the old
+                               state.
+        :type old_generation: int
+
+        :return: The current generation of the database, its associated
+                 transaction id, and an iterable over the changed documents,
+                 as returned by whats_changed.
+        :rtype: (int, str, iterable)
+        """
+        return self._database.iter_whats_changed(old_generation)
+
     def delete_doc(self, doc):
         """
         Mark a document as deleted.
@@ -395,7 +419,10 @@ class SoledadBackend(CommonBackend):
         :rtype: (int, str)
         """
         if other_replica_uid in self.cache:
-            return self.cache[other_replica_uid]
+            # caches shared through a sync state store hand tuples back as
+            # lists
+            gen, trans_id = self.cache[other_replica_uid]
+            return (gen, trans_id)
         gen, trans_id = \
             self._database.get_replica_gen_and_trans_id(other_replica_uid)
         self.cache[other_replica_uid] = (gen, trans_id)
@@ -446,6 +473,19 @@ class SoledadBackend(CommonBackend):
         else:
             callback()
 
+    def set_replica_known_generation(self, other_replica_uid, generation):
+        """
+        Record the generation of this database that another replica claims to
+        know about.
+
+        :param other_replica_uid: The identifier for the other replica.
+        :type other_replica_uid: str
+        :param generation: The generation the other replica knows about.
+        :type generation: int
+        """
+        self._database.set_replica_known_generation(
+            other_replica_uid, generation)
+
     def _force_doc_sync_conflict(self, doc):
         """
         Add a conflict and force a document put.
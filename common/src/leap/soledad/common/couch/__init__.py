@@ -21,7 +21,9 @@
 
 import json
 import copy
+import itertools
 import re
+import time
 import uuid
 import binascii
 
@@ -54,6 +56,18 @@ from leap.soledad.common.backend import SoledadBackend
 
 COUCH_TIMEOUT = 120  # timeout for transfers between Soledad server and Couch
 
+# how many bytes of attachments and how many documents to fetch per request
+# when getting many documents
+BULK_CONTENT_SIZE = 1024 * 1024
+BULK_MAX_DOCS = 1000
+
+# how many changes to get per request when listing changes
+CHANGES_PAGE_SIZE = 1000
+
+# how long a reserved generation hides later changes if its writer never
+# releases it, for example because it died while writing
+RESERVATION_TIMEOUT = 5 * 60
+
 
 def list_users_dbs(couch_url):
     """
@@ -102,11 +116,36 @@ TRANSACTION_ID_KEY = 'trans_id'
 REPLICA_UID_KEY = 'replica_uid'
 DOC_ID_KEY = 'doc_id'
 SCHEMA_VERSION_KEY = 'schema_version'
+INDEXED_SINCE_KEY = 'indexed_since'
+REPLICAS_KEY = 'replicas'
+RESERVED_KEY = 'reserved'
+DOC_GENERATION_KEY = 'u1db_gen'
+DOC_TRANSACTION_ID_KEY = 'u1db_trans_id'
 
 CONFIG_DOC_ID = '_local/config'
+GENERATION_DOC_ID = '_local/generation'
+KNOWN_GENERATIONS_DOC_ID = '_local/known_generations'
 SYNC_DOC_ID_PREFIX = '_local/sync_'
 SCHEMA_VERSION = 1
 
+# documents hold the generation and transaction id of their last change, and
+# this view lists each document once, by the generation of its last change
+CHANGES_DDOC = {
+    '_id': '_design/changes',
+    'language': 'javascript',
+    'views': {
+        'by_generation': {
+            'map': 'function(doc) {\n'
+                   '  if (doc.%s) {\n'
+                   '    emit(doc.%s, doc.%s);\n'
+                   '  }\n'
+                   '}' % (DOC_GENERATION_KEY, DOC_GENERATION_KEY,
+                          DOC_TRANSACTION_ID_KEY),
+        },
+    },
+}
+CHANGES_VIEW = 'changes/by_generation'
+
 
 class CouchDatabase(object):
     """
@@ -171,19 +210,63 @@ class CouchDatabase(object):
         self.batching = False
         self.batch_generation = None
         self.batch_docs = {}
+        self.batch_current_docs = {}
+        self.batched_ids = None
+        self.batch_reserved = []
+        self.batch_reservations = []
+        self._generation_doc = None
         if ensure_security:
             self.ensure_security_ddoc(database_security)
 
-    def batch_start(self):
+    def batch_start(self, doc_ids=None):
+        """
+        Start staging document changes, to be saved together when the batch
+        ends.
+
+        :param doc_ids: The ids of the documents that will be changed in the
+                        batch, if known. Their current versions, with
+                        conflicts, are fetched with a single request so that
+                        getting them during the batch costs no requests.
+                        Otherwise, documents are fetched one by one.
+                        A generation is reserved for each of them.
+        :type doc_ids: list
+        """
         self.batching = True
         self.batch_generation = self.get_generation_info()
-        ids = set(row.id for row in self._database.view('_all_docs'))
-        self.batched_ids = ids
+        self.batch_current_docs = {}
+        self.batched_ids = None
+        self.batch_reserved = []
+        self.batch_reservations = []
+        if doc_ids is None:
+            return
+        first = self.reserve_generations(len(doc_ids))
+        self.batch_reservations.append(first)
+        self.batch_reserved = list(
+            range(first + len(doc_ids) - 1, first - 1, -1))
+        # only look up the documents in the batch, as listing all documents
+        # costs as much as the database is large
+        view = self._database.view(
+            '_all_docs', keys=list(set(doc_ids)), include_docs='true',
+            attachments='true')
+        for row in view.rows:
+            if row.get('doc') is not None:
+                self.batch_current_docs[row['id']] = row['doc']
+        self.batched_ids = set(self.batch_current_docs)
 
     def batch_end(self):
         self.batching = False
         self.batch_generation = None
-        self.__perform_batch()
+        self.batch_current_docs = {}
+        self.batched_ids = None
+        # generations reserved but not used are left as gaps
+        self.batch_reserved = []
+        reservations, self.batch_reservations = self.batch_reservations, []
+        try:
+            self.__perform_batch()
+        finally:
+            # only now the changes of the batch are all written
+            if reservations:
+                self.release_generations(reservations)
 
     def get_couch_database(self, url, dbname):
         """
@@ -324,14 +407,7 @@ class CouchDatabase(object):
         if doc_ids is not None:
             params['keys'] = doc_ids
         view = self._database.view("_all_docs", **params)
-        for row in view.rows:
-            result = copy.deepcopy(row['doc'])
-            for file_name in result.get('_attachments', {}).keys():
-                data = self._database.get_attachment(result, file_name)
-                if data:
-                    if read_content:
-                        data = data.read()
-                    result['_attachments'][file_name] = {'data': data}
+        for result in self._get_contents(view.rows, read_content):
             doc = self.__parse_doc_from_couch(
                 result, result['_id'],
                 check_for_conflicts=check_for_conflicts, decode=False)
@@ -340,6 +416,82 @@ class CouchDatabase(object):
                 continue
             yield doc
 
+    def _get_contents(self, rows, read_content):
+        """
+        Get the attachments of documents listed without them, in as few
+        requests as possible.
+
+        Consecutive documents are fetched together with their attachments,
+        up to BULK_CONTENT_SIZE bytes of attachments per request, and are
+        yielded as each request is answered. Documents with larger
+        attachments are yielded with the attachments streamed from couch.
+
+        :param rows: Rows of the `_all_docs` view with attachment stubs.
+        :type rows: iterable
+        :param read_content: Whether to read streamed attachments, or return
+                             file-like objects to read them from.
+        :type read_content: bool
+
+        :return: An iterable over couch documents, with the data of each
+                 attachment as a string or a file-like object.
+        :rtype: iterable
+        """
+        chunk, chunk_size = [], 0
+        for row in rows:
+            couch_doc = row['doc']
+            size = sum(attachment['length'] for attachment
+                       in couch_doc.get('_attachments', {}).values())
+            if size > BULK_CONTENT_SIZE:
+                for result in self._get_chunk_contents(chunk, chunk_size,
+                                                       read_content):
+                    yield result
+                chunk, chunk_size = [], 0
+                yield self._get_streamed_contents(couch_doc, read_content)
+                continue
+            if chunk_size + size > BULK_CONTENT_SIZE \
+                    or len(chunk) >= BULK_MAX_DOCS:
+                for result in self._get_chunk_contents(chunk, chunk_size,
+                                                       read_content):
+                    yield result
+                chunk, chunk_size = [], 0
+            chunk.append(couch_doc)
+            chunk_size += size
+        for result in self._get_chunk_contents(chunk, chunk_size,
+                                               read_content):
+            yield result
+
+    def _get_chunk_contents(self, couch_docs, size, read_content):
+        if not size:
+            # no attachments to fetch, e.g. only tombstones
+            return couch_docs
+        view = self._database.view(
+            '_all_docs', keys=[couch_doc['_id'] for couch_doc in couch_docs],
+            include_docs='true', attachments='true')
+        results = []
+        # rows come in the order of the keys, and callers match the results
+        # with the documents they asked for by position
+        for couch_doc, row in zip(couch_docs, view.rows):
+            result = row.get('doc')
+            if result is None:
+                # deleted in the meantime, and leaving it out would misplace
+                # the documents after it
+                raise ResourceNotFound(couch_doc['_id'])
+            for attachment in result.get('_attachments', {}).values():
+                data = binascii.a2b_base64(attachment['data'])
+                attachment['data'] = data if read_content else StringIO(data)
+            results.append(result)
+        return results
+
+    def _get_streamed_contents(self, couch_doc, read_content):
+        result = copy.deepcopy(couch_doc)
+        for file_name in result.get('_attachments', {}).keys():
+            data = self._database.get_attachment(result, file_name)
+            if data:
+                if read_content:
+                    data = data.read()
+                result['_attachments'][file_name] = {'data': data}
+        return result
+
     def get_doc(self, doc_id, check_for_conflicts=False):
         """
         Extract the document from storage.
@@ -358,8 +510,12 @@ class CouchDatabase(object):
         doc_from_batch = self.__check_batch_before_get(doc_id)
         if doc_from_batch:
             return doc_from_batch
-        if self.batching and doc_id not in self.batched_ids:
+        if self.batching and self.batched_ids is not None \
+                and doc_id not in self.batched_ids:
             return None
+        if self.batching and doc_id in self.batch_current_docs:
+            return self.__parse_doc_from_couch(
+                self.batch_current_docs[doc_id], doc_id, check_for_conflicts)
         if doc_id not in self._database:
             return None
         # get document with all attachments (u1db content and eventual
@@ -380,7 +536,9 @@ class CouchDatabase(object):
             couch_doc = self.batch_docs[doc_id]
             rev = self.__perform_batch(doc_id)
             couch_doc['_rev'] = rev
-            self.batched_ids.add(doc_id)
+            if self.batched_ids is not None:
+                self.batched_ids.add(doc_id)
+            self.batch_current_docs[doc_id] = couch_doc
             return self.__parse_doc_from_couch(couch_doc, doc_id, True)
         return None
 
@@ -559,6 +717,116 @@ class CouchDatabase(object):
         doc[TRANSACTION_ID_KEY] = other_transaction_id
         self._database.save(doc)
 
+    def set_replica_known_generation(self, other_replica_uid, generation):
+        """
+        Record the generation of this database that another replica claims to
+        know about.
+
+        The transaction log is only compacted below the generations known by
+        all replicas, so that their claims can still be validated.
+
+        :param other_replica_uid: The U1DB identifier for the other replica.
+        :type other_replica_uid: str
+        :param generation: The generation the other replica knows about.
+        :type generation: int
+        """
+        while True:
+            try:
+                doc = self._database[KNOWN_GENERATIONS_DOC_ID]
+            except ResourceNotFound:
+                doc = {'_id': KNOWN_GENERATIONS_DOC_ID, REPLICAS_KEY: {}}
+            if doc[REPLICAS_KEY].get(other_replica_uid) == generation:
+                return
+            doc[REPLICAS_KEY][other_replica_uid] = generation
+            try:
+                self._database.save(doc)
+                return
+            except ResourceConflict:
+                pass  # recorded by another replica in the meantime, try again
+
+    def compact_transaction_log(self, dry_run=False):
+        """
+        Remove the gen docs of changes that were superseded by a later change
+        to the same document, and that are older than the generations known
+        by all replicas. Replicas in the sync log whose known generation was
+        not recorded may know about any generation, so nothing is removed
+        while there are any, or while the sync log can not be listed.
+
+        Changes listed by whats_changed are never removed, as they are the
+        last ones of each document, and neither are the generations replicas
+        may validate, so get_trans_id_for_gen stays correct for all of them.
+
+        :param dry_run: If True, only count the gen docs that would be
+                        removed.
+        :type dry_run: bool
+
+        :return: How many gen docs were removed, and their size in bytes.
+        :rtype: (int, int)
+        """
+        try:
+            known = self._database[KNOWN_GENERATIONS_DOC_ID][REPLICAS_KEY]
+        except ResourceNotFound:
+            known = {}
+        synced = self._get_synced_replicas()
+        if synced is None:
+            return 0, 0
+        replicas = set(known) | set(synced)
+        oldest_known = min([known.get(uid, 0) for uid in replicas] or [0])
+        if not oldest_known:
+            return 0, 0
+        # the last change to each document which is older than oldest_known
+        last_changes = {}
+        removed, size = 0, 0
+        superseded = []
+        start = 1
+        while True:
+            rows = self._get_gen_docs(start=start, limit=BULK_MAX_DOCS)
+            for row in rows:
+                gen_doc = row['doc']
+                doc_id = gen_doc[DOC_ID_KEY]
+                previous = last_changes.pop(doc_id, None)
+                if previous is not None:
+                    superseded.append(previous)
+                if gen_doc[GENERATION_KEY] < oldest_known:
+                    last_changes[doc_id] = gen_doc
+            if len(superseded) >= BULK_MAX_DOCS or len(rows) < BULK_MAX_DOCS:
+                removed += len(superseded)
+                size += sum(len(json.dumps(doc)) for doc in superseded)
+                if superseded and not dry_run:
+                    self._delete_gen_docs(superseded)
+                superseded = []
+            if len(rows) < BULK_MAX_DOCS:
+                return removed, size
+            start = rows[-1]['doc'][GENERATION_KEY] + 1
+
+    def _get_synced_replicas(self):
+        """
+        Return the uids of the replicas in the sync log, or None if local
+        documents can not be listed, as in couch versions before 2.0.
+        """
+        try:
+            rows = self._database.view(
+                '_local_docs', startkey=SYNC_DOC_ID_PREFIX,
+                endkey=SYNC_DOC_ID_PREFIX + u'\ufff0').rows
+        except ResourceNotFound:
+            return None
+        return [row['id'][len(SYNC_DOC_ID_PREFIX):] for row in rows]
+
+    def _delete_gen_docs(self, gen_docs):
+        status = self._database.update([
+            {'_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True}
+            for doc in gen_docs])
+        for ok, _, error in status:
+            if not ok:
+                raise error
+
+    def compact_database(self):
+        """
+        Ask couch to compact the database, which reclaims the disk space of
+        removed documents and of old revisions.
+        """
+        self._database.compact()
+
     def get_transaction_log(self):
         """
         This is only for the test suite, it is not part of the api.
@@ -613,16 +881,95 @@ class CouchDatabase(object):
                  changes first)
         :rtype: (int, str, [(str, int, str)])
         """
-        changes = []
+        cur_generation, last_trans_id, changes = \
+            self.iter_whats_changed(old_generation)
+        return (cur_generation, last_trans_id, list(changes))
+
+    def iter_whats_changed(self, old_generation=0):
+        """
+        Return an iterable over the documents that have changed since
+        old_generation.
+
+        Changes are listed from a view which holds each document once, so
+        their number does not depend on how many times documents changed,
+        and they are fetched in pages as they are iterated over. Changes made
+        before documents held their generation are listed from gen docs.
+
+        :param old_generation: The generation of the database in the old
+                               state.
+        :type old_generation: int
+
+        :return: The current generation of the database, its associated
+                 transaction id, and an iterable over the changed documents,
+                 as returned by whats_changed.
+        :rtype: (int, str, iterable)
+        """
         cur_generation, last_trans_id = self.get_generation_info()
-        relevant_tail = self._get_transaction_log(start=old_generation + 1)
+        start = old_generation + 1
+        # changes made after the current generation are listed by later
+        # syncs, as this one does not report their generations
+        end = cur_generation
+        indexed_since = self._get_indexed_since()
+        if indexed_since is None:
+            changes = iter(self._get_logged_changes(start, end))
+        elif start >= indexed_since:
+            changes = self._iter_indexed_changes(start, end)
+        else:
+            indexed = list(self._iter_indexed_changes(indexed_since, end))
+            indexed_ids = set(doc_id for doc_id, _, _ in indexed)
+            # documents changed again later are listed with their last change
+            logged = [change for change in self._get_logged_changes(
+                start, min(indexed_since - 1, end))
+                if change[0] not in indexed_ids]
+            changes = itertools.chain(logged, indexed)
+        return (cur_generation, last_trans_id, changes)
+
+    def _get_logged_changes(self, start, end=9999999999):
+        changes = []
+        relevant_tail = self._get_transaction_log(start=start, end=end)
         seen = set()
         for generation, doc_id, trans_id in reversed(relevant_tail):
             if doc_id not in seen:
                 changes.append((doc_id, generation, trans_id))
                 seen.add(doc_id)
         changes.reverse()
-        return (cur_generation, last_trans_id, changes)
+        return changes
+
+    def _iter_indexed_changes(self, start, end):
+        while start <= end:
+            rows = self._get_indexed_changes(start, end)
+            for row in rows:
+                yield row['id'], row['key'], row['value']
+            if len(rows) < CHANGES_PAGE_SIZE:
+                return
+            start = rows[-1]['key'] + 1
+
+    def _get_indexed_changes(self, start, end):
+        try:
+            return self._database.view(
+                CHANGES_VIEW, startkey=start, endkey=end,
+                limit=CHANGES_PAGE_SIZE).rows
+        except ResourceNotFound:
+            # the view is created when first used
+            try:
+                self._database.save(copy.deepcopy(CHANGES_DDOC))
+            except ResourceConflict:
+                pass  # created by someone else in the meantime
+            return self._database.view(
+                CHANGES_VIEW, startkey=start, endkey=end,
+                limit=CHANGES_PAGE_SIZE).rows
+
+    def _get_indexed_since(self):
+        """
+        Return the first generation whose changes are listed by the changes
+        view, or None if no document holds its generation yet.
+        """
+        if self._generation_doc is None:
+            try:
+                self._generation_doc = self._database[GENERATION_DOC_ID]
+            except ResourceNotFound:
+                return None
+        return self._generation_doc.get(INDEXED_SINCE_KEY)
 
     def get_generation_info(self):
         """
@@ -636,6 +983,18 @@ class CouchDatabase(object):
         rows = self._get_gen_docs(descending=True, limit=1)
         if not rows:
             return 0, ''
+        # generations are only visible once all the ones before them are
+        # written, otherwise a client could skip changes that are written
+        # later with a lower generation. Generations are reserved before
+        # their gen docs are created, so any pending one below the gen doc
+        # found is in the reservations read after it.
+        visible = self._get_visible_generation()
+        if visible is not None and visible < rows[0]['doc'][GENERATION_KEY]:
+            if visible < 1:
+                return 0, ''
+            rows = self._get_gen_docs(end=visible, descending=True, limit=1)
+            if not rows:
+                return 0, ''
         gen_doc = rows.pop()['doc']
         return gen_doc[GENERATION_KEY], gen_doc[TRANSACTION_ID_KEY]
 
@@ -657,51 +1016,134 @@ class CouchDatabase(object):
         _, _, data = resource.get_json(**kwargs)
         return data
 
-    def _allocate_new_generation(self, doc_id, transaction_id, save=True):
+    def reserve_generations(self, amount):
         """
-        Allocate a new generation number for a document modification.
+        Reserve a contiguous range of generations for new changes.
 
-        We need to allocate a new generation to this document modification by
-        creating a new gen doc. In order to avoid concurrent database updates
-        from allocating the same new generation, we will try to create the
-        document until we succeed, meaning that no other piece of code holds
-        the same generation number as ours.
+        The last reserved generation is kept in a local document, and couch
+        only lets one writer update it from a given revision, so concurrent
+        writers never get the same generations. The document is cached, and
+        is only fetched again when another writer changed it.
+
+        The range is also recorded as pending, which hides the generations
+        from it on until the writer releases it with release_generations.
+
+        :param amount: How many generations to reserve.
+        :type amount: int
+
+        :return: The first generation of the range.
+        :rtype: int
+        """
+        while True:
+            doc = self._generation_doc
+            if doc is None:
+                doc = self._get_generation_doc()
+            gen = doc[GENERATION_KEY]
+            new_doc = dict(doc)
+            new_doc[GENERATION_KEY] = gen + amount
+            # documents hold their generation from now on
+            new_doc.setdefault(INDEXED_SINCE_KEY, gen + 1)
+            now = time.time()
+            new_doc[RESERVED_KEY] = [
+                r for r in doc.get(RESERVED_KEY, []) if r[1] > now]
+            new_doc[RESERVED_KEY].append([gen + 1, now + RESERVATION_TIMEOUT])
+            try:
+                self._database.save(new_doc)
+            except ResourceConflict:
+                # another writer reserved generations in the meantime
+                self._generation_doc = None
+                continue
+            self._generation_doc = new_doc
+            return gen + 1
 
-        The loop below would only be executed more than once if:
+    def release_generations(self, firsts):
+        """
+        Release ranges of reserved generations whose changes are written.
 
-          1. there's more than one thread trying to modify the user's database,
-             and
+        :param firsts: The first generations of the ranges, as returned by
+                       reserve_generations.
+        :type firsts: list
+        """
+        while True:
+            doc = self._generation_doc
+            if doc is None:
+                doc = self._get_generation_doc()
+            reserved = doc.get(RESERVED_KEY, [])
+            pending = [r for r in reserved if r[0] not in firsts]
+            if len(pending) == len(reserved):
+                return  # expired, or released already
+            new_doc = dict(doc)
+            new_doc[RESERVED_KEY] = pending
+            try:
+                self._database.save(new_doc)
+            except ResourceConflict:
+                self._generation_doc = None
+                continue
+            self._generation_doc = new_doc
+            return
 
-          2. the execution of getting the current generation and saving the gen
-             doc different threads get interleaved (one of them will succeed
-             and the others will fail and try again).
+    def _get_visible_generation(self):
+        """
+        Return the last generation below all pending reservations, or None if
+        there are none.
+        """
+        try:
+            self._generation_doc = self._database[GENERATION_DOC_ID]
+        except ResourceNotFound:
+            return None
+        now = time.time()
+        pending = [
+            r[0] for r in self._generation_doc.get(RESERVED_KEY, [])
+            if r[1] > now]
+        if not pending:
+            return None
+        return min(pending) - 1
+
+    def _get_generation_doc(self):
+        try:
+            return self._database[GENERATION_DOC_ID]
+        except ResourceNotFound:
+            # generations of databases created before they were reserved
+            rows = self._get_gen_docs(descending=True, limit=1)
+            gen = rows[0]['doc'][GENERATION_KEY] if rows else 0
+            return {'_id': GENERATION_DOC_ID, GENERATION_KEY: gen}
 
-        Number 1 only happens when more than one user device is syncing at the
-        same time. Number 2 depends on not-so-frequent coincidence of
-        code execution.
+    def _allocate_new_generation(self, doc_id, transaction_id, save=True):
+        """
+        Allocate a new generation number for a document modification.
 
-        Also, in the race between threads for a generation number there's
-        always one thread that wins. so if there are N threads in the race, the
-        expected number of repetitions of the loop for each thread would be
-        N/2. If N is equal to the number of devices that the user has, the
-        number of possible repetitions of the loop should always be low.
+        We need to allocate a new generation to this document modification by
+        creating a new gen doc. Generations are reserved before gen docs are
+        created, so creating them would only fail if a gen doc was created by
+        a writer that does not reserve generations, and then we just try again
+        with a new one.
+
+        If save is False, saving the gen doc and releasing its generation are
+        left to the caller, and when batching its generation comes from the
+        range reserved for the batch, which is released when the batch ends.
         """
         while True:
+            if save or not self.batch_reserved:
+                new_gen = self.reserve_generations(1)
+                if self.batching and not save:
+                    self.batch_reservations.append(new_gen)
+            else:
+                new_gen = self.batch_reserved.pop()
+            gen_doc = {
+                '_id': _get_gen_doc_id(new_gen),
+                GENERATION_KEY: new_gen,
+                DOC_ID_KEY: doc_id,
+                TRANSACTION_ID_KEY: transaction_id,
+            }
+            if not save:
+                break
             try:
-                # add the gen document
-                gen, _ = self.get_generation_info()
-                new_gen = gen + 1
-                gen_doc = {
-                    '_id': _get_gen_doc_id(new_gen),
-                    GENERATION_KEY: new_gen,
-                    DOC_ID_KEY: doc_id,
-                    TRANSACTION_ID_KEY: transaction_id,
-                }
-                if save:
-                    self._database.save(gen_doc)
+                self._database.save(gen_doc)
                 break  # succeeded allocating a new generation, proceed
             except ResourceConflict:
                 pass  # try again!
+            finally:
+                self.release_generations([new_gen])
         return gen_doc
 
     def save_document(self, old_doc, doc, transaction_id):
@@ -744,44 +1186,67 @@ class CouchDatabase(object):
             }
             parts.append(conflicts)
 
+        # the generation is allocated first so that the document holds it
+        gen_doc = self._allocate_new_generation(
+            doc.doc_id, transaction_id, save=False)
         # build the couch document
         couch_doc = {
             '_id': doc.doc_id,
             'u1db_rev': doc.rev,
+            DOC_GENERATION_KEY: gen_doc[GENERATION_KEY],
+            DOC_TRANSACTION_ID_KEY: transaction_id,
             '_attachments': attachments,
         }
         # if we are updating a doc we have to add the couch doc revision
         if old_doc is not None and hasattr(old_doc, 'couch_rev'):
             couch_doc['_rev'] = old_doc.couch_rev
-        # prepare the multipart PUT
         if not self.batching:
-            buf = StringIO()
-            envelope = MultipartWriter(buf)
-            # the order in which attachments are described inside the
-            # serialization of the couch document must match the order in
-            # which they are actually written in the multipart structure.
-            # Because of that, we use `sorted_keys=True` in the json
-            # serialization (so "u1db_conflicts" comes before
-            # "u1db_content" on the couch document attachments
-            # description), and also reverse the order of the parts before
-            # writing them, so the "conflict" part is written before the
-            # "content" part.
-            envelope.add(
-                'application/json',
-                json.dumps(couch_doc, sort_keys=True))
-            parts.reverse()
-            for part in parts:
-                envelope.add('application/octet-stream', part)
-            envelope.close()
-            # try to save and fail if there's a revision conflict
             try:
-                resource = self._new_resource()
-                resource.put_json(
-                    doc.doc_id, body=str(buf.getvalue()),
-                    headers=envelope.headers)
-            except ResourceConflict:
-                raise RevisionConflict()
-            self._allocate_new_generation(doc.doc_id, transaction_id)
+                # the change is logged first, and it stays hidden until the
+                # document holding its generation is written
+                while True:
+                    try:
+                        self._database.save(gen_doc)
+                        break
+                    except ResourceConflict:
+                        # the generation was taken by a writer that does not
+                        # reserve generations, so log the change with a new
+                        # one
+                        self.release_generations([gen_doc[GENERATION_KEY]])
+                        gen_doc = self._allocate_new_generation(
+                            doc.doc_id, transaction_id, save=False)
+                couch_doc[DOC_GENERATION_KEY] = gen_doc[GENERATION_KEY]
+                # prepare the multipart PUT
+                buf = StringIO()
+                envelope = MultipartWriter(buf)
+                # the order in which attachments are described inside the
+                # serialization of the couch document must match the order in
+                # which they are actually written in the multipart structure.
+                # Because of that, we use `sorted_keys=True` in the json
+                # serialization (so "u1db_conflicts" comes before
+                # "u1db_content" on the couch document attachments
+                # description), and also reverse the order of the parts
+                # before writing them, so the "conflict" part is written
+                # before the "content" part.
+                envelope.add(
+                    'application/json',
+                    json.dumps(couch_doc, sort_keys=True))
+                parts.reverse()
+                for part in parts:
+                    envelope.add('application/octet-stream', part)
+                envelope.close()
+                # try to save and fail if there's a revision conflict
+                try:
+                    resource = self._new_resource()
+                    resource.put_json(
+                        doc.doc_id, body=str(buf.getvalue()),
+                        headers=envelope.headers)
+                except ResourceConflict:
+                    # the logged change did not happen
+                    self._delete_gen_docs([gen_doc])
+                    raise RevisionConflict()
+            finally:
+                self.release_generations([gen_doc[GENERATION_KEY]])
         else:
             for name, attachment in attachments.items():
                 del attachment['follows']
@@ -790,12 +1255,11 @@ class CouchDatabase(object):
                 attachment['data'] = binascii.b2a_base64(
                     parts[index]).strip()
             couch_doc['_attachments'] = attachments
-            gen_doc = self._allocate_new_generation(
-                doc.doc_id, transaction_id, save=False)
             self.batch_docs[doc.doc_id] = couch_doc
             self.batch_docs[gen_doc['_id']] = gen_doc
-            last_gen, last_trans_id = self.batch_generation
-            self.batch_generation = (last_gen + 1, transaction_id)
+            # the version fetched when the batch started is outdated now
+            self.batch_current_docs.pop(doc.doc_id, None)
+            self.batch_generation = (gen_doc[GENERATION_KEY], transaction_id)
 
     def _new_resource(self, *path):
         """
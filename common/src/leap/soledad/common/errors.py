@@ -69,6 +69,25 @@ class InvalidAuthTokenError(errors.Unauthorized):
     status = 401
 
 
+#
+# Sync errors
+#
+
+
+@register_exception
+class SyncStateMismatchError(SoledadError):
+
+    """
+    Exception raised when a sync exchange done in a single request expects the
+    server to know a different generation of the client replica than the one
+    it has recorded. The client has to get the sync info from the server
+    before syncing.
+    """
+
+    wire_description = "sync state mismatch"
+    status = 409
+
+
 #
 # SoledadBackend errors
 # u1db error statuses also have to be updated
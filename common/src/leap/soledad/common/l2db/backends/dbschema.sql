@@ -4,6 +4,11 @@ CREATE TABLE transaction_log (
     doc_id TEXT NOT NULL,
     transaction_id TEXT NOT NULL
 );
+CREATE TABLE doc_latest_generation (
+    generation INTEGER PRIMARY KEY,
+    doc_id TEXT NOT NULL UNIQUE,
+    transaction_id TEXT NOT NULL
+);
 CREATE TABLE document (
     doc_id TEXT PRIMARY KEY,
     doc_rev TEXT NOT NULL,
@@ -16,12 +21,27 @@ CREATE TABLE document_fields (
 );
 CREATE INDEX document_fields_field_value_doc_idx
     ON document_fields(field_name, value, doc_id);
+CREATE INDEX document_fields_doc_field_value_idx
+    ON document_fields(doc_id, field_name, value);
 
 CREATE TABLE sync_log (
     replica_uid TEXT PRIMARY KEY,
     known_generation INTEGER,
     known_transaction_id TEXT
 );
+CREATE TABLE sync_checkpoint (
+    replica_uid TEXT PRIMARY KEY,
+    sync_id TEXT NOT NULL,
+    received INTEGER NOT NULL
+);
+CREATE TABLE sync_target_info (
+    url TEXT PRIMARY KEY,
+    replica_uid TEXT NOT NULL,
+    known_generation INTEGER NOT NULL,
+    known_transaction_id TEXT NOT NULL,
+    pending_generation INTEGER,
+    pending_transaction_id TEXT
+);
 CREATE TABLE conflicts (
     doc_id TEXT,
     doc_rev TEXT,
@@ -39,4 +59,4 @@ CREATE TABLE u1db_config (
     name TEXT PRIMARY KEY,
     value TEXT
 );
-INSERT INTO u1db_config VALUES ('sql_schema', '0');
+INSERT INTO u1db_config VALUES ('sql_schema', '4');
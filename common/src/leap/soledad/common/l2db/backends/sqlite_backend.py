@@ -19,7 +19,9 @@
 A L2DB implementation that uses SQLite as its persistence layer.
 """
 
+import copy
 import errno
+import hashlib
 import os
 import json
 import sys
@@ -35,11 +37,50 @@ from leap.soledad.common.l2db import (
     query_parser, vectorclock)
 
 
+# The prefix of the names of sqlite indexes over index expressions, see
+# SQLiteExpressionIndexDatabase.
+_EXPRESSION_INDEX_PREFIX = 'document_expr_'
+
+
 class SQLiteDatabase(CommonBackend):
     """A U1DB implementation that uses SQLite as its persistence layer."""
 
     _sqlite_registry = {}
 
+    # The schema version created by dbschema.sql. Databases with an older
+    # version are upgraded by _migrate_schema().
+    _schema_version = 4
+
+    # The maximum number of doc ids bound to a single statement, kept below
+    # the default SQLITE_MAX_VARIABLE_NUMBER of 999.
+    _max_doc_ids_per_statement = 500
+
+    # A (version, [(field, Getter)]) tuple caching the parsed index
+    # definitions, see _get_index_getters().
+    _index_getters_cache = None
+
+    # A (version, {index_name: [field]}) tuple caching index definitions,
+    # see _get_index_definition().
+    _index_definitions_cache = None
+
+    # SQL conditions on index values by kind of match, see
+    # _get_query_conditions() and _get_range_conditions().
+    _query_conditions = {
+        '=': '%(value)s = ?',
+        'glob': '%(value)s >= ? AND %(value)s < ? AND %(value)s GLOB ?',
+        'pattern': '%(value)s GLOB ?',
+        '*': '%(value)s NOT NULL'}
+    _range_conditions = {
+        '>=': '%(value)s >= ?',
+        '<=': '%(value)s <= ?',
+        'glob': '%(value)s < ?',
+        'pattern': '(%(value)s < ? OR %(value)s GLOB ?)',
+        '*': '%(value)s NOT NULL'}
+
+    # A dictionary of index query statements, keyed by query shape, see
+    # _get_cached_statement().
+    _statement_cache = None
+
     def __init__(self, sqlite_file, document_factory=None):
         """Create a new sqlite file."""
         self._db_handle = dbapi2.connect(sqlite_file)
@@ -180,11 +221,61 @@ class SQLiteDatabase(CommonBackend):
         c.execute("INSERT INTO u1db_config VALUES" " ('index_storage', ?)",
                   (self._index_storage_value,))
 
+    def _get_schema_version(self, c):
+        """Return the schema version of an initialized database."""
+        c.execute("SELECT value FROM u1db_config WHERE name = 'sql_schema'")
+        return int(c.fetchone()[0])
+
+    def _migrate_schema(self, c):
+        """Upgrade the schema of an existing database to the current version.
+
+        A transaction should already be held.
+        """
+        version = self._get_schema_version(c)
+        if version < 1:
+            # covering indexes for index lookups and for the per-document
+            # joins and deletes on document_fields.
+            c.execute("CREATE INDEX IF NOT EXISTS"
+                      " document_fields_field_value_doc_idx"
+                      " ON document_fields(field_name, value, doc_id)")
+            c.execute("CREATE INDEX IF NOT EXISTS"
+                      " document_fields_doc_field_value_idx"
+                      " ON document_fields(doc_id, field_name, value)")
+            c.execute("ANALYZE")
+        if version < 2:
+            # the latest generation of each document, used by whats_changed.
+            c.execute("CREATE TABLE IF NOT EXISTS doc_latest_generation ("
+                      " generation INTEGER PRIMARY KEY,"
+                      " doc_id TEXT NOT NULL UNIQUE,"
+                      " transaction_id TEXT NOT NULL)")
+            c.execute("INSERT OR REPLACE INTO doc_latest_generation"
+                      " SELECT max(generation), doc_id, transaction_id"
+                      " FROM transaction_log GROUP BY doc_id")
+        if version < 3:
+            # the interrupted sync session with each replica, if any.
+            c.execute("CREATE TABLE IF NOT EXISTS sync_checkpoint ("
+                      " replica_uid TEXT PRIMARY KEY,"
+                      " sync_id TEXT NOT NULL,"
+                      " received INTEGER NOT NULL)")
+        if version < 4:
+            # what the replicas this one syncs with know about it.
+            c.execute("CREATE TABLE IF NOT EXISTS sync_target_info ("
+                      " url TEXT PRIMARY KEY,"
+                      " replica_uid TEXT NOT NULL,"
+                      " known_generation INTEGER NOT NULL,"
+                      " known_transaction_id TEXT NOT NULL,"
+                      " pending_generation INTEGER,"
+                      " pending_transaction_id TEXT)")
+        c.execute("UPDATE u1db_config SET value = ?"
+                  " WHERE name = 'sql_schema'", (str(self._schema_version),))
+
     def _ensure_schema(self):
-        """Ensure that the database schema has been created."""
+        """Ensure that the database schema has been created and is up to
+        date."""
         old_isolation_level = self._db_handle.isolation_level
         c = self._db_handle.cursor()
-        if self._is_initialized(c):
+        if self._is_initialized(c) and \
+                self._get_schema_version(c) >= self._schema_version:
             return
         try:
             # autocommit/own mgmt of transactions
@@ -192,9 +283,29 @@ class SQLiteDatabase(CommonBackend):
             with self._db_handle:
                 # only one execution path should initialize the db
                 c.execute("begin exclusive")
-                if self._is_initialized(c):
-                    return
-                self._initialize(c)
+                if not self._is_initialized(c):
+                    self._initialize(c)
+                elif self._get_schema_version(c) < self._schema_version:
+                    self._migrate_schema(c)
+        finally:
+            self._db_handle.isolation_level = old_isolation_level
+
+    def _run_in_transaction(self, meth, *args):
+        """Run meth in an explicitly started transaction.
+
+        The sqlite3 module commits any open transaction before running a
+        statement that changes the schema, so changes that create or drop
+        sqlite indexes have to manage the transaction themselves to stay
+        atomic. meth should commit using "with self._db_handle".
+        """
+        old_isolation_level = self._db_handle.isolation_level
+        try:
+            self._db_handle.isolation_level = None
+            self._db_handle.cursor().execute("begin")
+            return meth(*args)
+        except:
+            self._db_handle.rollback()
+            raise
         finally:
             self._db_handle.isolation_level = old_isolation_level
 
@@ -203,15 +314,54 @@ class SQLiteDatabase(CommonBackend):
 
     def _parse_index_definition(self, index_field):
         """Parse a field definition for an index, returning a Getter."""
-        # Note: We may want to keep a Parser object around, and cache the
-        #       Getter objects for a greater length of time. Specifically, if
-        #       you create a bunch of indexes, and then insert 50k docs, you'll
-        #       re-parse the indexes between puts. The time to insert the docs
-        #       is still likely to dominate put_doc time, though.
+        # Note: Getters for every indexed field are cached between puts by
+        #       _get_index_getters(), so this is only called when the index
+        #       definitions change.
         parser = query_parser.Parser()
         getter = parser.parse(index_field)
         return getter
 
+    def _get_index_definitions_version(self, c):
+        """Return the version of the index definitions.
+
+        The version changes every time an index is created or deleted, so
+        connections can tell whether their cached definitions are stale.
+        """
+        c.execute("SELECT value FROM u1db_config"
+                  " WHERE name = 'index_definitions_version'")
+        val = c.fetchone()
+        if val is None:
+            return None
+        return val[0]
+
+    def _bump_index_definitions_version(self, c):
+        """Change the version of the index definitions.
+
+        A transaction should already be held.
+        """
+        version = self._get_index_definitions_version(c)
+        c.execute("INSERT OR REPLACE INTO u1db_config"
+                  " VALUES ('index_definitions_version', ?)",
+                  (str(int(version or 0) + 1),))
+        self._index_getters_cache = None
+        self._index_definitions_cache = None
+
+    def _get_index_getters(self):
+        """Return a list of [(field_name, Getter)] for all indexed fields.
+
+        The list is cached and only rebuilt when the index definitions
+        version changes, so that puts don't have to re-read and re-parse
+        every index definition.
+        """
+        c = self._db_handle.cursor()
+        version = self._get_index_definitions_version(c)
+        cache = self._index_getters_cache
+        if cache is None or cache[0] != version:
+            getters = [(field, self._parse_index_definition(field))
+                       for field in self._get_indexed_fields()]
+            cache = self._index_getters_cache = (version, getters)
+        return cache[1]
+
     def _update_indexes(self, doc_id, raw_doc, getters, db_cursor):
         """Update document_fields for a single document.
 
@@ -314,6 +464,48 @@ class SQLiteDatabase(CommonBackend):
         doc.has_conflicts = conflicts > 0
         return doc
 
+    def _select_by_doc_ids(self, c, statement, doc_ids):
+        """Run statement for chunks of doc_ids and yield the result rows.
+
+        statement must have a single %s where the placeholders of a chunk
+        go, as in "... WHERE doc_id IN (%s)".
+        """
+        for i in range(0, len(doc_ids), self._max_doc_ids_per_statement):
+            chunk = doc_ids[i:i + self._max_doc_ids_per_statement]
+            c.execute(statement % ','.join('?' * len(chunk)), chunk)
+            for row in c.fetchall():
+                yield row
+
+    def _get_docs(self, doc_ids, check_for_conflicts=False):
+        """Get the documents with the given ids in bulk, keyed by doc_id."""
+        doc_ids = list(set(doc_ids))
+        c = self._db_handle.cursor()
+        docs = {}
+        for doc_id, doc_rev, content in self._select_by_doc_ids(
+                c, "SELECT doc_id, doc_rev, content FROM document"
+                " WHERE doc_id IN (%s)", doc_ids):
+            doc = self._factory(doc_id, doc_rev, content)
+            doc.has_conflicts = False
+            docs[doc_id] = doc
+        if check_for_conflicts:
+            for doc_id, in self._select_by_doc_ids(
+                    c, "SELECT DISTINCT doc_id FROM conflicts"
+                    " WHERE doc_id IN (%s)", doc_ids):
+                docs[doc_id].has_conflicts = True
+        return docs
+
+    def get_docs(self, doc_ids, check_for_conflicts=True,
+                 include_deleted=False):
+        doc_ids = list(doc_ids)
+        docs = self._get_docs(doc_ids, check_for_conflicts=check_for_conflicts)
+        for doc_id in doc_ids:
+            doc = docs.get(doc_id)
+            if doc is None:
+                continue
+            if doc.is_tombstone() and not include_deleted:
+                continue
+            yield doc
+
     def _has_conflicts(self, doc_id):
         c = self._db_handle.cursor()
         c.execute("SELECT 1 FROM conflicts WHERE doc_id = ? LIMIT 1",
@@ -358,22 +550,125 @@ class SQLiteDatabase(CommonBackend):
         self._check_doc_size(doc)
         with self._db_handle:
             old_doc = self._get_doc(doc.doc_id, check_for_conflicts=True)
-            if old_doc and old_doc.has_conflicts:
-                raise errors.ConflictedDoc()
-            if old_doc and doc.rev is None and old_doc.is_tombstone():
-                new_rev = self._allocate_doc_rev(old_doc.rev)
-            else:
-                if old_doc is not None:
-                        if old_doc.rev != doc.rev:
-                            raise errors.RevisionConflict()
-                else:
-                    if doc.rev is not None:
-                        raise errors.RevisionConflict()
-                new_rev = self._allocate_doc_rev(doc.rev)
+            new_rev = self._check_put(old_doc, doc)
             doc.rev = new_rev
             self._put_and_update_indexes(old_doc, doc)
         return new_rev
 
+    def _check_put(self, old_doc, doc):
+        """Check that doc can be stored over old_doc and return its new rev.
+        """
+        if old_doc and old_doc.has_conflicts:
+            raise errors.ConflictedDoc()
+        if old_doc and doc.rev is None and old_doc.is_tombstone():
+            return self._allocate_doc_rev(old_doc.rev)
+        if old_doc is not None:
+            if old_doc.rev != doc.rev:
+                raise errors.RevisionConflict()
+        else:
+            if doc.rev is not None:
+                raise errors.RevisionConflict()
+        return self._allocate_doc_rev(doc.rev)
+
+    def _check_delete(self, old_doc, doc):
+        """Check that doc can be deleted and return the tombstone's rev."""
+        if old_doc is None:
+            raise errors.DocumentDoesNotExist
+        if old_doc.rev != doc.rev:
+            raise errors.RevisionConflict()
+        if old_doc.is_tombstone():
+            raise errors.DocumentAlreadyDeleted
+        if old_doc.has_conflicts:
+            raise errors.ConflictedDoc()
+        return self._allocate_doc_rev(doc.rev)
+
+    def apply_batch(self, operations):
+        """Apply many write operations in a single transaction.
+
+        Operations are checked in order, as if they were run one after the
+        other, but all documents, index fields and transaction log entries
+        are written in bulk at the end. If any operation fails, none of them
+        is applied.
+
+        :param operations: A list of tuples, each one of ('create', content,
+            doc_id), ('put', doc) or ('delete', doc).
+        :return: The list of resulting documents, in the same order as the
+            operations.
+        """
+        docs = []
+        changes = []
+        pending = {}
+        # the caller's documents are only changed once the batch is written,
+        # so the checks work on copies of them
+        staged = {}
+        with self._db_handle:
+            for operation in operations:
+                op = operation[0]
+                if op == 'create':
+                    content, doc_id = operation[1:]
+                    if not isinstance(content, dict):
+                        raise errors.InvalidContent
+                    if doc_id is None:
+                        doc_id = self._allocate_doc_id()
+                    doc = self._factory(doc_id, None, json.dumps(content))
+                elif op in ('put', 'delete'):
+                    original = operation[1]
+                    if id(original) not in staged:
+                        staged[id(original)] = (original, copy.copy(original))
+                    doc = staged[id(original)][1]
+                else:
+                    raise ValueError('Unknown batch operation: %r' % (op,))
+                if op != 'delete':
+                    if doc.doc_id is None:
+                        raise errors.InvalidDocId()
+                    self._check_doc_id(doc.doc_id)
+                    self._check_doc_size(doc)
+                if doc.doc_id in pending:
+                    old_doc = pending[doc.doc_id]
+                else:
+                    old_doc = self._get_doc(
+                        doc.doc_id, check_for_conflicts=True)
+                if op == 'delete':
+                    doc.rev = self._check_delete(old_doc, doc)
+                    doc.make_tombstone()
+                else:
+                    doc.rev = self._check_put(old_doc, doc)
+                pending[doc.doc_id] = doc
+                changes.append((old_doc, doc))
+                docs.append(doc if op == 'create' else original)
+            if changes:
+                self._put_many_and_update_indexes(changes)
+        for original, doc in staged.values():
+            original.rev = doc.rev
+            if doc.is_tombstone():
+                original.make_tombstone()
+        return docs
+
+    def create_docs(self, contents):
+        """Create many documents in a single transaction.
+
+        :param contents: A list of python dictionaries.
+        :return: The list of created documents.
+        """
+        return self.apply_batch(
+            [('create', content, None) for content in contents])
+
+    def put_docs(self, docs):
+        """Update many documents in a single transaction.
+
+        :param docs: A list of documents with new content.
+        :return: The list of updated documents.
+        """
+        return self.apply_batch([('put', doc) for doc in docs])
+
+    def delete_docs(self, docs):
+        """Mark many documents as deleted in a single transaction.
+
+        :param docs: A list of documents to be deleted.
+        :return: The list of deleted documents.
+        """
+        return self.apply_batch([('delete', doc) for doc in docs])
+
     def _expand_to_fields(self, doc_id, base_field, raw_doc, save_none):
         """Convert a dict representation into named fields.
 
@@ -411,25 +706,26 @@ class SQLiteDatabase(CommonBackend):
         """
         raise NotImplementedError(self._put_and_update_indexes)
 
+    def _put_many_and_update_indexes(self, changes):
+        """Insert many documents into the database at once.
+
+        :param changes: A list of (old_doc, doc) tuples, in the order in which
+            they should show up in the transaction log.
+        """
+        raise NotImplementedError(self._put_many_and_update_indexes)
+
     def whats_changed(self, old_generation=0):
         c = self._db_handle.cursor()
-        c.execute("SELECT generation, doc_id, transaction_id"
-                  " FROM transaction_log"
-                  " WHERE generation > ? ORDER BY generation DESC",
+        # doc_latest_generation holds only the last change of each document,
+        # so there is nothing to deduplicate.
+        c.execute("SELECT doc_id, generation, transaction_id"
+                  " FROM doc_latest_generation"
+                  " WHERE generation > ? ORDER BY generation",
                   (old_generation,))
-        results = c.fetchall()
-        cur_gen = old_generation
-        seen = set()
-        changes = []
-        newest_trans_id = ''
-        for generation, doc_id, trans_id in results:
-            if doc_id not in seen:
-                changes.append((doc_id, generation, trans_id))
-                seen.add(doc_id)
+        changes = c.fetchall()
         if changes:
-            cur_gen = changes[0][1]  # max generation
-            newest_trans_id = changes[0][2]
-            changes.reverse()
+            cur_gen = changes[-1][1]  # max generation
+            newest_trans_id = changes[-1][2]
         else:
             c.execute("SELECT generation, transaction_id"
                       " FROM transaction_log ORDER BY generation DESC LIMIT 1")
@@ -442,18 +738,60 @@ class SQLiteDatabase(CommonBackend):
 
         return cur_gen, newest_trans_id, changes
 
+    def _log_transaction(self, c, doc_id):
+        """Add a transaction log entry and record it as the latest generation
+        of the document.
+
+        :return: The new generation.
+        """
+        trans_id = self._allocate_transaction_id()
+        c.execute("INSERT INTO transaction_log(doc_id, transaction_id)"
+                  " VALUES (?, ?)", (doc_id, trans_id))
+        generation = c.lastrowid
+        c.execute("INSERT OR REPLACE INTO doc_latest_generation"
+                  " VALUES (?, ?, ?)", (generation, doc_id, trans_id))
+        return generation
+
+    def _log_many_transactions(self, c, doc_ids):
+        """Add transaction log entries for many documents, in order."""
+        last_generation = self._get_generation()
+        c.executemany("INSERT INTO transaction_log(doc_id, transaction_id)"
+                      " VALUES (?, ?)",
+                      [(doc_id, self._allocate_transaction_id())
+                       for doc_id in doc_ids])
+        c.execute("INSERT OR REPLACE INTO doc_latest_generation"
+                  " SELECT generation, doc_id, transaction_id"
+                  " FROM transaction_log WHERE generation > ?"
+                  " ORDER BY generation", (last_generation,))
+
+    def compact_transaction_log(self):
+        """Remove superseded transaction log entries no sync target needs.
+
+        An entry is superseded when the same document changed again later.
+        The latest entry of each document is always kept, so whats_changed()
+        answers are unaffected, but generations below the lowest one the sync
+        targets have recorded for this replica can no longer be validated.
+        Nothing is removed while no sync target info is known.
+
+        :return: The number of removed entries.
+        :rtype: int
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute("SELECT MIN(known_generation) FROM sync_target_info")
+            generation = c.fetchone()[0]
+            if generation is None:
+                return 0
+            c.execute("DELETE FROM transaction_log WHERE generation < ?"
+                      " AND generation NOT IN"
+                      " (SELECT generation FROM doc_latest_generation"
+                      " WHERE generation < ?)", (generation, generation))
+            return c.rowcount
+
     def delete_doc(self, doc):
         with self._db_handle:
             old_doc = self._get_doc(doc.doc_id, check_for_conflicts=True)
-            if old_doc is None:
-                raise errors.DocumentDoesNotExist
-            if old_doc.rev != doc.rev:
-                raise errors.RevisionConflict()
-            if old_doc.is_tombstone():
-                raise errors.DocumentAlreadyDeleted
-            if old_doc.has_conflicts:
-                raise errors.ConflictedDoc()
-            new_rev = self._allocate_doc_rev(doc.rev)
+            new_rev = self._check_delete(old_doc, doc)
             doc.rev = new_rev
             doc.make_tombstone()
             self._put_and_update_indexes(old_doc, doc)
@@ -503,6 +841,78 @@ class SQLiteDatabase(CommonBackend):
                       (other_replica_uid, other_generation,
                        other_transaction_id))
 
+    def _get_sync_checkpoint(self, other_replica_uid):
+        """Get the interrupted sync session with another replica, if any.
+
+        :return: A (sync_id, received) tuple with the id of the session and
+            the number of documents received from the other replica during
+            it, or None.
+        """
+        c = self._db_handle.cursor()
+        c.execute("SELECT sync_id, received FROM sync_checkpoint"
+                  " WHERE replica_uid = ?", (other_replica_uid,))
+        val = c.fetchone()
+        if val is None:
+            return None
+        return val[0], val[1]
+
+    def _set_sync_checkpoint(self, other_replica_uid, sync_id):
+        """Record that a sync session with another replica has started.
+
+        The session is kept until _clear_sync_checkpoint() is called, so it
+        can be resumed if the sync is interrupted.
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute("INSERT OR REPLACE INTO sync_checkpoint"
+                      " VALUES (?, ?, 0)", (other_replica_uid, sync_id))
+
+    def _clear_sync_checkpoint(self, other_replica_uid):
+        """Forget the sync session with another replica."""
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute("DELETE FROM sync_checkpoint WHERE replica_uid = ?",
+                      (other_replica_uid,))
+
+    def _get_sync_target_info(self, url):
+        """Get what the sync target at url knows about this replica.
+
+        :return: A (replica_uid, known_generation, known_transaction_id,
+            pending_generation, pending_transaction_id) tuple, or None. The
+            known generation is the one the target has recorded for this
+            replica, and the pending generation, if not None, is a later one
+            that has yet to be recorded with the target.
+        """
+        c = self._db_handle.cursor()
+        c.execute("SELECT replica_uid, known_generation, known_transaction_id,"
+                  " pending_generation, pending_transaction_id"
+                  " FROM sync_target_info WHERE url = ?", (url,))
+        val = c.fetchone()
+        if val is None:
+            return None
+        return tuple(val)
+
+    def _set_sync_target_info(self, url, other_replica_uid, known_generation,
+                              known_transaction_id, pending_generation=None,
+                              pending_transaction_id=None):
+        """Set what the sync target at url knows about this replica.
+
+        See _get_sync_target_info().
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute("INSERT OR REPLACE INTO sync_target_info"
+                      " VALUES (?, ?, ?, ?, ?, ?)",
+                      (url, other_replica_uid, known_generation,
+                       known_transaction_id, pending_generation,
+                       pending_transaction_id))
+
+    def _clear_sync_target_info(self, url):
+        """Forget what the sync target at url knows about this replica."""
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute("DELETE FROM sync_target_info WHERE url = ?", (url,))
+
     def _put_doc_if_newer(self, doc, save_conflict, replica_uid=None,
                           replica_gen=None, replica_trans_id=None):
         return super(SQLiteDatabase, self)._put_doc_if_newer(
@@ -511,6 +921,147 @@ class SQLiteDatabase(CommonBackend):
             replica_uid=replica_uid, replica_gen=replica_gen,
             replica_trans_id=replica_trans_id)
 
+    def _put_docs_if_newer(self, docs, save_conflict, replica_uid,
+                           sync_id=None):
+        """Insert many documents received from another replica at once.
+
+        This has the same outcome as calling _put_doc_if_newer() for each
+        document in order, but the current revisions and conflicts of all
+        documents are read with a single query each, and documents,
+        conflicts and transaction log entries are written in bulk in a
+        single transaction. If any document fails, none of them is applied.
+
+        :param docs: A list of (doc, replica_gen, replica_trans_id) tuples,
+            in the order in which they were received from the replica.
+        :param save_conflict: Whether to store conflicting documents.
+        :param replica_uid: The uid of the replica the documents came from.
+        :param sync_id: The id of the sync session the documents were
+            received in. If given, the documents are also counted as
+            received in that session's checkpoint.
+        :return: The list of the states of the documents, each one of
+            'inserted', 'superseded', 'converged' or 'conflicted'.
+        """
+        states = []
+        changes = []
+        with self._db_handle:
+            known_gen, known_trans_id = self._get_replica_gen_and_trans_id(
+                replica_uid)
+            doc_ids = [doc.doc_id for doc, _, _ in docs]
+            current = self._get_docs(doc_ids)
+            conflicts = self._get_many_conflicts(doc_ids)
+            stored_conflicts = dict(
+                (doc_id, set(c_doc.rev for c_doc in c_docs))
+                for doc_id, c_docs in conflicts.iteritems())
+            for doc, replica_gen, replica_trans_id in docs:
+                if replica_gen < known_gen:
+                    raise errors.InvalidGeneration
+                if replica_gen == known_gen and \
+                        replica_trans_id != known_trans_id:
+                    raise errors.InvalidTransactionId
+                known_gen, known_trans_id = replica_gen, replica_trans_id
+                cur_doc = current.get(doc.doc_id)
+                cur_vcr = vectorclock.VectorClockRev(
+                    cur_doc.rev if cur_doc is not None else None)
+                doc_vcr = vectorclock.VectorClockRev(doc.rev)
+                if doc_vcr.is_newer(cur_vcr):
+                    rev = doc.rev
+                    self._prune_many_conflicts(doc, doc_vcr, conflicts)
+                    state = 'inserted' if doc.rev == rev else 'superseded'
+                elif doc.rev == cur_doc.rev:
+                    state = 'converged'
+                    doc = None
+                elif cur_vcr.is_newer(doc_vcr):
+                    state = 'superseded'
+                    doc = None
+                elif cur_doc.same_content_as(doc):
+                    doc_vcr.maximize(cur_vcr)
+                    doc_vcr.increment(self._replica_uid)
+                    doc.rev = doc_vcr.as_str()
+                    state = 'superseded'
+                else:
+                    state = 'conflicted'
+                    if save_conflict:
+                        self._prune_many_conflicts(
+                            doc, vectorclock.VectorClockRev(doc.rev),
+                            conflicts)
+                        conflicts.setdefault(doc.doc_id, []).append(cur_doc)
+                        doc.has_conflicts = True
+                    else:
+                        doc = None
+                if doc is not None:
+                    changes.append((cur_doc, doc))
+                    current[doc.doc_id] = doc
+                states.append(state)
+            self._write_many_conflicts(stored_conflicts, conflicts)
+            if changes:
+                self._put_many_and_update_indexes(changes)
+            if docs and replica_uid is not None:
+                self._do_set_replica_gen_and_trans_id(
+                    replica_uid, known_gen, known_trans_id)
+            if sync_id is not None:
+                c = self._db_handle.cursor()
+                c.execute("UPDATE sync_checkpoint SET received = received + ?"
+                          " WHERE replica_uid = ? AND sync_id = ?",
+                          (len(docs), replica_uid, sync_id))
+        return states
+
+    def _get_many_conflicts(self, doc_ids):
+        """Get the conflicts of many documents, keyed by doc_id."""
+        c = self._db_handle.cursor()
+        conflicts = {}
+        for doc_id, doc_rev, content in self._select_by_doc_ids(
+                c, "SELECT doc_id, doc_rev, content FROM conflicts"
+                " WHERE doc_id IN (%s)", list(set(doc_ids))):
+            conflicts.setdefault(doc_id, []).append(
+                self._factory(doc_id, doc_rev, content))
+        return conflicts
+
+    def _prune_many_conflicts(self, doc, doc_vcr, conflicts):
+        """Prune the conflicts superseded by doc, like _prune_conflicts().
+
+        :param conflicts: The conflict documents keyed by doc_id, which is
+            updated in place.
+        """
+        if not conflicts.get(doc.doc_id):
+            return
+        autoresolved = False
+        remaining = []
+        for c_doc in conflicts[doc.doc_id]:
+            c_vcr = vectorclock.VectorClockRev(c_doc.rev)
+            if doc_vcr.is_newer(c_vcr):
+                continue
+            if doc.same_content_as(c_doc):
+                doc_vcr.maximize(c_vcr)
+                autoresolved = True
+                continue
+            remaining.append(c_doc)
+        if autoresolved:
+            doc_vcr.increment(self._replica_uid)
+            doc.rev = doc_vcr.as_str()
+        conflicts[doc.doc_id] = remaining
+        doc.has_conflicts = bool(remaining)
+
+    def _write_many_conflicts(self, stored_conflicts, conflicts):
+        """Write the difference between the stored and the new conflicts.
+
+        :param stored_conflicts: The sets of stored conflict revisions, keyed
+            by doc_id.
+        :param conflicts: The lists of conflict documents to keep, keyed by
+            doc_id.
+        """
+        deleted = []
+        inserted = []
+        for doc_id, c_docs in conflicts.iteritems():
+            stored = stored_conflicts.get(doc_id, set())
+            revs = set(c_doc.rev for c_doc in c_docs)
+            deleted.extend((doc_id, rev) for rev in stored - revs)
+            inserted.extend((doc_id, c_doc.rev, c_doc.get_json())
+                            for c_doc in c_docs if c_doc.rev not in stored)
+        c = self._db_handle.cursor()
+        c.executemany("DELETE FROM conflicts WHERE doc_id=? AND doc_rev=?",
+                      deleted)
+        c.executemany("INSERT INTO conflicts VALUES (?, ?, ?)", inserted)
+
     def _add_conflict(self, c, doc_id, my_doc_rev, my_content):
         c.execute("INSERT INTO conflicts VALUES (?, ?, ?)",
                   (doc_id, my_doc_rev, my_content))
@@ -594,13 +1145,22 @@ class SQLiteDatabase(CommonBackend):
 
     def _get_index_definition(self, index_name):
         """Return the stored definition for a given index_name."""
+        # Definitions are cached until the index definitions version changes,
+        # see _get_index_getters().
         c = self._db_handle.cursor()
-        c.execute("SELECT field FROM index_definitions"
-                  " WHERE name = ? ORDER BY offset", (index_name,))
-        fields = [x[0] for x in c.fetchall()]
-        if not fields:
-            raise errors.IndexDoesNotExist
-        return fields
+        version = self._get_index_definitions_version(c)
+        cache = self._index_definitions_cache
+        if cache is None or cache[0] != version:
+            cache = self._index_definitions_cache = (version, {})
+        definitions = cache[1]
+        if index_name not in definitions:
+            c.execute("SELECT field FROM index_definitions"
+                      " WHERE name = ? ORDER BY offset", (index_name,))
+            fields = [x[0] for x in c.fetchall()]
+            if not fields:
+                raise errors.IndexDoesNotExist
+            definitions[index_name] = fields
+        return list(definitions[index_name])
 
     @staticmethod
     def _strip_glob(value):
@@ -608,57 +1168,134 @@ class SQLiteDatabase(CommonBackend):
         assert value[-1] == '*'
         return value[:-1]
 
-    def _format_query(self, definition, key_values):
-        # First, build the definition. We join the document_fields table
-        # against itself, as many times as the 'width' of our definition.
-        # We then do a query for each key_value, one-at-a-time.
-        # Note: All of these strings are static, we could cache them, etc.
-        tables = ["document_fields d%d" % i for i in range(len(definition))]
-        novalue_where = ["d.doc_id = d%d.doc_id"
-                         " AND d%d.field_name = ?"
-                         % (i, i) for i in range(len(definition))]
-        wildcard_where = [novalue_where[i] +
-                          (" AND d%d.value NOT NULL" % (i,))
-                          for i in range(len(definition))]
-        exact_where = [novalue_where[i] +
-                       (" AND d%d.value = ?" % (i,))
-                       for i in range(len(definition))]
-        like_where = [novalue_where[i] +
-                      (" AND d%d.value GLOB ?" % (i,))
-                      for i in range(len(definition))]
+    def _get_cached_statement(self, shape, build, *build_args):
+        """Return the statement for a query shape, building it if needed.
+
+        Index query statements only depend on the width of the index and on
+        which values are exact, glob or wildcard matches, so they are cached
+        by that shape. Reusing the exact same statement string also lets
+        sqlite reuse its prepared statement.
+
+        :param shape: A hashable description of the query.
+        :param build: A callable that builds the statement from build_args.
+        """
+        if self._statement_cache is None:
+            self._statement_cache = {}
+        statement = self._statement_cache.get(shape)
+        if statement is None:
+            statement = build(*build_args)
+            self._statement_cache[shape] = statement
+        return statement
+
+    def _parse_key_values(self, key_values, match, glob_match):
+        """Check the values of an index query and tell how each one matches.
+
+        :param key_values: The values to match, one for each indexed field.
+        :param match: The kind of match of plain values.
+        :param glob_match: The kind of match of globs. Globs are matched by
+            the prefix before the '*' when glob_match is '>=', and by the
+            prefix and the glob itself otherwise.
+        :return: A tuple with the kind of match of each value ('*' for
+            wildcards) and a list with the query arguments of each value.
+        """
         is_wildcard = False
-        # Merge the lists together, so that:
-        # [field1, field2, field3], [val1, val2, val3]
-        # Becomes:
-        # (field1, val1, field2, val2, field3, val3)
+        matches = []
         args = []
-        where = []
-        for idx, (field, value) in enumerate(zip(definition, key_values)):
-            args.append(field)
+        for value in key_values:
             if value.endswith('*'):
                 if value == '*':
-                    where.append(wildcard_where[idx])
+                    matches.append('*')
+                    args.append(())
                 else:
                     # This is a glob match
                     if is_wildcard:
                         # We can't have a partial wildcard following
                         # another wildcard
                         raise errors.InvalidGlobbing
-                    where.append(like_where[idx])
-                    args.append(value)
+                    matches.append(glob_match)
+                    if glob_match == '>=':
+                        args.append((self._strip_glob(value),))
+                    else:
+                        args.append((self._strip_glob(value), value))
                 is_wildcard = True
             else:
                 if is_wildcard:
                     raise errors.InvalidGlobbing
-                where.append(exact_where[idx])
-                args.append(value)
-        statement = (
+                matches.append(match)
+                args.append((value,))
+        return tuple(matches), args
+
+    def _format_query(self, definition, key_values):
+        matches, values = self._parse_key_values(key_values, '=', 'glob')
+        matches = list(matches)
+        for i, match in enumerate(matches):
+            if match == 'glob' and _has_glob_chars(values[i][0]):
+                # the prefix is a pattern itself, so it can't bound values
+                matches[i] = 'pattern'
+                values[i] = values[i][1:]
+        matches = tuple(matches)
+        # Merge the lists together, so that:
+        # [field1, field2, field3], [val1, val2, val3]
+        # Becomes:
+        # (field1, val1, field2, val2, field3, val3)
+        args = []
+        for field, field_values in zip(definition, values):
+            args.append(field)
+            args.extend(field_values)
+        width = len(definition)
+        statement = self._get_cached_statement(
+            ('query', width, matches),
+            self._build_query_statement, width, matches)
+        return statement, args
+
+    @staticmethod
+    def _build_query_statement(width, matches):
+        # First, build the definition. We join the document_fields table
+        # against itself, as many times as the 'width' of our definition.
+        # We then do a query for each key_value, one-at-a-time.
+        tables = ["document_fields d%d" % i for i in range(width)]
+        novalue_where = ["d.doc_id = d%d.doc_id"
+                         " AND d%d.field_name = ?"
+                         % (i, i) for i in range(width)]
+        wildcard_where = [novalue_where[i] +
+                          (" AND d%d.value NOT NULL" % (i,))
+                          for i in range(width)]
+        exact_where = [novalue_where[i] +
+                       (" AND d%d.value = ?" % (i,))
+                       for i in range(width)]
+        # globs are also bounded by their prefix, so that the index can be
+        # used to find the matching values
+        like_where = [novalue_where[i] +
+                      (" AND d%d.value >= ? AND d%d.value GLOB ?" % (i, i))
+                      for i in range(width)]
+        pattern_where = [novalue_where[i] +
+                         (" AND d%d.value GLOB ?" % (i,))
+                         for i in range(width)]
+        where_by_match = {
+            '*': wildcard_where, 'glob': like_where, 'pattern': pattern_where,
+            '=': exact_where}
+        where = [where_by_match[match][idx]
+                 for idx, match in enumerate(matches)]
+        return (
             "SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM "
-            "document d, %s LEFT OUTER JOIN conflicts c ON c.doc_id = "
+            "%s LEFT OUTER JOIN conflicts c ON c.doc_id = "
             "d.doc_id WHERE %s GROUP BY d.doc_id, d.doc_rev, d.content ORDER "
-            "BY %s;" % (', '.join(tables), ' AND '.join(where), ', '.join(
-                ['d%d.value' % i for i in range(len(definition))])))
-        return statement, args
+            "BY %s;" % (SQLiteDatabase._join_tables(tables),
+                        ' AND '.join(where), ', '.join(
+                            ['d%d.value' % i for i in range(width)])))
+
+    @staticmethod
+    def _join_tables(tables):
+        """Return the FROM clause joining document to document_fields tables.
+
+        Globs and wildcards are only allowed in trailing values, so the first
+        field always has the most selective condition. The join is driven
+        from it (CROSS JOIN fixes the loop order in sqlite) using the
+        (field_name, value, doc_id) covering index, and every other table is
+        then looked up by doc_id.
+        """
+        return "%s CROSS JOIN %s" % (
+            tables[0], ', '.join(["document d"] + tables[1:]))
 
     def get_from_index(self, index_name, *key_values):
         definition = self._get_index_definition(index_name)
@@ -680,84 +1317,75 @@ class SQLiteDatabase(CommonBackend):
             results.append(doc)
         return results
 
+    def _parse_range_values(self, definition, start_value, end_value):
+        """Check the bounds of a range query.
+
+        :return: A pair of (matches, args) tuples for the start and the end
+            of the range, see _parse_key_values(). The matches of a missing
+            bound are None.
+        """
+        bounds = []
+        for value, match, glob_match in ((start_value, '>=', '>='),
+                                         (end_value, '<=', 'glob')):
+            if not value:
+                bounds.append((None, []))
+                continue
+            if isinstance(value, basestring):
+                value = (value,)
+            if len(value) != len(definition):
+                raise errors.InvalidValueForIndex()
+            bounds.append(self._parse_key_values(value, match, glob_match))
+        return bounds
+
     def _format_range_query(self, definition, start_value, end_value):
-        tables = ["document_fields d%d" % i for i in range(len(definition))]
+        (start_matches, start_values), (end_matches, end_values) = \
+            self._parse_range_values(definition, start_value, end_value)
+        args = []
+        for values in (start_values, end_values):
+            for field, field_values in zip(definition, values):
+                args.append(field)
+                args.extend(field_values)
+        width = len(definition)
+        statement = self._get_cached_statement(
+            ('range', width, start_matches, end_matches),
+            self._build_range_query_statement,
+            width, start_matches, end_matches)
+        return statement, args
+
+    @staticmethod
+    def _build_range_query_statement(width, start_matches, end_matches):
+        tables = ["document_fields d%d" % i for i in range(width)]
         novalue_where = [
             "d.doc_id = d%d.doc_id AND d%d.field_name = ?" % (i, i) for i in
-            range(len(definition))]
+            range(width)]
         wildcard_where = [
             novalue_where[i] + (" AND d%d.value NOT NULL" % (i,)) for i in
-            range(len(definition))]
+            range(width)]
         like_where = [
             novalue_where[i] + (
                 " AND (d%d.value < ? OR d%d.value GLOB ?)" % (i, i)) for i in
-            range(len(definition))]
+            range(width)]
         range_where_lower = [
             novalue_where[i] + (" AND d%d.value >= ?" % (i,)) for i in
-            range(len(definition))]
+            range(width)]
         range_where_upper = [
             novalue_where[i] + (" AND d%d.value <= ?" % (i,)) for i in
-            range(len(definition))]
-        args = []
+            range(width)]
+        where_by_match = {
+            '*': wildcard_where, 'glob': like_where,
+            '>=': range_where_lower, '<=': range_where_upper}
         where = []
-        if start_value:
-            if isinstance(start_value, basestring):
-                start_value = (start_value,)
-            if len(start_value) != len(definition):
-                raise errors.InvalidValueForIndex()
-            is_wildcard = False
-            for idx, (field, value) in enumerate(zip(definition, start_value)):
-                args.append(field)
-                if value.endswith('*'):
-                    if value == '*':
-                        where.append(wildcard_where[idx])
-                    else:
-                        # This is a glob match
-                        if is_wildcard:
-                            # We can't have a partial wildcard following
-                            # another wildcard
-                            raise errors.InvalidGlobbing
-                        where.append(range_where_lower[idx])
-                        args.append(self._strip_glob(value))
-                    is_wildcard = True
-                else:
-                    if is_wildcard:
-                        raise errors.InvalidGlobbing
-                    where.append(range_where_lower[idx])
-                    args.append(value)
-        if end_value:
-            if isinstance(end_value, basestring):
-                end_value = (end_value,)
-            if len(end_value) != len(definition):
-                raise errors.InvalidValueForIndex()
-            is_wildcard = False
-            for idx, (field, value) in enumerate(zip(definition, end_value)):
-                args.append(field)
-                if value.endswith('*'):
-                    if value == '*':
-                        where.append(wildcard_where[idx])
-                    else:
-                        # This is a glob match
-                        if is_wildcard:
-                            # We can't have a partial wildcard following
-                            # another wildcard
-                            raise errors.InvalidGlobbing
-                        where.append(like_where[idx])
-                        args.append(self._strip_glob(value))
-                        args.append(value)
-                    is_wildcard = True
-                else:
-                    if is_wildcard:
-                        raise errors.InvalidGlobbing
-                    where.append(range_where_upper[idx])
-                    args.append(value)
-        statement = (
+        for matches in (start_matches, end_matches):
+            if matches:
+                where.extend(where_by_match[match][idx]
+                             for idx, match in enumerate(matches))
+        return (
             "SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM "
-            "document d, %s LEFT OUTER JOIN conflicts c ON c.doc_id = "
+            "%s LEFT OUTER JOIN conflicts c ON c.doc_id = "
             "d.doc_id WHERE %s GROUP BY d.doc_id, d.doc_rev, d.content ORDER "
-            "BY %s;" % (', '.join(tables), ' AND '.join(where), ', '.join(
-                ['d%d.value' % i for i in range(len(definition))])))
-        return statement, args
+            "BY %s;" % (SQLiteDatabase._join_tables(tables),
+                        ' AND '.join(where), ', '.join(
+                            ['d%d.value' % i for i in range(width)])))
 
     def get_range_from_index(self, index_name, start_value=None,
                              end_value=None):
@@ -780,35 +1408,296 @@ class SQLiteDatabase(CommonBackend):
             results.append(doc)
         return results
 
+    def _get_sql_expression(self, index_field):
+        """Return the SQL form of an index expression.
+
+        :return: None, all index values of this backend are stored in
+            document_fields. See SQLiteExpressionIndexDatabase.
+        """
+        return None
+
+    def _get_query_conditions(self, key_values):
+        """Return the SQL condition matching each value of an index query.
+
+        :return: A list of conditions, as '%(value)s' templates, and a list
+            with the query arguments of each condition.
+        """
+        matches, values = self._parse_key_values(key_values, '=', 'glob')
+        conditions = []
+        for i, match in enumerate(matches):
+            if match == 'glob':
+                prefix, glob = values[i]
+                if _has_glob_chars(prefix):
+                    # the prefix is a pattern itself, so it can't bound values
+                    match = 'pattern'
+                    values[i] = (glob,)
+                else:
+                    values[i] = (prefix, _prefix_upper_bound(prefix), glob)
+            conditions.append(self._query_conditions[match])
+        return conditions, values
+
+    def _get_range_conditions(self, definition, start_value, end_value):
+        """Return the SQL condition matching each field of a range query.
+
+        :return: A list of conditions, as '%(value)s' templates, and a list
+            with the query arguments of each condition.
+        """
+        # Both bounds of a field must hold for the same value, so they are
+        # checked in a single condition per field.
+        conditions = [[] for _ in definition]
+        values = [[] for _ in definition]
+        for matches, bound_values in self._parse_range_values(
+                definition, start_value, end_value):
+            for i, field_values in enumerate(bound_values):
+                match = matches[i]
+                if match == 'glob':
+                    if _has_glob_chars(field_values[0]):
+                        match = 'pattern'
+                    else:
+                        # values up to the glob are the ones below the upper
+                        # bound of its prefix
+                        field_values = (_prefix_upper_bound(field_values[0]),)
+                conditions[i].append(self._range_conditions[match])
+                values[i].extend(field_values)
+        conditions = [
+            ' AND '.join(field_conditions) or self._range_conditions['*']
+            for field_conditions in conditions]
+        return conditions, values
+
+    def get_from_index_page(self, index_name, key_values, limit, after=None):
+        """Return a page of the documents that match the keys supplied.
+
+        Documents are ordered by their lowest matching value of the first
+        field of the index and then by doc_id, and each page continues right
+        after the position where the previous one ended, so that going
+        through all pages costs about the same as a single get_from_index().
+
+        :param index_name: The index to query.
+        :param key_values: The values to match, as in get_from_index().
+        :param limit: The maximum number of documents in the page.
+        :param after: The position returned with the previous page, or None
+            to get the first page.
+        :return: A tuple of ([Document], position). The position is None
+            when there are no more documents.
+        """
+        definition = self._get_index_definition(index_name)
+        if len(key_values) != len(definition):
+            raise errors.InvalidValueForIndex()
+        conditions, values = self._get_query_conditions(key_values)
+        return self._get_index_page(
+            definition, conditions, values, limit, after)
+
+    def get_range_from_index_page(self, index_name, start_value, end_value,
+                                  limit, after=None):
+        """Return a page of the documents with key values in a range.
+
+        See get_range_from_index() for the range and get_from_index_page()
+        for the pages.
+        """
+        definition = self._get_index_definition(index_name)
+        conditions, values = self._get_range_conditions(
+            definition, start_value, end_value)
+        return self._get_index_page(
+            definition, conditions, values, limit, after)
+
+    def _get_index_page(self, definition, conditions, values, limit, after):
+        statement, args = self._format_page_query(
+            definition, conditions, values, after)
+        args.append(limit)
+        c = self._db_handle.cursor()
+        try:
+            c.execute(statement, tuple(args))
+        except dbapi2.OperationalError as e:
+            raise dbapi2.OperationalError(
+                str(e) +
+                '\nstatement: %s\nargs: %s\n' % (statement, args))
+        rows = c.fetchall()
+        results = []
+        for doc_id, doc_rev, content, conflicts, _ in rows:
+            doc = self._factory(doc_id, doc_rev, content)
+            doc.has_conflicts = conflicts > 0
+            results.append(doc)
+        if len(rows) < limit:
+            return results, None
+        return results, (rows[-1][4], rows[-1][0])
+
+    def _format_page_query(self, definition, conditions, values, after):
+        """Return the statement and arguments of a page of an index query.
+
+        The statement takes the page size as its last argument.
+
+        :param definition: The fields of the index.
+        :param conditions: The condition on the value of each field, as
+            '%(value)s' templates.
+        :param values: The query arguments of the condition of each field.
+        :param after: The (value, doc_id) position of the end of the
+            previous page, or None.
+        """
+        rest = []
+        for field, field_values in zip(definition[1:], values[1:]):
+            if self._get_sql_expression(field) is not None:
+                rest.extend(field_values)
+            rest.append(field)
+            rest.extend(field_values)
+        args = []
+        if self._get_sql_expression(definition[0]) is not None:
+            args.extend(values[0])
+            if after is not None:
+                args.extend([after[0], after[0], after[1]])
+            args.extend(rest)
+        args.append(definition[0])
+        args.extend(values[0])
+        if after is not None:
+            if conditions[0] == self._query_conditions['=']:
+                args.append(after[1])
+            else:
+                args.extend(after)
+        args.extend(values[0])
+        args.extend(rest)
+        definition = tuple(definition)
+        conditions = tuple(conditions)
+        statement = self._get_cached_statement(
+            ('page', definition, conditions, after is not None),
+            self._build_page_statement, definition, conditions,
+            after is not None)
+        return statement, args
+
+    def _build_page_statement(self, definition, conditions, has_position):
+        # Documents are read in the order of the (field_name, value, doc_id)
+        # index of the first field, and of its expression index, so a page
+        # is a range scan that stops after `limit` documents. A document
+        # with many matching values is only returned for its lowest one.
+        select = (
+            "SELECT %s, d.doc_rev, d.content, EXISTS (SELECT 1 FROM"
+            " conflicts c WHERE c.doc_id = d.doc_id), %s FROM ")
+        # Lower bounds of the first value are left out of the index lookup
+        # of later pages, so that it starts at the position instead. The
+        # other tables are looked up by doc_id.
+        condition = conditions[0]
+        if has_position:
+            condition = condition.replace(
+                '%(value)s >= ?', '+%(value)s >= ?')
+        rest = []
+        for field, field_condition in zip(definition[1:], conditions[1:]):
+            expanded_where = (
+                "EXISTS (SELECT 1 FROM document_fields f WHERE f.doc_id ="
+                " d.doc_id AND f.field_name = ? AND %s)"
+                % (field_condition % {'value': '+f.value'},))
+            expression = self._get_sql_expression(field)
+            if expression is None:
+                rest.append(expanded_where)
+            else:
+                rest.append("(%s OR %s)" % (
+                    field_condition % {'value': expression.sql('d.content')},
+                    expanded_where))
+        rest = ''.join(' AND ' + where for where in rest)
+        selects = []
+        expression = self._get_sql_expression(definition[0])
+        if expression is not None:
+            # the expression index doesn't hold doc_id, so only the value
+            # is looked up and ties are sorted.
+            value = expression.sql('d.content')
+            where = condition % {'value': value}
+            if has_position:
+                where += " AND %s >= ? AND (%s > ? OR d.doc_id > ?)" % (
+                    value, value)
+            selects.append(
+                select % ('d.doc_id', value) + "document d WHERE " + where
+                + rest)
+        where = condition % {'value': 'f0.value'}
+        if has_position:
+            if conditions[0] == self._query_conditions['=']:
+                where += " AND f0.doc_id > ?"
+            else:
+                where += " AND (f0.value, f0.doc_id) > (?, ?)"
+        selects.append(
+            select % ('f0.doc_id', 'f0.value')
+            + "document_fields f0 CROSS JOIN document d WHERE"
+            " f0.field_name = ? AND " + where
+            + " AND d.doc_id = f0.doc_id AND NOT EXISTS (SELECT 1 FROM"
+            " document_fields f WHERE f.doc_id = f0.doc_id AND"
+            " f.field_name = f0.field_name AND f.value < f0.value AND %s)"
+            % (conditions[0] % {'value': '+f.value'},) + rest)
+        return "%s ORDER BY 5, 1 LIMIT ?;" % (' UNION ALL '.join(selects),)
+
+    def get_all_docs_page(self, limit, after=None, include_deleted=False):
+        """Return a page of all documents in the database, ordered by doc_id.
+
+        :param limit: The maximum number of documents in the page.
+        :param after: The position returned with the previous page, or None
+            to get the first page.
+        :param include_deleted: If set to True, deleted documents will be
+            returned with empty content.
+        :return: A tuple of ([Document], position). The position is None
+            when there are no more documents.
+        """
+        where = []
+        args = []
+        if after is not None:
+            where.append("d.doc_id > ?")
+            args.append(after)
+        if not include_deleted:
+            where.append("d.content NOT NULL")
+        args.append(limit)
+        where = ' WHERE ' + ' AND '.join(where) if where else ''
+        c = self._db_handle.cursor()
+        c.execute(
+            "SELECT d.doc_id, d.doc_rev, d.content, EXISTS (SELECT 1 FROM"
+            " conflicts c WHERE c.doc_id = d.doc_id) FROM document d%s"
+            " ORDER BY d.doc_id LIMIT ?" % (where,), tuple(args))
+        rows = c.fetchall()
+        results = []
+        for doc_id, doc_rev, content, conflicts in rows:
+            doc = self._factory(doc_id, doc_rev, content)
+            doc.has_conflicts = conflicts > 0
+            results.append(doc)
+        if len(rows) < limit:
+            return results, None
+        return results, rows[-1][0]
+
     def get_index_keys(self, index_name):
         c = self._db_handle.cursor()
         definition = self._get_index_definition(index_name)
+        statement = self._format_index_keys_query(definition)
+        try:
+            c.execute(statement, tuple(definition))
+        except dbapi2.OperationalError as e:
+            raise dbapi2.OperationalError(
+                str(e) +
+                '\nstatement: %s\nargs: %s\n' % (statement, tuple(definition)))
+        return c.fetchall()
+
+    def _format_index_keys_query(self, definition):
+        """Return the statement listing the keys of an index.
+
+        The statement takes the fields of the definition as arguments.
+        """
+        width = len(definition)
+        return self._get_cached_statement(
+            ('keys', width), self._build_index_keys_statement, width)
+
+    @staticmethod
+    def _build_index_keys_statement(width):
         value_fields = ', '.join([
-            'd%d.value' % i for i in range(len(definition))])
-        tables = ["document_fields d%d" % i for i in range(len(definition))]
+            'd%d.value' % i for i in range(width)])
+        tables = ["document_fields d%d" % i for i in range(width)]
         novalue_where = [
             "d.doc_id = d%d.doc_id AND d%d.field_name = ?" % (i, i) for i in
-            range(len(definition))]
+            range(width)]
         where = [
             novalue_where[i] + (" AND d%d.value NOT NULL" % (i,)) for i in
-            range(len(definition))]
-        statement = (
+            range(width)]
+        return (
             "SELECT %s FROM document d, %s WHERE %s GROUP BY %s;" % (
                 value_fields, ', '.join(tables), ' AND '.join(where),
                 value_fields))
-        try:
-            c.execute(statement, tuple(definition))
-        except dbapi2.OperationalError as e:
-            raise dbapi2.OperationalError(
-                str(e) +
-                '\nstatement: %s\nargs: %s\n' % (statement, tuple(definition)))
-        return c.fetchall()
 
     def delete_index(self, index_name):
         with self._db_handle:
             c = self._db_handle.cursor()
             c.execute("DELETE FROM index_definitions WHERE name = ?",
                       (index_name,))
+            self._bump_index_definitions_version(c)
             c.execute(
                 "DELETE FROM document_fields WHERE document_fields.field_name "
                 " NOT IN (SELECT field from index_definitions)")
@@ -869,16 +1758,42 @@ class SQLitePartialExpandDatabase(SQLiteDatabase):
             c.execute("INSERT INTO document (doc_id, doc_rev, content)"
                       " VALUES (?, ?, ?)",
                       (doc.doc_id, doc.rev, doc.get_json()))
-        indexed_fields = self._get_indexed_fields()
-        if indexed_fields:
-            # It is expected that len(indexed_fields) is shorter than
-            # len(raw_doc)
-            getters = [(field, self._parse_index_definition(field))
-                       for field in indexed_fields]
+        getters = self._get_index_getters()
+        if getters:
+            # It is expected that len(getters) is shorter than len(raw_doc)
             self._update_indexes(doc.doc_id, raw_doc, getters, c)
-        trans_id = self._allocate_transaction_id()
-        c.execute("INSERT INTO transaction_log(doc_id, transaction_id)"
-                  " VALUES (?, ?)", (doc.doc_id, trans_id))
+        self._log_transaction(c, doc.doc_id)
+
+    def _put_many_and_update_indexes(self, changes):
+        c = self._db_handle.cursor()
+        inserts = []
+        updates = []
+        latest = {}
+        for old_doc, doc in changes:
+            if old_doc is None:
+                inserts.append((doc.doc_id, doc.rev, doc.get_json()))
+            else:
+                updates.append((doc.rev, doc.get_json(), doc.doc_id))
+            latest[doc.doc_id] = doc
+        c.executemany("INSERT INTO document (doc_id, doc_rev, content)"
+                      " VALUES (?, ?, ?)", inserts)
+        c.executemany("UPDATE document SET doc_rev=?, content=?"
+                      " WHERE doc_id = ?", updates)
+        c.executemany("DELETE FROM document_fields WHERE doc_id = ?",
+                      [(doc_id,) for _, _, doc_id in updates])
+        getters = self._get_index_getters()
+        if getters:
+            values = []
+            for doc_id, doc in latest.iteritems():
+                if doc.is_tombstone():
+                    continue
+                raw_doc = json.loads(doc.get_json())
+                for field_name, getter in getters:
+                    for idx_value in getter.get(raw_doc):
+                        values.append((doc_id, field_name, idx_value))
+            c.executemany(
+                "INSERT INTO document_fields VALUES (?, ?, ?)", values)
+        self._log_many_transactions(c, [doc.doc_id for _, doc in changes])
 
     def create_index(self, index_name, *index_expressions):
         with self._db_handle:
@@ -897,6 +1812,7 @@ class SQLitePartialExpandDatabase(SQLiteDatabase):
                     str(e) +
                     str(sys.exc_info()[2])
                 )
+            self._bump_index_definitions_version(c)
             new_fields = set(
                 [f for f in index_expressions if f not in cur_fields])
             if new_fields:
@@ -926,5 +1842,379 @@ class SQLitePartialExpandDatabase(SQLiteDatabase):
             raw_doc = json.loads(doc)
             self._update_indexes(doc_id, raw_doc, getters, c)
 
+    def convert_index_storage(self):
+        """Store the indexes of this database the way this class does.
+
+        Databases record how their indexes are stored ('index_storage' in
+        u1db_config) and open_database() uses the matching implementation.
+        To switch an existing database to another implementation, open it
+        with that implementation and call this method: all index data is
+        dropped and every document is indexed again.
+        """
+        self._run_in_transaction(self._convert_index_storage)
+
+    def _convert_index_storage(self):
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            index_storage, _ = self._which_index_storage(c)
+            if index_storage == self._index_storage_value:
+                return
+            c.execute("DELETE FROM document_fields")
+            c.execute("SELECT name FROM sqlite_master"
+                      " WHERE type = 'index' AND name GLOB ?",
+                      (_EXPRESSION_INDEX_PREFIX + '*',))
+            for (name,) in c.fetchall():
+                c.execute("DROP INDEX %s" % (name,))
+            c.execute("UPDATE u1db_config SET value = ?"
+                      " WHERE name = 'index_storage'",
+                      (self._index_storage_value,))
+            self._bump_index_definitions_version(c)
+            self._update_all_indexes(self._get_indexed_fields())
+
 
 SQLiteDatabase.register_implementation(SQLitePartialExpandDatabase)
+
+
+def _is_ascii(value):
+    return all(u'\x00' < char < u'\x80' for char in value)
+
+
+def _has_glob_chars(value):
+    """Return whether GLOB does not match all characters of value literally.
+    """
+    return any(char in value for char in '*?[')
+
+
+def _prefix_upper_bound(prefix):
+    """Return a value greater than every string that starts with prefix.
+
+    SQLite only bounds globs over plain columns, so the upper bound has to
+    be given to use expression indexes for globs.
+    """
+    chars = list(prefix)
+    while chars:
+        code = ord(chars[-1])
+        # skip surrogates, that don't sort by code point in narrow builds
+        if code < sys.maxunicode and not 0xd800 <= code <= 0xdfff:
+            chars[-1] = unichr(code + 1)
+            return u''.join(chars)
+        chars.pop()
+    # blobs sort after all text values
+    return buffer('')
+
+
+class _SQLIndexExpression(object):
+    """The SQL form of an index expression over the JSON document content.
+
+    Only fields, and the lower, number and bool transformations of fields,
+    can be computed by SQLite. An expression index holds a single value per
+    document, so documents where the field is (or is inside) a list are
+    still expanded into document_fields, see is_expanded().
+    """
+
+    def __init__(self, subfields, transformation=None):
+        self._subfields = subfields
+        self._transformation = transformation
+
+    @classmethod
+    def from_getter(cls, getter):
+        """Return the SQL form of a parsed index expression.
+
+        :return: A _SQLIndexExpression or None if the expression can't be
+            computed by SQLite.
+        """
+        transformation = None
+        if type(getter) in (
+                query_parser.Lower, query_parser.Number, query_parser.Bool):
+            transformation = getter
+            getter = getter.inner
+        if type(getter) is not query_parser.ExtractField:
+            return None
+        for subfield in getter.field:
+            # JSON1 compares object keys without unescaping them, and json
+            # escapes non-ascii characters, so only plain ascii keys can be
+            # looked up by SQL.
+            if not subfield or not all(
+                    ' ' <= char <= '~' and char not in '"\'\\'
+                    for char in subfield):
+                return None
+        return cls(getter.field, transformation)
+
+    @staticmethod
+    def _path(subfields):
+        return "'$.%s'" % '.'.join('"%s"' % (s,) for s in subfields)
+
+    @staticmethod
+    def _is_ascii_sql(value):
+        # length() counts characters up to the first NUL, while the length
+        # of the blob counts bytes, see _is_ascii().
+        return "length(CAST(%s AS BLOB)) = length(%s)" % (value, value)
+
+    def sql(self, content='content'):
+        """Return the SQL expression computing the index value.
+
+        :param content: The column holding the JSON content.
+        """
+        path = self._path(self._subfields)
+        json_type = "json_type(%s, %s)" % (content, path)
+        value = "json_extract(%s, %s)" % (content, path)
+        transformation = self._transformation
+        if transformation is None:
+            # index values are compared as text, as in document_fields
+            return (
+                "CASE WHEN %s IN ('text', 'integer', 'real', 'true', 'false')"
+                " THEN CAST(%s AS TEXT) END" % (json_type, value))
+        if isinstance(transformation, query_parser.Lower):
+            # lower() only folds ascii characters, other strings are expanded
+            return "CASE WHEN %s = 'text' AND %s THEN lower(%s) END" % (
+                json_type, self._is_ascii_sql(value), value)
+        if isinstance(transformation, query_parser.Number):
+            return "CASE WHEN %s = 'integer' THEN printf('%s', %s) END" % (
+                json_type, transformation.padding, value)
+        return "CASE %s WHEN 'true' THEN '1' WHEN 'false' THEN '0' END" % (
+            json_type,)
+
+    def sql_expanded(self, content='content'):
+        """Return an SQL condition matching the documents that are expanded.
+
+        :param content: The column holding the JSON content.
+        """
+        conditions = [
+            "json_type(%s, %s) = 'array'" % (
+                content, self._path(self._subfields[:i + 1]))
+            for i in range(len(self._subfields))]
+        if isinstance(self._transformation, query_parser.Lower):
+            path = self._path(self._subfields)
+            conditions.append("(json_type(%s, %s) = 'text' AND NOT %s)" % (
+                content, path,
+                self._is_ascii_sql("json_extract(%s, %s)" % (content, path))))
+        return ' OR '.join(conditions)
+
+    def is_expanded(self, raw_doc):
+        """Tell whether the values of a document can't be computed by sql().
+
+        This must agree with sql_expanded().
+        """
+        value = raw_doc
+        for subfield in self._subfields:
+            if not isinstance(value, dict):
+                return False
+            value = value.get(subfield)
+            if isinstance(value, list):
+                return True
+        return (isinstance(self._transformation, query_parser.Lower) and
+                isinstance(value, basestring) and not _is_ascii(value))
+
+
+class _ExpandedValuesGetter(query_parser.Getter):
+    """Get the values of a document that are expanded into document_fields.
+
+    These are the values that the SQL form of the index expression can't
+    compute.
+    """
+
+    def __init__(self, getter, expression):
+        self._getter = getter
+        self._expression = expression
+
+    def get(self, raw_doc):
+        if self._expression.is_expanded(raw_doc):
+            return self._getter.get(raw_doc)
+        return []
+
+
+def _expression_index_name(field):
+    if isinstance(field, unicode):
+        field = field.encode('utf-8')
+    return _EXPRESSION_INDEX_PREFIX + hashlib.sha1(field).hexdigest()
+
+
+class SQLiteExpressionIndexDatabase(SQLitePartialExpandDatabase):
+    """An SQLite Backend that indexes documents with expression indexes.
+
+    Index expressions that SQLite can compute (fields, and the lower, number
+    and bool of fields) are stored as sqlite indexes over json_extract() of
+    document.content, so writing a document doesn't write document_fields
+    rows for them and creating an index doesn't go through every document in
+    python. Other index expressions (split_words, combine, ...) and values
+    inside lists are still expanded into document_fields.
+
+    This needs SQLite with the JSON1 extension.
+    """
+
+    _index_storage_value = 'expression referenced'
+
+    # A dictionary of index expression: _SQLIndexExpression or None, see
+    # _get_sql_expression().
+    _sql_expressions = None
+
+    def _ensure_schema(self):
+        c = self._db_handle.cursor()
+        try:
+            c.execute("SELECT json_type('{}')")
+        except dbapi2.OperationalError as e:
+            raise dbapi2.OperationalError(
+                str(e) + '\nexpression indexes need the JSON1 extension')
+        SQLitePartialExpandDatabase._ensure_schema(self)
+
+    def _get_sql_expression(self, index_field):
+        """Return the SQL form of an index expression.
+
+        :return: A _SQLIndexExpression, or None if the index expression is
+            only stored in document_fields.
+        """
+        if self._sql_expressions is None:
+            self._sql_expressions = {}
+        if index_field not in self._sql_expressions:
+            getter = query_parser.Parser().parse(index_field)
+            self._sql_expressions[index_field] = \
+                _SQLIndexExpression.from_getter(getter)
+        return self._sql_expressions[index_field]
+
+    def _parse_index_definition(self, index_field):
+        """Parse a field definition for an index, returning a Getter.
+
+        The Getter only returns the values that are stored in
+        document_fields.
+        """
+        getter = SQLitePartialExpandDatabase._parse_index_definition(
+            self, index_field)
+        expression = self._get_sql_expression(index_field)
+        if expression is None:
+            return getter
+        return _ExpandedValuesGetter(getter, expression)
+
+    def create_index(self, index_name, *index_expressions):
+        self._run_in_transaction(
+            SQLitePartialExpandDatabase.create_index,
+            self, index_name, *index_expressions)
+
+    def _update_all_indexes(self, new_fields):
+        """Create the expression indexes and expand what they can't hold.
+
+        :param new_fields: The index definitions that need to be added.
+        """
+        c = self._db_handle.cursor()
+        expanded_fields = []
+        for field in new_fields:
+            expression = self._get_sql_expression(field)
+            if expression is None:
+                expanded_fields.append(field)
+                continue
+            c.execute("CREATE INDEX IF NOT EXISTS %s ON document(%s)" % (
+                _expression_index_name(field), expression.sql()))
+            getters = [(field, self._parse_index_definition(field))]
+            c.execute("SELECT doc_id, content FROM document WHERE %s" % (
+                expression.sql_expanded(),))
+            for doc_id, doc in c.fetchall():
+                self._update_indexes(doc_id, json.loads(doc), getters, c)
+        if expanded_fields:
+            SQLitePartialExpandDatabase._update_all_indexes(
+                self, expanded_fields)
+
+    def delete_index(self, index_name):
+        self._run_in_transaction(self._delete_index, index_name)
+
+    def _delete_index(self, index_name):
+        c = self._db_handle.cursor()
+        c.execute("SELECT field FROM index_definitions WHERE name = ?"
+                  " AND field NOT IN (SELECT field FROM index_definitions"
+                  " WHERE name != ?)", (index_name, index_name))
+        for (field,) in c.fetchall():
+            c.execute("DROP INDEX IF EXISTS %s" % (
+                _expression_index_name(field),))
+        SQLitePartialExpandDatabase.delete_index(self, index_name)
+
+    def _format_query(self, definition, key_values):
+        conditions, values = self._get_query_conditions(key_values)
+        return self._format_expression_query(definition, conditions, values)
+
+    def _format_range_query(self, definition, start_value, end_value):
+        conditions, values = self._get_range_conditions(
+            definition, start_value, end_value)
+        return self._format_expression_query(definition, conditions, values)
+
+    def _format_expression_query(self, definition, conditions, values):
+        """Return the statement and arguments of an index query.
+
+        :param definition: The fields of the index.
+        :param conditions: The condition on the value of each field, as
+            '%(value)s' templates.
+        :param values: The query arguments of the condition of each field.
+        """
+        args = []
+        for field, field_values in zip(definition, values):
+            if self._get_sql_expression(field) is not None:
+                args.extend(field_values)
+            args.append(field)
+            args.extend(field_values)
+        for field, field_values in zip(definition, values):
+            args.append(field)
+            args.extend(field_values)
+        definition = tuple(definition)
+        conditions = tuple(conditions)
+        statement = self._get_cached_statement(
+            ('expression query', definition, conditions),
+            self._build_expression_query_statement, definition, conditions)
+        return statement, args
+
+    def _build_expression_query_statement(self, definition, conditions):
+        # A document matches a field either by the value of the expression
+        # index or by its expanded values. SQLite looks up both indexes and
+        # merges the results.
+        where = []
+        order = []
+        for field, condition in zip(definition, conditions):
+            expanded_condition = condition % {'value': 'f.value'}
+            expanded_where = (
+                "d.doc_id IN (SELECT f.doc_id FROM document_fields f"
+                " WHERE f.field_name = ? AND %s)" % (expanded_condition,))
+            expanded_order = (
+                "(SELECT min(f.value) FROM document_fields f"
+                " WHERE f.doc_id = d.doc_id AND f.field_name = ? AND %s)"
+                % (expanded_condition,))
+            expression = self._get_sql_expression(field)
+            if expression is None:
+                where.append(expanded_where)
+                order.append(expanded_order)
+            else:
+                value = expression.sql('d.content')
+                where.append("(%s OR %s)" % (
+                    condition % {'value': value}, expanded_where))
+                order.append("coalesce(%s, %s)" % (value, expanded_order))
+        return (
+            "SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM "
+            "document d LEFT OUTER JOIN conflicts c ON c.doc_id = d.doc_id "
+            "WHERE %s GROUP BY d.doc_id, d.doc_rev, d.content ORDER BY %s;" % (
+                ' AND '.join(where), ', '.join(order)))
+
+    def _format_index_keys_query(self, definition):
+        definition = tuple(definition)
+        return self._get_cached_statement(
+            ('expression keys', definition),
+            self._build_expression_index_keys_statement, definition)
+
+    def _build_expression_index_keys_statement(self, definition):
+        tables = []
+        for i, field in enumerate(definition):
+            values = ("SELECT doc_id, value FROM document_fields"
+                      " WHERE field_name = ?")
+            expression = self._get_sql_expression(field)
+            if expression is not None:
+                # all index values are text, and sqlite only scans the
+                # expression index for a range
+                value = expression.sql()
+                values = (
+                    "SELECT doc_id, %s AS value FROM document"
+                    " WHERE %s >= '' UNION ALL %s" % (value, value, values))
+            tables.append("(%s) v%d" % (values, i))
+        value_fields = ', '.join(['v%d.value' % i for i in range(len(tables))])
+        where = ['v%d.value NOT NULL' % i for i in range(len(tables))]
+        where.extend(
+            'v%d.doc_id = v0.doc_id' % i for i in range(1, len(tables)))
+        return "SELECT %s FROM %s WHERE %s GROUP BY %s;" % (
+            value_fields, ', '.join(tables), ' AND '.join(where),
+            value_fields)
+
+
+SQLiteDatabase.register_implementation(SQLiteExpressionIndexDatabase)
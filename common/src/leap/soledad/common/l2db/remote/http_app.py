@@ -441,7 +441,10 @@ class HTTPResponder(object):
     """Encode responses from the server back to the client."""
 
     # a multi document response will put args and documents
-    # each on one line of the response body
+    # each on one line of the response body, or in one frame each if binary
+    # framing was negotiated
+
+    binary_framing = False
 
     def __init__(self, start_response):
         self._started = False
@@ -459,9 +462,12 @@ class HTTPResponder(object):
             return
         self._started = True
         status_text = httplib.responses[status]
+        content_type = self.content_type
+        if self.binary_framing and content_type != 'application/json':
+            content_type += '; ' + utils.BINARY_FRAMING
         self._write = self._start_response(
             '%d %s' % (status, status_text),
-            [('content-type', self.content_type),
+            [('content-type', content_type),
              ('cache-control', 'no-cache')] +
             headers.items())
         # xxx version in headers
@@ -469,6 +475,11 @@ class HTTPResponder(object):
             self._no_initial_obj = False
             self._write(json.dumps(obj_dic) + "\r\n")
 
+    def write_to(self, write):
+        """write the rest of the response with the given callable instead of
+        the one returned by start_response."""
+        self._write = write
+
     def finish_response(self):
         """finish sending response."""
         self.sent_response = True
@@ -482,7 +493,9 @@ class HTTPResponder(object):
         """send and finish response with content"""
         headers['content-length'] = str(len(content))
         self.start_response(status, headers=headers)
-        if self._stream_state == 1:
+        if self._stream_state != -1 and self.binary_framing:
+            self.content = [utils.frame(utils.FRAME_JSON, content)]
+        elif self._stream_state == 1:
             self.content = [',\r\n', content]
         else:
             self.content = [content]
@@ -492,11 +505,16 @@ class HTTPResponder(object):
         "start stream (array) as part of the response."
         assert self._started and self._no_initial_obj
         self._stream_state = 0
-        self._write("[")
+        if not self.binary_framing:
+            self._write("[")
 
     def stream_entry(self, entry):
         "send stream entry as part of the response."
         assert self._stream_state != -1
+        if self.binary_framing:
+            self._stream_state = 1
+            self._write(utils.frame_entry(entry))
+            return
         if self._stream_state == 0:
             self._stream_state = 1
             self._write('\r\n')
@@ -509,6 +527,9 @@ class HTTPResponder(object):
     def end_stream(self):
         "end stream (array)."
         assert self._stream_state != -1
+        if self.binary_framing:
+            self._write(utils.frame(utils.FRAME_END))
+            return
         self._write("\r\n]\r\n")
 
 
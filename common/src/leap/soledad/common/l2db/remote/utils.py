@@ -15,9 +15,125 @@
 # along with u1db.  If not, see <http://www.gnu.org/licenses/>.
 
 """Utilities for details of the procotol."""
+import base64
+import json
+import struct
 
 
 def check_and_strip_comma(line):
     if line and line[-1] == ',':
         return line[:-1], True
     return line, False
+
+
+# Binary framing of sync streams.
+#
+# Instead of lines of JSON, the entries of a sync stream may be sent as
+# frames, each one made of a type byte, the size of the payload as a 4 bytes
+# big-endian unsigned integer, and the payload. Symmetrically encrypted
+# document contents are sent as raw frames, which hold the ciphertext without
+# the base64 armor and JSON wrapping it is stored with. The stream ends with
+# an empty end frame.
+#
+# Binary framing is negotiated with a content type parameter, both in
+# requests and in the responses to them.
+
+BINARY_FRAMING = 'framing=binary'
+
+FRAME_HEADER = struct.Struct('>cI')
+FRAME_JSON = 'j'
+FRAME_RAW = 'r'
+FRAME_END = 'e'
+
+_RAW_PREFIX = '{"raw": "'
+_RAW_SUFFIX = '"}'
+_RAW_SEPARATOR = ' '
+# base64 encoding of the magic number and symmetric encryption scheme that
+# start the preamble of symmetrically encrypted contents
+_RAW_SIGNATURE = 'EzcB'
+
+
+class RawContent(str):
+    """
+    A symmetrically encrypted document content whose ciphertext is not base64
+    armored nor wrapped in JSON.
+    """
+
+
+def is_binary_framing(content_type):
+    """
+    Return whether a content type asks for binary framing.
+    """
+    params = (content_type or '').split(';')[1:]
+    return BINARY_FRAMING in [param.strip() for param in params]
+
+
+def strip_framing(content_type):
+    """
+    Return a content type without its framing parameter.
+    """
+    return (content_type or '').split(';')[0].strip()
+
+
+def frame(frame_type, payload=''):
+    """
+    Build a frame with the given type and payload.
+    """
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+
+def frame_entry(entry):
+    """
+    Build a frame for an entry of a sync stream.
+
+    Dicts are sent as JSON, and document contents are sent as raw frames if
+    they are symmetrically encrypted, or as JSON frames otherwise. Missing
+    contents are sent as empty JSON frames.
+    """
+    if type(entry) == dict:
+        return frame(FRAME_JSON, json.dumps(entry))
+    if isinstance(entry, RawContent):
+        return frame(FRAME_RAW, entry)
+    raw = unarmor_content(entry or '')
+    if raw is not None:
+        return frame(FRAME_RAW, raw)
+    return frame(FRAME_JSON, entry or '')
+
+
+def unarmor_content(content):
+    """
+    Remove the JSON wrapping and base64 armor of a symmetrically encrypted
+    document content.
+
+    :return: The raw content, or None if the content is not symmetrically
+             encrypted or could not be armored back exactly as it is.
+    :rtype: RawContent
+    """
+    if not (content.startswith(_RAW_PREFIX + _RAW_SIGNATURE) and
+            content.endswith(_RAW_SUFFIX)):
+        return None
+    armored = content[len(_RAW_PREFIX):-len(_RAW_SUFFIX)]
+    preamble, separator, ciphertext = armored.partition(_RAW_SEPARATOR)
+    if not separator:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(ciphertext)
+    except TypeError:
+        return None
+    # decoding ignores unexpected characters
+    if base64.urlsafe_b64encode(raw) != ciphertext:
+        return None
+    return RawContent(preamble + separator + raw)
+
+
+def armor_content(raw):
+    """
+    Wrap a raw symmetrically encrypted document content the way it is stored.
+
+    :raise ValueError: If the content has no preamble.
+    """
+    preamble, separator, ciphertext = raw.partition(_RAW_SEPARATOR)
+    if not separator or not preamble.startswith(_RAW_SIGNATURE):
+        raise ValueError('Not a raw symmetrically encrypted content')
+    return (_RAW_PREFIX + preamble + separator +
+            base64.urlsafe_b64encode(ciphertext) + _RAW_SUFFIX)
@@ -158,6 +158,90 @@ http_app.url_to_resource.register(SyncResource)
 # Modified HTTP method invocation (to account for splitted sync)
 # ----------------------------------------------------------------------------
 
+class _LineStream(object):
+    """
+    Read the entries of a sync stream sent as lines of JSON.
+    """
+
+    def __init__(self, reader):
+        self._getline = reader.getline
+        self._comma = False
+
+    def read_header(self):
+        # read one line and validate it
+        if self._getline().strip() != '[':
+            raise http_app.BadRequest()
+        line = self._getline()
+        line, self._comma = utils.check_and_strip_comma(line.strip())
+        return line
+
+    def read_docs(self):
+        while True:
+            entry = self._getline().strip()
+            if entry == ']':  # end of incoming document stream
+                break
+            if not entry or not self._comma:  # empty or no prec comma
+                raise http_app.BadRequest
+            entry, self._comma = utils.check_and_strip_comma(entry)
+            content = self._getline().strip()
+            content, self._comma = utils.check_and_strip_comma(content)
+            yield entry, content or None
+        if self._comma or self._getline():  # extra comma or data
+            raise http_app.BadRequest
+
+
+class _FrameStream(object):
+    """
+    Read the entries of a sync stream sent with binary framing.
+    """
+
+    def __init__(self, reader, max_entry_size):
+        self._reader = reader
+        self._max_entry_size = max_entry_size
+
+    def _read(self, size):
+        parts = []
+        while size > 0:
+            data = self._reader.read_chunk(size)
+            if not data:
+                raise http_app.BadRequest()
+            parts.append(data)
+            size -= len(data)
+        return ''.join(parts)
+
+    def _read_frame(self):
+        frame_type, size = utils.FRAME_HEADER.unpack(
+            self._read(utils.FRAME_HEADER.size))
+        if size > self._max_entry_size:
+            raise http_app.BadRequest()
+        return frame_type, self._read(size)
+
+    def read_header(self):
+        frame_type, header = self._read_frame()
+        if frame_type != utils.FRAME_JSON:
+            raise http_app.BadRequest()
+        return header
+
+    def read_docs(self):
+        while True:
+            frame_type, entry = self._read_frame()
+            if frame_type == utils.FRAME_END:
+                break
+            if frame_type != utils.FRAME_JSON or not entry:
+                raise http_app.BadRequest()
+            frame_type, content = self._read_frame()
+            if frame_type == utils.FRAME_RAW:
+                try:
+                    content = utils.armor_content(content)
+                except ValueError:
+                    raise http_app.BadRequest()
+            elif frame_type != utils.FRAME_JSON:
+                raise http_app.BadRequest()
+            yield entry, content or None
+        if self._reader.read_chunk(1):  # extra data
+            raise http_app.BadRequest()
+
+
 class HTTPInvocationByMethodWithBody(
         http_app.HTTPInvocationByMethodWithBody):
     """
@@ -176,7 +260,12 @@ class HTTPInvocationByMethodWithBody(
         reasons, as lack of possibility of gracefully interrupting the sync
         process, and possible timeouts for when dealing with large documents
         that have to be retrieved and encrypted/decrypted. Because of those,
-        we split the sync process into many POST requests.
+        we split the sync process into many POST requests. Clients that
+        already know the sync state may still exchange documents in both
+        directions with a single POST request.
+
+        Sync streams may be sent with binary framing instead of lines of JSON,
+        in which case the response is sent with binary framing as well.
         """
         args = urlparse.parse_qsl(self.environ['QUERY_STRING'],
                                   strict_parsing=False)
@@ -210,30 +299,25 @@ class HTTPInvocationByMethodWithBody(
                 body = reader.read_chunk(sys.maxint)
                 return meth(args, body)
             elif content_type.startswith('application/x-soledad-sync'):
-                # read one line and validate it
-                body_getline = reader.getline
-                if body_getline().strip() != '[':
-                    raise http_app.BadRequest()
-                line = body_getline()
-                line, comma = utils.check_and_strip_comma(line.strip())
+                if utils.is_binary_framing(content_type):
+                    stream = _FrameStream(reader, self.max_entry_size)
+                    self.resource.responder.binary_framing = True
+                else:
+                    stream = _LineStream(reader)
+                content_type = utils.strip_framing(content_type)
                 meth_args = self._lookup('%s_args' % method)
-                meth_args(args, line)
-                # handle incoming documents
-                if content_type == 'application/x-soledad-sync-put':
+                meth_args(args, stream.read_header())
+                # handle incoming documents, and return outgoing documents
+                # after them if both are exchanged in the same request
+                if content_type in ('application/x-soledad-sync-put',
+                                    'application/x-soledad-sync-exchange'):
                     meth_put = self._lookup('%s_put' % method)
-                    meth_end = self._lookup('%s_end' % method)
-                    while True:
-                        entry = body_getline().strip()
-                        if entry == ']':  # end of incoming document stream
-                            break
-                        if not entry or not comma:  # empty or no prec comma
-                            raise http_app.BadRequest
-                        entry, comma = utils.check_and_strip_comma(entry)
-                        content = body_getline().strip()
-                        content, comma = utils.check_and_strip_comma(content)
-                        meth_put({'content': content or None}, entry)
-                    if comma or body_getline():  # extra comma or data
-                        raise http_app.BadRequest
+                    if content_type == 'application/x-soledad-sync-put':
+                        meth_end = self._lookup('%s_end' % method)
+                    else:
+                        meth_end = self._lookup('%s_exchange' % method)
+                    for entry, content in stream.read_docs():
+                        meth_put({'content': content}, entry)
                     return meth_end()
                 # handle outgoing documents
                 elif content_type == 'application/x-soledad-sync-get':
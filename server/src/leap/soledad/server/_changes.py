@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+# _changes.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Cheap ways for clients to find out whether their database has changed.
+
+Clients poll the server for changes every few minutes, and most of the time
+nothing has changed. Instead of asking for the whole sync info, they may:
+
+    * make a conditional request for the sync info, with an If-None-Match
+      header containing the generation and transaction id of the user
+      database they know about. If it is still current, the server answers
+      with 304 Not Modified without reaching the sync resource.
+
+    * make a long-poll request to /changes/{uuid}?generation={generation},
+      which is answered as soon as the user database advances past the given
+      generation, or after LONG_POLL_TIMEOUT seconds.
+
+Both are answered from an in-memory cache of the generation of user databases,
+which is updated by sync requests. Other processes (e.g. the MX) write to
+couch directly, so cache entries expire after CACHE_EXPIRE seconds and the
+generation is then read from couch again.
+"""
+import json
+import threading
+import time
+
+from collections import defaultdict
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.logger import Logger
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from leap.soledad.common.l2db.errors import DatabaseDoesNotExist
+
+
+__all__ = ['generation_cache', 'generation_etag', 'ChangesResource',
+           'SyncInfoProbeResource']
+
+
+logger = Logger()
+
+
+# seconds a cached generation is trusted for
+CACHE_EXPIRE = 60
+
+# seconds a long-poll request waits for changes before being answered
+LONG_POLL_TIMEOUT = 300
+
+
+def generation_etag(generation, trans_id):
+    """
+    Return the entity tag of the sync info of a user database.
+
+    :param generation: The generation of the user database.
+    :type generation: int
+    :param trans_id: The transaction id of the user database.
+    :type trans_id: str
+
+    :return: The quoted entity tag.
+    :rtype: str
+    """
+    return '"%d-%s"' % (generation, trans_id)
+
+
+class GenerationCache(object):
+    """
+    An in-memory cache of the generation of user databases.
+
+    The cache may be updated from any thread, and the deferreds returned by
+    wait() are fired in the reactor thread.
+    """
+
+    def __init__(self, expire=CACHE_EXPIRE, clock=time.time):
+        """
+        :param expire: How many seconds a cached generation is trusted for.
+        :type expire: int
+        :param clock: A callable returning the current time.
+        :type clock: callable
+        """
+        self._expire = expire
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._generations = {}
+        # only accessed from the reactor thread
+        self._waiting = defaultdict(list)
+
+    def get(self, dbname):
+        """
+        Return the cached generation of a database.
+
+        :param dbname: The name of the database.
+        :type dbname: str
+
+        :return: The generation and transaction id of the database, or None
+                 if it is not cached or has expired.
+        :rtype: (int, str)
+        """
+        with self._lock:
+            cached = self._generations.get(dbname)
+            if cached is None:
+                return None
+            generation, trans_id, timestamp = cached
+            if self._clock() - timestamp > self._expire:
+                del self._generations[dbname]
+                return None
+        return generation, trans_id
+
+    def update(self, dbname, generation, trans_id):
+        """
+        Cache the generation of a database, and notify requests waiting for
+        it to advance.
+
+        :param dbname: The name of the database.
+        :type dbname: str
+        :param generation: The generation of the database.
+        :type generation: int
+        :param trans_id: The transaction id of the database.
+        :type trans_id: str
+        """
+        with self._lock:
+            cached = self._generations.get(dbname)
+            # requests finishing out of order may report older generations
+            if cached is not None and cached[0] > generation:
+                return
+            self._generations[dbname] = \
+                (generation, trans_id, self._clock())
+        if cached is None or cached[0] < generation:
+            reactor.callFromThread(self._notify, dbname, generation, trans_id)
+
+    def wait(self, dbname, generation):
+        """
+        Wait for the cached generation of a database to advance.
+
+        :param dbname: The name of the database.
+        :type dbname: str
+        :param generation: The generation to be advanced past.
+        :type generation: int
+
+        :return: A cancellable deferred that fires with the new generation and
+                 transaction id of the database.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        def cancel(d):
+            waiting = self._waiting[dbname]
+            waiting[:] = [w for w in waiting if w[1] is not d]
+            if not waiting:
+                del self._waiting[dbname]
+
+        d = defer.Deferred(cancel)
+        self._waiting[dbname].append((generation, d))
+        return d
+
+    def _notify(self, dbname, generation, trans_id):
+        waiting = self._waiting.pop(dbname, [])
+        ready = [d for gen, d in waiting if gen < generation]
+        waiting = [(gen, d) for gen, d in waiting if gen >= generation]
+        if waiting:
+            self._waiting[dbname] = waiting
+        for d in ready:
+            d.callback((generation, trans_id))
+
+
+generation_cache = GenerationCache()
+
+
+class _GenerationResource(Resource):
+
+    isLeaf = True
+
+    def __init__(self, pool, get_state, cache=generation_cache):
+        """
+        :param pool: The pool used to read generations from couch.
+        :type pool: twisted.python.threadpool.ThreadPool
+        :param get_state: A callable returning the couch server state.
+        :type get_state: callable
+        :param cache: The cache of generations of user databases.
+        :type cache: GenerationCache
+        """
+        Resource.__init__(self)
+        self._pool = pool
+        self._get_state = get_state
+        self._cache = cache
+
+    def _get_generation(self, dbname):
+        """
+        Return a deferred that fires with the generation and transaction id of
+        a user database, preferably read from the cache.
+        """
+        cached = self._cache.get(dbname)
+        if cached is not None:
+            return defer.succeed(cached)
+        return self._read_generation(dbname)
+
+    def _read_generation(self, dbname):
+        """
+        Return a deferred that fires with the generation and transaction id of
+        a user database, read from couch.
+        """
+        return threads.deferToThreadPool(
+            reactor, self._pool, self._read_generation_from_couch, dbname)
+
+    def _read_generation_from_couch(self, dbname):
+        db = self._get_state().open_database(dbname)
+        generation, trans_id = db._get_generation_info()
+        self._cache.update(dbname, generation, trans_id)
+        return generation, trans_id
+
+
+class SyncInfoProbeResource(_GenerationResource):
+    """
+    Answer conditional requests for the sync info of a user database with 304
+    Not Modified if its generation did not change, and pass them on to the
+    sync resource otherwise.
+    """
+
+    def __init__(self, sync_resource, pool, get_state,
+                 cache=generation_cache):
+        """
+        :param sync_resource: The resource that serves the sync info.
+        :type sync_resource: twisted.web.resource.Resource
+        """
+        _GenerationResource.__init__(self, pool, get_state, cache=cache)
+        self._sync_resource = sync_resource
+
+    def render_GET(self, request):
+        dbname = request.postpath[0]
+        d = self._get_generation(dbname)
+        d.addCallbacks(
+            self._compare, self._pass_on, callbackArgs=(request,),
+            errbackArgs=(request,))
+        return NOT_DONE_YET
+
+    def _compare(self, result, request):
+        etag = generation_etag(*result)
+        if request.getHeader('if-none-match') != etag:
+            return self._pass_on(None, request)
+        request.setResponseCode(304)
+        request.setHeader('etag', etag)
+        request.finish()
+
+    def _pass_on(self, failure, request):
+        if failure is not None and not failure.check(DatabaseDoesNotExist):
+            logger.failure("error reading generation", failure)
+        self._sync_resource.render(request)
+
+
+class ChangesResource(_GenerationResource):
+    """
+    Answer with the generation of a user database as soon as it advances past
+    the one given by the client.
+    """
+
+    def __init__(self, pool, get_state, cache=generation_cache,
+                 timeout=LONG_POLL_TIMEOUT, clock=reactor):
+        """
+        :param timeout: How many seconds to wait for changes.
+        :type timeout: int
+        :param clock: The clock used for timeouts.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        _GenerationResource.__init__(self, pool, get_state, cache=cache)
+        self._timeout = timeout
+        self._clock = clock
+
+    def render_GET(self, request):
+        uuid = request.postpath[0]
+        try:
+            generation = int(request.args.get('generation', ['0'])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return json.dumps({'error': 'bad request'})
+        finished = request.notifyFinish()
+        d = self._wait_for_changes('user-%s' % uuid, generation)
+        d.addCallbacks(
+            self._respond, self._fail, callbackArgs=(request,),
+            errbackArgs=(request,))
+        finished.addErrback(lambda _: d.cancel())
+        return NOT_DONE_YET
+
+    @defer.inlineCallbacks
+    def _wait_for_changes(self, dbname, generation):
+        result = yield self._get_generation(dbname)
+        if result[0] > generation:
+            defer.returnValue(result)
+        try:
+            result = yield self._cache.wait(dbname, generation).addTimeout(
+                self._timeout, self._clock)
+        except defer.TimeoutError:
+            # changes made by other processes don't go through the cache
+            result = yield self._read_generation(dbname)
+        defer.returnValue(result)
+
+    def _respond(self, result, request):
+        generation, trans_id = result
+        request.setHeader('content-type', 'application/json')
+        request.write(json.dumps(
+            {'generation': generation, 'transaction_id': trans_id}))
+        request.finish()
+
+    def _fail(self, failure, request):
+        if failure.check(defer.CancelledError):
+            return  # the client went away
+        if failure.check(DatabaseDoesNotExist):
+            request.setResponseCode(404)
+            request.write(json.dumps({'error': 'database does not exist'}))
+        else:
+            logger.failure("error waiting for changes", failure)
+            request.setResponseCode(500)
+        request.finish()
@@ -30,6 +30,17 @@ CONFIG_DEFAULTS = {
         'batching': True,
         'blobs': False,
         'blobs_path': '/srv/leap/soledad/blobs',
+        'gzip_level': 6,
+        'gzip_min_size': 1024,
+        # bytes per second, 0 means no limit
+        'sync_user_rate': 5 * 1024 * 1024,
+        'sync_global_rate': 0,
+        # either 'memory' or 'sqlite', which may be shared by many processes
+        'sync_state_store': 'memory',
+        'sync_state_max_size': 128 * 1024 * 1024,
+        'sync_state_path': '/srv/leap/soledad/sync-state.db',
+        # seconds between compactions of transaction logs, 0 means never
+        'compaction_interval': 0,
     },
     'database-security': {
         'members': ['soledad'],
@@ -71,6 +82,8 @@ def _load_config(file_path):
                 continue
             elif type(value) == bool:
                 conf[section][key] = config.getboolean(section, key)
+            elif type(value) == int:
+                conf[section][key] = config.getint(section, key)
             elif type(value) == list:
                 values = config.get(section, key).split(',')
                 values = [v.strip() for v in values]
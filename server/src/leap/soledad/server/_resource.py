@@ -19,8 +19,12 @@ A twisted resource that serves the Soledad Server.
 """
 from twisted.web.resource import Resource
 
+from ._changes import ChangesResource
+from ._changes import SyncInfoProbeResource
 from ._server_info import ServerInfo
+from ._wsgi import get_couch_state
 from ._wsgi import get_sync_resource
+from ._wsgi import produce_from_reactor
 
 
 __all__ = ['SoledadResource', 'SoledadAnonResource']
@@ -55,7 +59,7 @@ class SoledadResource(Resource):
     for the Soledad Server.
     """
 
-    def __init__(self, blobs_resource=None, sync_pool=None):
+    def __init__(self, blobs_resource=None, sync_pool=None, throttle=None):
         """
         Initialize the Soledad resource.
 
@@ -64,8 +68,12 @@ class SoledadResource(Resource):
 
         :param sync_pool: A pool to pass to the WSGI sync resource.
         :type sync_pool: twisted.python.threadpool.ThreadPool
+
+        :param throttle: A rate limiter for responses from user databases.
+        :type throttle: _throttle.Throttle
         """
         Resource.__init__(self)
+        self._throttle = throttle
 
         # requests to / return server information
         server_info = ServerInfo(bool(blobs_resource))
@@ -75,12 +83,30 @@ class SoledadResource(Resource):
         if blobs_resource:
             self.putChild('blobs', blobs_resource)
 
+        # requests to /changes wait for changes in the user database
+        self.putChild('changes', ChangesResource(sync_pool, get_couch_state))
+
         # other requests are routed to legacy sync resource
         self._sync_resource = get_sync_resource(sync_pool)
+        self._sync_info_probe = SyncInfoProbeResource(
+            self._sync_resource, sync_pool, get_couch_state)
 
     def getChild(self, path, request):
         """
         Route requests to legacy WSGI sync resource dynamically.
+
+        Conditional requests for the sync info are answered without reaching
+        the sync resource if the user database did not change, and responses
+        from user databases are rate limited. The bodies of rate limited
+        responses are produced from the reactor, so that worker threads are
+        not held while they are delivered.
         """
         request.postpath.insert(0, request.prepath.pop())
+        dbname = request.postpath[0]
+        if self._throttle is not None and dbname.startswith('user-'):
+            self._throttle.throttle(request, dbname)
+            produce_from_reactor(request)
+        if request.method == 'GET' and request.getHeader('if-none-match') \
+                and request.postpath[1:2] == ['sync-from']:
+            return self._sync_info_probe
         return self._sync_resource
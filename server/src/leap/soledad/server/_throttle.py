@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# _throttle.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Rate limiting of responses, per user and globally.
+
+Throttling responses with sleeps holds a worker thread for as long as the
+download takes. Instead, data written to a throttled request is queued and
+delivered to the transport by the reactor, as fast as the token buckets of the
+user and of the whole server allow.
+
+So that a whole download is not held in memory while it is delivered, the
+streaming producer of a request whose queue is full is paused until the queue
+has drained. The throttle stands for that producer before the transport, so
+that it stays paused while either of them asks for it.
+"""
+import weakref
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+
+__all__ = ['TokenBucket', 'Throttle']
+
+
+# the amount of data delivered to the transport at once
+CHUNK_SIZE = 64 * 1024
+
+# how many chunks may be queued for a request before its producer is paused
+HIGH_WATER_MARK = 16
+
+# how many chunks may be left in the queue when its producer is resumed
+LOW_WATER_MARK = HIGH_WATER_MARK // 2
+
+
+class TokenBucket(object):
+    """
+    A token bucket that fills at a given rate, up to a burst size.
+
+    Data is allowed to go out when the bucket holds a token for each of its
+    bytes. Data larger than the burst size only waits for a full bucket, and
+    leaves it in debt.
+    """
+
+    def __init__(self, rate, burst=None, clock=reactor):
+        """
+        :param rate: How many bytes per second are allowed.
+        :type rate: int
+        :param burst: How many bytes may go out at once, defaults to one
+                      second worth of bytes.
+        :type burst: int
+        :param clock: The clock used to fill the bucket.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._clock = clock
+        self._tokens = self.burst
+        self._updated = clock.seconds()
+
+    def _fill(self):
+        now = self._clock.seconds()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount):
+        """
+        Return how many seconds to wait until an amount of data is allowed to
+        go out.
+        """
+        self._fill()
+        return max(0, (min(amount, self.burst) - self._tokens) / self.rate)
+
+    def consume(self, amount):
+        """
+        Take tokens for an amount of data that went out.
+        """
+        self._fill()
+        self._tokens -= amount
+
+
+@implementer(IPushProducer)
+class _ThrottledRequest(object):
+    """
+    Queue the data written to a request and deliver it to the transport as
+    the token buckets allow.
+    """
+
+    def __init__(self, request, buckets, clock):
+        self._request = request
+        self._write = request.write
+        self._finish = request.finish
+        self._buckets = buckets
+        self._clock = clock
+        self._queue = deque()
+        self._call = None
+        self._finishing = False
+        self._producer = None
+        self._producer_paused = False
+        self._full = False
+        self._transport_paused = False
+        self._registerProducer = request.registerProducer
+        self._unregisterProducer = request.unregisterProducer
+        request.write = self.write
+        request.finish = self.finish
+        request.registerProducer = self.registerProducer
+        request.unregisterProducer = self.unregisterProducer
+        request.notifyFinish().addErrback(self._connection_lost)
+
+    def write(self, data):
+        if not self._queue and not data:
+            # empty writes are used to flush headers and cost nothing
+            self._write(data)
+            return
+        for i in xrange(0, len(data), CHUNK_SIZE):
+            self._queue.append(data[i:i + CHUNK_SIZE])
+        self._schedule()
+        if len(self._queue) > HIGH_WATER_MARK:
+            self._full = True
+            self._update_producer()
+
+    def registerProducer(self, producer, streaming):
+        if not streaming:
+            self._registerProducer(producer, streaming)
+            return
+        self._producer = producer
+        self._producer_paused = False
+        self._registerProducer(self, True)
+
+    def unregisterProducer(self):
+        self._producer = None
+        self._unregisterProducer()
+
+    def _update_producer(self):
+        paused = self._full or self._transport_paused
+        if self._producer is None or paused == self._producer_paused:
+            return
+        self._producer_paused = paused
+        if paused:
+            self._producer.pauseProducing()
+        else:
+            self._producer.resumeProducing()
+
+    def pauseProducing(self):
+        self._transport_paused = True
+        self._update_producer()
+
+    def resumeProducing(self):
+        self._transport_paused = False
+        self._update_producer()
+
+    def stopProducing(self):
+        if self._producer is not None:
+            self._producer.stopProducing()
+
+    def finish(self):
+        self._finishing = True
+        if not self._queue:
+            self._finish()
+
+    def _delay(self):
+        amount = len(self._queue[0])
+        return max(bucket.delay(amount) for bucket in self._buckets)
+
+    def _schedule(self):
+        if self._call is not None or not self._queue:
+            return
+        self._call = self._clock.callLater(self._delay(), self._deliver)
+
+    def _deliver(self):
+        self._call = None
+        while self._queue and not self._delay():
+            data = self._queue.popleft()
+            for bucket in self._buckets:
+                bucket.consume(len(data))
+            self._write(data)
+        if self._full and len(self._queue) <= LOW_WATER_MARK:
+            self._full = False
+            self._update_producer()
+        if self._queue:
+            self._schedule()
+        elif self._finishing:
+            self._finish()
+
+    def _connection_lost(self, _):
+        self._queue.clear()
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        # the producer is stopped with the connection
+        self._producer = None
+
+
+class Throttle(object):
+    """
+    Limit the rate at which responses are delivered, per user and globally.
+    """
+
+    def __init__(self, user_rate=None, global_rate=None, clock=reactor):
+        """
+        :param user_rate: How many bytes per second each user may download,
+                          or None for no limit.
+        :type user_rate: int
+        :param global_rate: How many bytes per second all users together may
+                            download, or None for no limit.
+        :type global_rate: int
+        :param clock: The clock used to deliver data.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self._user_rate = user_rate
+        self._clock = clock
+        self._global_bucket = None
+        if global_rate:
+            self._global_bucket = TokenBucket(global_rate, clock=clock)
+        # buckets of users are kept while their requests are throttled
+        self._user_buckets = weakref.WeakValueDictionary()
+
+    def _buckets(self, user):
+        buckets = []
+        if self._user_rate:
+            bucket = self._user_buckets.get(user)
+            if bucket is None:
+                bucket = TokenBucket(self._user_rate, clock=self._clock)
+                self._user_buckets[user] = bucket
+            buckets.append(bucket)
+        if self._global_bucket is not None:
+            buckets.append(self._global_bucket)
+        return buckets
+
+    def throttle(self, request, user):
+        """
+        Throttle the data written to a request.
+
+        :param request: The request to be throttled.
+        :type request: twisted.web.server.Request
+        :param user: The user the request belongs to.
+        :type user: str
+        """
+        buckets = self._buckets(user)
+        if buckets:
+            _ThrottledRequest(request, buckets, self._clock)
@@ -17,8 +17,15 @@
 """
 A WSGI application that serves Soledad synchronization.
 """
+import weakref
+
+from uuid import uuid4
+
 from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.threads import deferToThreadPool
 from twisted.web.wsgi import WSGIResource
+from zope.interface import implementer
 
 from leap.soledad.server import SoledadApp
 from leap.soledad.server.gzip_middleware import GzipMiddleware
@@ -29,7 +36,19 @@ from leap.soledad.common.log import getLogger
 from twisted.logger import Logger
 log = Logger()
 
-__all__ = ['init_couch_state', 'get_sync_resource']
+__all__ = ['init_couch_state', 'init_gzip', 'get_couch_state',
+           'get_sync_resource', 'produce_from_reactor']
+
+
+# requests whose response bodies are produced from the reactor, by the id set
+# in their headers, which is the only way to reach them from the WSGI environ
+_requests = weakref.WeakValueDictionary()
+
+REQUEST_ID_HEADER = 'x-soledad-request-id'
+REQUEST_ID_ENVIRON = 'HTTP_X_SOLEDAD_REQUEST_ID'
+
+# how much of a response body is read from the app at once
+BODY_CHUNK_SIZE = 64 * 1024
 
 
 def _get_couch_state(conf):
@@ -61,5 +80,159 @@ def init_couch_state(conf):
         reactor.stop()
 
 
+def init_gzip(conf):
+    wsgi_application.compresslevel = conf['gzip_level']
+    wsgi_application.min_size = conf['gzip_min_size']
+
+
+def get_couch_state():
+    return _app.state
+
+
+class _ProducedBodies(object):
+    """
+    Hand the rest of the body of a response over to the reactor, for requests
+    that asked for it with produce_from_reactor().
+
+    The app is only iterated in the worker thread until the headers are
+    decided, and the worker thread is released once it returns.
+    """
+
+    def __init__(self, app, pool):
+        self.app = app
+        self.pool = pool
+
+    def __call__(self, environ, start_response):
+        request = _requests.get(environ.get(REQUEST_ID_ENVIRON))
+        if request is None:
+            return self.app(environ, start_response)
+        started = []
+
+        def _start_response(*args):
+            started.append(True)
+            return start_response(*args)
+
+        app_iter = self.app(environ, _start_response)
+        if isinstance(app_iter, list):
+            return app_iter
+        head, body = [], iter(app_iter)
+        try:
+            # the headers have to be set before the app returns
+            while not started:
+                head.append(next(body))
+        except StopIteration:
+            _close(app_iter)
+            return head
+        reactor.callFromThread(
+            _BodyProducer, request, body, app_iter, self.pool)
+        return head
+
+
+def _close(app_iter):
+    if hasattr(app_iter, 'close'):
+        app_iter.close()
+
+
+@implementer(IPushProducer)
+class _BodyProducer(object):
+    """
+    Write the rest of a response body to a request from the reactor once the
+    WSGI response finishes, reading it from a worker thread a chunk at a time
+    and only while the request is not paused.
+    """
+
+    def __init__(self, request, body, app_iter, pool):
+        self._request = request
+        self._body = body
+        self._app_iter = app_iter
+        self._pool = pool
+        self._finish = request.finish
+        self._paused = False
+        self._reading = False
+        self._done = False
+        request.finish = self.start
+        request.notifyFinish().addErrback(lambda _: self.stopProducing())
+
+    def start(self):
+        if self._done:
+            return
+        self._request.registerProducer(self, True)
+        self._read()
+
+    def _read(self):
+        if self._paused or self._reading or self._done:
+            return
+        self._reading = True
+        d = deferToThreadPool(reactor, self._pool, self._next_chunk)
+        d.addCallbacks(self._write, self._failed)
+
+    def _next_chunk(self):
+        chunk, size = [], 0
+        for data in self._body:
+            chunk.append(data)
+            size += len(data)
+            if size >= BODY_CHUNK_SIZE:
+                return ''.join(chunk), False
+        return ''.join(chunk), True
+
+    def _write(self, result):
+        self._reading = False
+        if self._done:
+            # stopped while the chunk was read
+            _close(self._app_iter)
+            return
+        data, last = result
+        if data:
+            self._request.write(data)
+        if last:
+            self._stop()
+            self._finish()
+        else:
+            self._read()
+
+    def _failed(self, failure):
+        self._reading = False
+        log.failure('Error producing the response body', failure)
+        if not self._done:
+            self._stop()
+            self._request.loseConnection()
+        else:
+            _close(self._app_iter)
+
+    def _stop(self):
+        self._done = True
+        self._request.unregisterProducer()
+        _close(self._app_iter)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._read()
+
+    def stopProducing(self):
+        if self._done:
+            return
+        self._done = True
+        # a body being read by a worker thread is closed once it returns
+        if not self._reading:
+            _close(self._app_iter)
+
+
+def produce_from_reactor(request):
+    """
+    Have the body of the WSGI response to a request produced from the
+    reactor, so that a worker thread is not held while a slow request
+    consumes it.
+
+    :param request: The request whose response body is produced.
+    :type request: twisted.web.server.Request
+    """
+    request_id = uuid4().hex
+    request.requestHeaders.setRawHeaders(REQUEST_ID_HEADER, [request_id])
+    _requests[request_id] = request
+
+
 def get_sync_resource(pool):
-    return WSGIResource(reactor, pool, wsgi_application)
+    return WSGIResource(reactor, pool, _ProducedBodies(wsgi_application, pool))
@@ -41,6 +41,7 @@ from leap.soledad.common.couch import couch_server
 from ._resource import SoledadResource, SoledadAnonResource
 from ._blobs import BlobsResource
 from ._config import get_config
+from ._throttle import Throttle
 
 
 log = Logger()
@@ -57,9 +58,13 @@ class SoledadRealm(object):
         blobs_resource = BlobsResource(conf['blobs_path']) if blobs else None
         self.anon_resource = SoledadAnonResource(
             enable_blobs=blobs)
+        throttle = Throttle(
+            user_rate=conf.get('sync_user_rate'),
+            global_rate=conf.get('sync_global_rate'))
         self.auth_resource = SoledadResource(
             blobs_resource=blobs_resource,
-            sync_pool=sync_pool)
+            sync_pool=sync_pool,
+            throttle=throttle)
 
     def requestAvatar(self, avatarId, mind, *interfaces):
 
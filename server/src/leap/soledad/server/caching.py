@@ -15,18 +15,298 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
-Server side caching. Using beaker for now.
+Server side caching of sync session state.
+
+The state of sync sessions is kept in a store, which hands out dict-like
+namespaces that expire some time after they were last used. Two stores are
+available:
+
+    * a memory store, bounded in total size, which evicts the least recently
+      used namespaces when full. It is only visible to the server process
+      that holds it.
+
+    * a SQLite store, kept on disk and shared by all server processes that
+      use the same file, so that sync sessions may continue on any of them.
 """
-from beaker.cache import CacheManager
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+from zope.interface import Interface, implementer
+
+
+__all__ = ['ISyncStateStore', 'MemorySyncStateStore', 'SQLiteSyncStateStore',
+           'init_store', 'get_store', 'get_cache_for']
+
+
+# seconds a namespace is kept after it was last used
+DEFAULT_EXPIRE = 3600
+
+# bytes the memory store may use
+DEFAULT_MAX_SIZE = 128 * 1024 * 1024
+
+
+class ISyncStateStore(Interface):
+
+    """
+    An interface for a store of sync session state.
+    """
+
+    def namespace(name, expire=DEFAULT_EXPIRE):
+        """
+        Return a namespace of the store, creating it if needed.
+
+        Namespaces behave like dicts with string keys. Values must be made of
+        strings, numbers, lists, tuples and dicts, and may be returned as
+        lists instead of tuples.
+
+        :param name: The name of the namespace.
+        :type name: str
+        :param expire: How many seconds the namespace is kept after it was
+                       last used.
+        :type expire: int
+        """
+
+    def memory_usage():
+        """
+        Return an estimate of how many bytes of memory the store uses.
+        """
+
+
+def _sizeof(value):
+    """
+    Estimate the memory used by a value, including the values it contains.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, int)):
+        return size
+    if isinstance(value, (list, tuple)):
+        size += sum(_sizeof(v) for v in value)
+    elif isinstance(value, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in value.iteritems())
+    return size
+
+
+class _MemoryNamespace(object):
+    """
+    A namespace of the memory store.
+
+    Namespaces are marked as used when they are returned by the store, and
+    not on every access, which would be too costly for large uploads.
+    """
+
+    def __init__(self, store, name, expire):
+        self._store = store
+        self._name = name
+        self._data = {}
+        self.expire = expire
+        self.expires_at = None
+        self.size = _sizeof(name)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __setitem__(self, key, value):
+        old = self._data.get(key)
+        delta = _sizeof(value)
+        if old is not None:
+            delta -= _sizeof(old)
+        else:
+            delta += _sizeof(key)
+        self._data[key] = value
+        self._store._resize(self, delta)
+
+    def as_dict(self):
+        """
+        Return the contents of the namespace. The dict must not be modified.
+        """
+        return self._data
+
+
+@implementer(ISyncStateStore)
+class MemorySyncStateStore(object):
+    """
+    A store of sync session state in memory, bounded in total size.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, clock=time.time):
+        """
+        :param max_size: How many bytes the store may use.
+        :type max_size: int
+        :param clock: A callable returning the current time.
+        :type clock: callable
+        """
+        self._max_size = max_size
+        self._clock = clock
+        self._lock = threading.Lock()
+        # namespaces, from the least to the most recently used
+        self._namespaces = OrderedDict()
+        self._size = 0
+
+    def namespace(self, name, expire=DEFAULT_EXPIRE):
+        with self._lock:
+            self._expire()
+            namespace = self._namespaces.pop(name, None)
+            if namespace is None:
+                namespace = _MemoryNamespace(self, name, expire)
+                self._size += namespace.size
+            # mark the namespace as the most recently used
+            namespace.expires_at = self._clock() + namespace.expire
+            self._namespaces[name] = namespace
+            return namespace
+
+    def memory_usage(self):
+        return self._size
+
+    def _resize(self, namespace, delta):
+        with self._lock:
+            namespace.size += delta
+            if self._namespaces.get(namespace._name) is not namespace:
+                return  # evicted while in use
+            self._size += delta
+            # evict the least recently used namespaces, but not this one
+            while self._size > self._max_size and len(self._namespaces) > 1:
+                _, evicted = self._namespaces.popitem(last=False)
+                self._size -= evicted.size
+
+    def _expire(self):
+        now = self._clock()
+        while self._namespaces:
+            name = next(iter(self._namespaces))
+            namespace = self._namespaces[name]
+            if namespace.expires_at > now:
+                break
+            del self._namespaces[name]
+            self._size -= namespace.size
+
+
+class _SQLiteNamespace(object):
+
+    def __init__(self, store, name, expire):
+        self._store = store
+        self._name = name
+        self._expire = expire
+
+    def get(self, key, default=None):
+        row = self._store._execute(
+            'SELECT value FROM state '
+            'WHERE namespace = ? AND key = ? AND expires_at > ?',
+            (self._name, key, self._store._clock())).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._store._execute(
+            'INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)',
+            (self._name, key, json.dumps(value, default=_tolist),
+             self._store._clock() + self._expire))
+
+    def as_dict(self):
+        """
+        Return the contents of the namespace.
+        """
+        rows = self._store._execute(
+            'SELECT key, value FROM state '
+            'WHERE namespace = ? AND expires_at > ?',
+            (self._name, self._store._clock()))
+        return dict((key, json.loads(value)) for key, value in rows)
+
+
+def _tolist(value):
+    # arrays are stored as lists
+    return value.tolist()
+
+
+@implementer(ISyncStateStore)
+class SQLiteSyncStateStore(object):
+    """
+    A store of sync session state in a SQLite database, which may be shared
+    by many server processes.
+    """
+
+    # seconds between removals of expired state
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path, clock=time.time):
+        """
+        :param path: The path of the SQLite database.
+        :type path: str
+        :param clock: A callable returning the current time.
+        :type clock: callable
+        """
+        self._path = path
+        self._clock = clock
+        self._local = threading.local()
+        self._purged_at = 0
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            'namespace TEXT, key TEXT, value TEXT, expires_at REAL, '
+            'PRIMARY KEY (namespace, key))')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # each write is committed on its own
+            conn = sqlite3.connect(
+                self._path, timeout=30, isolation_level=None)
+            # let readers in other processes go on while state is written
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, query, args=()):
+        return self._connection().execute(query, args)
+
+    def namespace(self, name, expire=DEFAULT_EXPIRE):
+        now = self._clock()
+        if now - self._purged_at > self.PURGE_INTERVAL:
+            self._purged_at = now
+            self._execute('DELETE FROM state WHERE expires_at <= ?', (now,))
+        return _SQLiteNamespace(self, name, expire)
+
+    def memory_usage(self):
+        # state is kept on disk
+        return 0
+
+
+_store = MemorySyncStateStore()
 
 
-def setup_caching():
-    _cache_manager = CacheManager(type='memory')
-    return _cache_manager
+def init_store(conf):
+    """
+    Set up the store of sync session state from the server configuration.
+    """
+    global _store
+    if conf['sync_state_store'] == 'sqlite':
+        _store = SQLiteSyncStateStore(conf['sync_state_path'])
+    else:
+        _store = MemorySyncStateStore(max_size=conf['sync_state_max_size'])
 
 
-_cache_manager = setup_caching()
+def get_store():
+    return _store
 
 
-def get_cache_for(key, expire=3600):
-    return _cache_manager.get_cache(key, expire=expire)
+def get_cache_for(key, expire=DEFAULT_EXPIRE):
+    return _store.namespace(key, expire=expire)
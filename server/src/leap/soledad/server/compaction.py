@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# compaction.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Compaction of the transaction logs of user databases.
+
+Every change to a user database adds a gen document to its transaction log,
+so databases grow without bound. Compaction removes the gen documents of
+changes that were superseded by a later change to the same document and that
+all replicas of the database already know about (see
+CouchDatabase.compact_transaction_log).
+
+Compaction may be run from the command line:
+
+    python -m leap.soledad.server.compaction --help
+
+or periodically by the server, every compaction_interval seconds as set in
+its configuration.
+
+Replicas record the generation they know about every time they sync, so
+databases are only compacted as far as the least up to date replica allows.
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet import threads
+from twisted.logger import Logger
+
+from leap.soledad.common.couch import CouchDatabase
+from leap.soledad.common.couch import list_users_dbs
+
+from ._config import get_config
+
+
+__all__ = ['iter_compaction', 'schedule_compaction', 'main']
+
+
+log = Logger()
+
+
+def iter_compaction(couch_url, dry_run=False, compact_databases=False):
+    """
+    Compact the transaction logs of all user databases.
+
+    :param couch_url: The URL of the couch server, with credentials.
+    :type couch_url: str
+    :param dry_run: If True, only count what would be removed.
+    :type dry_run: bool
+    :param compact_databases: Whether to ask couch to compact databases
+                              whose transaction logs were compacted, which
+                              reclaims the disk space of removed documents.
+    :type compact_databases: bool
+
+    :return: An iterator over the name of each database, how many gen docs
+             were removed from it and their size in bytes, or None in case
+             of errors.
+    :rtype: iterator
+    """
+    for dbname in list_users_dbs(couch_url):
+        try:
+            db = CouchDatabase(couch_url, dbname)
+            removed, size = db.compact_transaction_log(dry_run=dry_run)
+            if removed and compact_databases and not dry_run:
+                db.compact_database()
+        except Exception:
+            log.failure('Error compacting {dbname}', dbname=dbname)
+            yield dbname, None, None
+            continue
+        yield dbname, removed, size
+
+
+def _compact(couch_url):
+    removed, size = 0, 0
+    for dbname, db_removed, db_size in iter_compaction(couch_url):
+        if db_removed:
+            removed += db_removed
+            size += db_size
+    log.info('Removed {removed} gen docs ({size} bytes) from transaction '
+             'logs', removed=removed, size=size)
+
+
+def schedule_compaction(conf, clock=reactor):
+    """
+    Compact the transaction logs of all user databases periodically, in a
+    thread, if a compaction interval is configured.
+
+    :param conf: The server configuration.
+    :type conf: dict
+    :param clock: The clock used to schedule compaction.
+    :type clock: twisted.internet.interfaces.IReactorTime
+
+    :return: The looping call that runs compaction, or None.
+    :rtype: twisted.internet.task.LoopingCall
+    """
+    interval = conf['compaction_interval']
+    if not interval:
+        return None
+
+    def run():
+        d = threads.deferToThread(_compact, conf['couch_url'])
+        d.addErrback(lambda f: log.failure('Error compacting', f))
+        return d
+
+    call = task.LoopingCall(run)
+    call.clock = clock
+    call.start(interval, now=False)
+    return call
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Compact the transaction logs of Soledad user '
+                    'databases.')
+    parser.add_argument(
+        '--couch-url', default=None,
+        help='the url of the couch server, defaults to the one in the '
+             'server configuration')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='only report what would be removed')
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='ask couch to compact databases afterwards, which reclaims the '
+             'disk space of removed documents')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, out=sys.stdout):
+    args = _parse_args(argv)
+    couch_url = args.couch_url or get_config()['couch_url']
+    removed, size, errors = 0, 0, 0
+    for dbname, db_removed, db_size in iter_compaction(
+            couch_url, dry_run=args.dry_run, compact_databases=args.compact):
+        if db_removed is None:
+            errors += 1
+            print('%s: error, see the log' % dbname, file=out)
+            continue
+        removed += db_removed
+        size += db_size
+        if db_removed:
+            print('%s: %d gen docs, %d bytes' % (dbname, db_removed, db_size),
+                  file=out)
+    action = 'would be removed' if args.dry_run else 'removed'
+    print('total: %d gen docs, %d bytes %s' % (removed, size, action),
+          file=out)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,13 +25,18 @@ from twisted.internet import reactor
 from twisted.python import threadpool
 
 from .auth import portalFactory
+from .caching import init_store
+from .compaction import schedule_compaction
 from .session import SoledadSession
 from ._config import get_config
 from ._wsgi import init_couch_state
+from ._wsgi import init_gzip
 
 
 # load configuration from file
 conf = get_config()
+init_gzip(conf)
+init_store(conf)
 
 
 class SoledadEntrypoint(SoledadSession):
@@ -48,3 +53,4 @@ class SoledadEntrypoint(SoledadSession):
 # initialized when the reactor is running
 
 reactor.callWhenRunning(init_couch_state, conf)
+reactor.callWhenRunning(schedule_compaction, conf)
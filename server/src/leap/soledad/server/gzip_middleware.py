@@ -16,52 +16,171 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 Gzip middleware for WSGI apps.
+
+Responses are compressed as they are produced, so streamed responses (e.g.
+sync downloads) are never held in memory as a whole. Compressed data is
+flushed to the client every time enough data has been compressed, and the
+response is sent with chunked transfer encoding as its final size is not
+known in advance.
 """
-from six import StringIO
-from gzip import GzipFile
+import six
+import zlib
+
+from leap.soledad.common.l2db.remote import utils
+
+
+# default gzip compression level, which is much cheaper than the maximum
+# and compresses almost as well
+COMPRESS_LEVEL = 6
+
+# responses smaller than this are not worth compressing
+MIN_SIZE = 1024
+
+# how much data to compress before flushing it to the client
+FLUSH_SIZE = 64 * 1024
+
+# symmetrically encrypted data won't shrink, so responses with these content
+# types are not compressed
+INCOMPRESSIBLE_CONTENT_TYPES = ['application/octet-stream']
+
+
+def _compressible(headers):
+    """
+    Return whether a response with the given headers may be compressed.
+    """
+    headers = dict((name.lower(), value) for name, value in headers)
+    if 'content-encoding' in headers:
+        return False
+    content_type = headers.get('content-type', '')
+    if utils.is_binary_framing(content_type):
+        # raw ciphertext, see leap.soledad.common.l2db.remote.utils
+        return False
+    return utils.strip_framing(content_type) not in \
+        INCOMPRESSIBLE_CONTENT_TYPES
+
+
+class _GzipResponse(object):
+    """
+    Compress a single response as it is written by the app or returned from
+    its iterable.
+
+    The decision of compressing is delayed until at least min_size bytes were
+    produced, unless the content length is known in advance.
+    """
+
+    def __init__(self, start_response, compresslevel, min_size, flush_size):
+        self._start_response = start_response
+        self._compresslevel = compresslevel
+        self._min_size = min_size
+        self._flush_size = flush_size
+        self._status = None
+        self._headers = None
+        self._exc_info = None
+        self._write = None
+        self._compressor = None
+        self._buffer = []
+        self._buffered = 0
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None and self._write is not None:
+            # headers were sent already, let the server deal with the error
+            six.reraise(*exc_info)
+        self._status, self._headers, self._exc_info = \
+            status, headers, exc_info
+        self._buffer, self._buffered = [], 0
+        if not _compressible(headers):
+            self._start(compress=False)
+        else:
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    self._start(compress=int(value) >= self._min_size)
+        return self.write
+
+    def _start(self, compress):
+        headers = self._headers
+        if compress:
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
+            headers += [('Content-Encoding', 'gzip'),
+                        ('Vary', 'Accept-Encoding')]
+            # wbits + 16 produces a gzip header and trailer
+            self._compressor = zlib.compressobj(
+                self._compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._write = self._start_response(
+            self._status, headers, self._exc_info)
+
+    def _process(self, data, last=False):
+        """
+        Return the data to be sent to the client for a chunk of the response.
+        """
+        if self._write is None:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            if self._buffered < self._min_size and not last:
+                return ''
+            self._start(compress=self._buffered >= self._min_size)
+            data = ''.join(self._buffer)
+            self._buffer, self._buffered = [], 0
+        if self._compressor is None:
+            return data
+        out = self._compressor.compress(data)
+        self._buffered += len(data)
+        if last:
+            out += self._compressor.flush()
+        elif self._buffered >= self._flush_size:
+            out += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._buffered = 0
+        return out
+
+    def write(self, data):
+        out = self._process(data)
+        if out:
+            self._write(out)
+
+    def iterate(self, app_iter):
+        """
+        Compress the iterable returned by the app.
+        """
+        try:
+            for data in app_iter:
+                out = self._process(data)
+                if out:
+                    yield out
+            out = self._process('', last=True)
+            if out:
+                yield out
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
 
 
 class GzipMiddleware(object):
     """
     GzipMiddleware class for WSGI.
     """
-    def __init__(self, app, compresslevel=9):
+
+    def __init__(self, app, compresslevel=COMPRESS_LEVEL, min_size=MIN_SIZE,
+                 flush_size=FLUSH_SIZE):
+        """
+        :param app: The WSGI app whose responses will be compressed.
+        :type app: callable
+        :param compresslevel: The gzip compression level, from 1 to 9.
+        :type compresslevel: int
+        :param min_size: Responses smaller than this are not compressed.
+        :type min_size: int
+        :param flush_size: How much data to compress before flushing it.
+        :type flush_size: int
+        """
         self.app = app
         self.compresslevel = compresslevel
+        self.min_size = min_size
+        self.flush_size = flush_size
 
     def __call__(self, environ, start_response):
         if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', ''):
             return self.app(environ, start_response)
-
-        buffer = StringIO.StringIO()
-        output = GzipFile(
-            mode='wb',
-            compresslevel=self.compresslevel,
-            fileobj=buffer
-        )
-
-        start_response_args = []
-
-        def dummy_start_response(status, headers, exc_info=None):
-            start_response_args.append(status)
-            start_response_args.append(headers)
-            start_response_args.append(exc_info)
-            return output.write
-
-        app_iter = self.app(environ, dummy_start_response)
-        for line in app_iter:
-            output.write(line)
-        if hasattr(app_iter, 'close'):
-            app_iter.close()
-        output.close()
-        buffer.seek(0)
-        result = buffer.getvalue()
-        headers = []
-        for name, value in start_response_args[1]:
-            if name.lower() != 'content-length':
-                headers.append((name, value))
-        headers.append(('Content-Length', str(len(result))))
-        headers.append(('Content-Encoding', 'gzip'))
-        start_response(start_response_args[0], headers, start_response_args[2])
-        buffer.close()
-        return [result]
+        response = _GzipResponse(
+            start_response, self.compresslevel, self.min_size,
+            self.flush_size)
+        app_iter = self.app(environ, response.start_response)
+        return response.iterate(app_iter)
@@ -17,6 +17,8 @@
 """
 Server side synchronization infrastructure.
 """
+from array import array
+
 from leap.soledad.server import caching
 
 
@@ -25,7 +27,10 @@ class ServerSyncState(object):
     The state of one sync session, as stored on backend server.
 
     On server side, the ongoing syncs metadata is maintained in
-    a caching layer.
+    a caching layer. Documents seen during the sync are kept in their own
+    namespace with the highest generation they were inserted at, and the
+    changes to return are kept as parallel arrays, so that recording and
+    looking up any of them takes constant time.
     """
 
     def __init__(self, source_replica_uid, sync_id):
@@ -41,21 +46,8 @@ class ServerSyncState(object):
         self._sync_id = sync_id
         caching_key = source_replica_uid + sync_id
         self._storage = caching.get_cache_for(caching_key)
-
-    def _put_dict_info(self, key, value):
-        """
-        Put some information about the sync state.
-
-        :param key: The key for the info to be put.
-        :type key: str
-        :param value: The value for the info to be put.
-        :type value: str
-        """
-        if key not in self._storage:
-            self._storage[key] = []
-        info_list = self._storage.get(key)
-        info_list.append(value)
-        self._storage[key] = info_list
+        self._seen_ids = caching.get_cache_for(caching_key + '-seen-ids')
+        self._changes = None
 
     def put_seen_id(self, seen_id, gen):
         """
@@ -66,22 +58,19 @@ class ServerSyncState(object):
         :param gen: The corresponding db generation.
         :type gen: int
         """
-        self._put_dict_info(
-            'seen_id',
-            (seen_id, gen))
+        if self._seen_ids.get(seen_id, -1) < gen:
+            self._seen_ids[seen_id] = gen
 
     def seen_ids(self):
         """
         Return all document ids seen during the sync.
 
-        :return: A dict with doc ids seen during the sync.
+        :return: A dict with doc ids seen during the sync, mapped to the
+                 highest generation they were inserted at. It must not be
+                 modified.
         :rtype: dict
         """
-        if 'seen_id' in self._storage:
-            seen_ids = self._storage.get('seen_id')
-        else:
-            seen_ids = []
-        return dict(seen_ids)
+        return self._seen_ids.as_dict()
 
     def put_changes_to_return(self, gen, trans_id, changes_to_return):
         """
@@ -96,14 +85,19 @@ class ServerSyncState(object):
                                   returned during the sync process.
         :type changes_to_return: list
         """
-        self._put_dict_info(
-            'changes_to_return',
-            {
-                'gen': gen,
-                'trans_id': trans_id,
-                'changes_to_return': changes_to_return,
-            }
-        )
+        self._changes = {
+            'gen': gen,
+            'trans_id': trans_id,
+            'doc_ids': [doc_id for doc_id, _, _ in changes_to_return],
+            'gens': array('l', (g for _, g, _ in changes_to_return)),
+            'trans_ids': [t for _, _, t in changes_to_return],
+        }
+        self._storage['changes_to_return'] = self._changes
+
+    def _get_changes(self):
+        if self._changes is None:
+            self._changes = self._storage.get('changes_to_return')
+        return self._changes
 
     def sync_info(self):
         """
@@ -115,13 +109,28 @@ class ServerSyncState(object):
                  server.
         :rtype: tuple
         """
-        gen = trans_id = number_of_changes = None
-        if 'changes_to_return' in self._storage:
-            info = self._storage.get('changes_to_return')[0]
-            gen = info['gen']
-            trans_id = info['trans_id']
-            number_of_changes = len(info['changes_to_return'])
-        return gen, trans_id, number_of_changes
+        changes = self._get_changes()
+        if changes is None:
+            return None, None, None
+        return changes['gen'], changes['trans_id'], len(changes['doc_ids'])
+
+    def changes_to_return(self, start=0):
+        """
+        Return the calculated changes to return.
+
+        :param start: The index of the first change to return, i.e. how many
+                      changes the source replica has already received.
+        :type start: int
+
+        :return: A list of tuples with the changes to be returned during the
+                 sync process, or None if those have not been calculated yet.
+        :rtype: list
+        """
+        changes = self._get_changes()
+        if changes is None:
+            return None
+        return list(zip(changes['doc_ids'][start:], changes['gens'][start:],
+                        changes['trans_ids'][start:]))
 
     def next_change_to_return(self, received):
         """
@@ -131,11 +140,12 @@ class ServerSyncState(object):
                          received during the current sync process.
         :type received: int
         """
-        gen = trans_id = next_change_to_return = None
-        if 'changes_to_return' in self._storage:
-            info = self._storage.get('changes_to_return')[0]
-            gen = info['gen']
-            trans_id = info['trans_id']
-            if received < len(info['changes_to_return']):
-                next_change_to_return = (info['changes_to_return'][received])
-        return gen, trans_id, next_change_to_return
+        changes = self._get_changes()
+        if changes is None:
+            return None, None, None
+        next_change_to_return = None
+        if received < len(changes['doc_ids']):
+            next_change_to_return = (
+                changes['doc_ids'][received], changes['gens'][received],
+                changes['trans_ids'][received])
+        return changes['gen'], changes['trans_id'], next_change_to_return
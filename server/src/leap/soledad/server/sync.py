@@ -17,12 +17,14 @@
 """
 Server side synchronization infrastructure.
 """
-import time
 from six.moves import zip as izip
 
 from leap.soledad.common.l2db import sync
+from leap.soledad.common.errors import SyncStateMismatchError
 from leap.soledad.common.l2db.remote import http_app
 from leap.soledad.server.caching import get_cache_for
+from leap.soledad.server._changes import generation_cache
+from leap.soledad.server._changes import generation_etag
 from leap.soledad.server.state import ServerSyncState
 from leap.soledad.common.document import ServerDocument
 
@@ -56,14 +58,18 @@ class SyncExchange(sync.SyncExchange):
         # recover sync state
         self._sync_state = ServerSyncState(self.source_replica_uid, sync_id)
 
-    def find_changes_to_return(self):
+    def find_changes_to_return(self, received=0):
         """
         Find changes to return.
 
         Find changes since last_known_generation in db generation
-        order using whats_changed. It excludes documents ids that have
+        order using iter_whats_changed. It excludes documents ids that have
         already been considered (superseded by the sender, etc).
 
+        :param received: How many documents the source replica has already
+                         received in an interrupted run of this sync session.
+        :type received: int
+
         :return: the generation of this database, which the caller can
                  consider themselves to be synchronized after processing
                  allreturned documents, and the amount of documents to be sent
@@ -72,9 +78,11 @@ class SyncExchange(sync.SyncExchange):
         """
         # check if changes to return have already been calculated
         new_gen, new_trans_id, number_of_changes = self._sync_state.sync_info()
-        if number_of_changes is None:
+        if number_of_changes is not None:
+            self.changes_to_return = self._sync_state.changes_to_return()
+        else:
             self._trace('before whats_changed')
-            new_gen, new_trans_id, changes = self._db.whats_changed(
+            new_gen, new_trans_id, changes = self._db.iter_whats_changed(
                 self.source_last_known_generation)
             self._trace('after whats_changed')
             seen_ids = self._sync_state.seen_ids()
@@ -85,10 +93,18 @@ class SyncExchange(sync.SyncExchange):
                 if doc_id not in seen_ids or seen_ids.get(doc_id) < gen]
             self._sync_state.put_changes_to_return(
                 new_gen, new_trans_id, self.changes_to_return)
-            number_of_changes = len(self.changes_to_return)
+        # skip the changes the source received before the session was
+        # interrupted. Their generations are not newer than the last one the
+        # source knows about, which guards against a stale offset.
+        skip = 0
+        for _, gen, _ in self.changes_to_return[:received]:
+            if gen > self.source_last_known_generation:
+                break
+            skip += 1
+        self.changes_to_return = self.changes_to_return[skip:]
         self.new_gen = new_gen
         self.new_trans_id = new_trans_id
-        return self.new_gen, number_of_changes
+        return self.new_gen, len(self.changes_to_return)
 
     def return_docs(self, return_doc_cb):
         """Return the changed documents and their last change generation
@@ -101,6 +117,15 @@ class SyncExchange(sync.SyncExchange):
                 to the target replica.
         :return: None
         """
+        for doc, gen, trans_id in self.iter_docs():
+            return_doc_cb(doc, gen, trans_id)
+
+    def iter_docs(self):
+        """Iterate over the changed documents and their last change generation
+        and transaction id, fetching the documents as they are consumed.
+
+        :return: An iterator of (doc, gen, trans_id) tuples.
+        """
         changes_to_return = self.changes_to_return
         # return docs, including conflicts.
         # content as a file-object (will be read when writing)
@@ -109,16 +134,15 @@ class SyncExchange(sync.SyncExchange):
             changed_doc_ids, check_for_conflicts=False,
             include_deleted=True, read_content=False)
 
-        docs_by_gen = izip(
+        return izip(
             docs, (gen for _, gen, _ in changes_to_return),
             (trans_id for _, _, trans_id in changes_to_return))
-        for doc, gen, trans_id in docs_by_gen:
-            return_doc_cb(doc, gen, trans_id)
 
     def batched_insert_from_source(self, entries, sync_id):
         if not entries:
             return
-        self._db.batch_start()
+        # current versions of all documents in the batch are fetched at once
+        self._db.batch_start([entry[0].doc_id for entry in entries])
         for entry in entries:
             doc, gen, trans_id, number_of_docs, doc_idx = entry
             self.insert_doc_from_source(doc, gen, trans_id, number_of_docs,
@@ -177,11 +201,39 @@ class SyncResource(http_app.SyncResource):
 
     sync_exchange_class = SyncExchange
 
+    @http_app.http_method()
+    def get(self):
+        """
+        Return the sync info of the server replica and what it knows about the
+        source replica, and let the client know that it can use the single
+        request sync exchange and binary framing.
+
+        The response is tagged with the generation of the server replica, so
+        the client can later ask for it conditionally.
+        """
+        result = self.get_target().get_sync_info(self.source_replica_uid)
+        generation_cache.update(self.dbname, result[1], result[2])
+        self.responder.send_response_json(
+            headers={'etag': generation_etag(result[1], result[2])},
+            target_replica_uid=result[0], target_replica_generation=result[1],
+            target_replica_transaction_id=result[2],
+            source_replica_uid=self.source_replica_uid,
+            source_replica_generation=result[3],
+            source_transaction_id=result[4],
+            single_request_sync=True,
+            binary_framing=True)
+
     @http_app.http_method(
         last_known_generation=int, last_known_trans_id=http_app.none_or_str,
-        sync_id=http_app.none_or_str, content_as_args=True)
+        sync_id=http_app.none_or_str, received=int,
+        target_replica_uid=http_app.none_or_str,
+        source_known_generation=int, source_generation=int,
+        content_as_args=True)
     def post_args(self, last_known_generation, last_known_trans_id=None,
-                  sync_id=None, ensure=False):
+                  sync_id=None, ensure=False, received=0,
+                  target_replica_uid=None, source_known_generation=None,
+                  source_known_trans_id=None, source_generation=None,
+                  source_trans_id=None):
         """
         Handle the initial arguments for the sync POST request from client.
 
@@ -196,6 +248,28 @@ class SyncResource(http_app.SyncResource):
         :param ensure: Whether the server replica should be created if it does
                        not already exist.
         :type ensure: bool
+        :param received: How many documents the client has already received
+                         in an interrupted run of this sync session.
+        :type received: int
+        :param target_replica_uid: The uid the client expects the server
+                                   replica to have, when it did not ask for
+                                   the sync info before this request.
+        :type target_replica_uid: str
+        :param source_known_generation: The client replica generation the
+                                        client expects the server to have
+                                        recorded.
+        :type source_known_generation: int
+        :param source_known_trans_id: The client replica transaction id the
+                                      client expects the server to have
+                                      recorded.
+        :type source_known_trans_id: str
+        :param source_generation: A later client replica generation to be
+                                  recorded before inserting incoming
+                                  documents.
+        :type source_generation: int
+        :param source_trans_id: The client replica transaction id to be
+                                recorded with source_generation.
+        :type source_trans_id: str
         """
         # create or open the database
         cache = get_cache_for('db-' + sync_id + self.dbname, expire=120)
@@ -207,13 +281,40 @@ class SyncResource(http_app.SyncResource):
         # validate the information the client has about server replica
         db.validate_gen_and_trans_id(
             last_known_generation, last_known_trans_id)
+        if source_known_generation is not None:
+            self._record_source_info(
+                db, target_replica_uid,
+                (source_known_generation, source_known_trans_id),
+                (source_generation, source_trans_id))
         # get a sync exchange object
         self.sync_exch = self.sync_exchange_class(
             db, self.source_replica_uid, last_known_generation, sync_id)
         self._sync_id = sync_id
+        self._received = received
         self._staging = []
         self._staging_size = 0
 
+    def _record_source_info(self, db, target_replica_uid, known, pending):
+        """
+        Check what the client expects the server to know about the source
+        replica, and record its pending generation, if any.
+
+        This replaces getting and recording the sync info in separate requests
+        when the whole sync is done in a single request.
+
+        :raise SyncStateMismatchError: If the server knows something else.
+        """
+        if target_replica_uid != db._replica_uid:
+            raise SyncStateMismatchError()
+        recorded = db._get_replica_gen_and_trans_id(self.source_replica_uid)
+        # the pending generation may have been recorded by a previous request
+        # whose response was lost
+        if recorded != known and recorded != pending:
+            raise SyncStateMismatchError()
+        if pending[0] is not None and recorded != pending:
+            db._set_replica_gen_and_trans_id(
+                self.source_replica_uid, pending[0], pending[1])
+
     @http_app.http_method(content_as_args=True)
     def post_put(
             self, id, rev, content, gen,
@@ -252,38 +353,66 @@ class SyncResource(http_app.SyncResource):
         """
         Return syncing documents to the client.
         """
-        def send_doc(doc, gen, trans_id):
-            entry = dict(id=doc.doc_id, rev=doc.rev,
-                         gen=gen, trans_id=trans_id)
-            self.responder.stream_entry(entry)
-            content_reader = doc.get_json()
-            if content_reader:
-                content = content_reader.read()
-                self.responder.stream_entry(content)
-                content_reader.close()
-                # throttle at 5mb/s
-                # FIXME: twistd cant control througput
-                # we need to either use gunicorn or go async
-                time.sleep(len(content) / (5.0 * 1024 * 1024))
-            else:
-                self.responder.stream_entry('')
+        self._return_changes()
 
+    def post_exchange(self):
+        """
+        Return syncing documents to the client after inserting the incoming
+        ones, along with the generation of the client replica that the server
+        knows about after that.
+        """
+        source_gen, source_trans_id = \
+            self.sync_exch._db._get_replica_gen_and_trans_id(
+                self.source_replica_uid)
+        self._return_changes(
+            source_generation=source_gen,
+            source_transaction_id=source_trans_id)
+
+    def _return_changes(self, **extra_header):
         new_gen, number_of_changes = \
-            self.sync_exch.find_changes_to_return()
+            self.sync_exch.find_changes_to_return(self._received)
+        generation_cache.update(
+            self.dbname, new_gen, self.sync_exch.new_trans_id)
         self.responder.content_type = 'application/x-u1db-sync-response'
         self.responder.start_response(200)
-        self.responder.start_stream(),
         header = {
             "new_generation": new_gen,
             "new_transaction_id": self.sync_exch.new_trans_id,
             "number_of_changes": number_of_changes,
         }
+        header.update(extra_header)
         if self.replica_uid is not None:
             header['replica_uid'] = self.replica_uid
+        # documents are only read as the body is consumed, so that a slow
+        # download does not hold a worker thread or the whole body in memory
+        self.responder.content = self._iter_changes(header)
+
+    def _iter_changes(self, header):
+        chunk = []
+        self.responder.write_to(chunk.append)
+        self.responder.start_stream()
         self.responder.stream_entry(header)
-        self.sync_exch.return_docs(send_doc)
+        for doc, gen, trans_id in self.sync_exch.iter_docs():
+            entry = dict(id=doc.doc_id, rev=doc.rev,
+                         gen=gen, trans_id=trans_id)
+            self.responder.stream_entry(entry)
+            content_reader = doc.get_json()
+            if content_reader:
+                content = content_reader.read()
+                self.responder.stream_entry(content)
+                content_reader.close()
+            else:
+                self.responder.stream_entry('')
+            yield ''.join(chunk)
+            del chunk[:]
         self.responder.end_stream()
         self.responder.finish_response()
+        yield ''.join(chunk)
+        # the sync is finished, and the transaction log is compacted below
+        # what all replicas know
+        self.sync_exch._db.set_replica_known_generation(
+            self.source_replica_uid,
+            self.sync_exch.source_last_known_generation)
 
     def post_end(self):
         """
@@ -294,6 +423,7 @@ class SyncResource(http_app.SyncResource):
         self.responder.start_response(200)
         self.responder.start_stream(),
         new_gen, new_trans_id = self.sync_exch._db._get_generation_info()
+        generation_cache.update(self.dbname, new_gen, new_trans_id)
         header = {
             "new_generation": new_gen,
             "new_transaction_id": new_trans_id,
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# fake_couch.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+An in-memory stand-in for a couch database, which counts the requests made
+to it and may add latency to each of them. It may be used by many threads at
+once.
+"""
+import binascii
+import bisect
+import copy
+import threading
+import time
+import uuid
+
+from couchdb.http import ResourceConflict
+from couchdb.http import ResourceNotFound
+from six import StringIO
+
+from leap.soledad.common import couch
+
+
+class _View(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class FakeCouchDatabase(object):
+    """
+    Implement the parts of couchdb.client.Database used by CouchDatabase.
+
+    The number of requests made and of view rows returned are counted.
+    """
+
+    def __init__(self, latency=0):
+        """
+        :param latency: How many seconds each request takes.
+        :type latency: float
+        """
+        self.latency = latency
+        self.requests = 0
+        self.rows = 0
+        self.docs = {}
+        self.attachments = {}
+        self._sorted_ids = None
+        self._lock = threading.Lock()
+
+    def _request(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def __contains__(self, doc_id):
+        self._request()
+        return doc_id in self.docs
+
+    def __getitem__(self, doc_id):
+        self._request()
+        with self._lock:
+            if doc_id not in self.docs:
+                raise ResourceNotFound()
+            return copy.deepcopy(self.docs[doc_id])
+
+    def save(self, doc):
+        (ok, doc_id, rev_or_error), = self.update([doc])
+        if not ok:
+            raise rev_or_error
+        doc['_rev'] = rev_or_error
+        return doc_id, rev_or_error
+
+    def put_u1db_doc(self, doc_id, u1db_rev, content=None, conflicts=None):
+        """
+        Store a u1db document the way CouchDatabase does, without counting it
+        as a request.
+        """
+        attachments = {}
+        if content is not None:
+            attachments['u1db_content'] = content
+        if conflicts is not None:
+            attachments['u1db_conflicts'] = conflicts
+        self._sorted_ids = None
+        self.docs[doc_id] = {
+            '_id': doc_id, '_rev': '1-%s' % uuid.uuid4().hex,
+            'u1db_rev': u1db_rev}
+        self.attachments[doc_id] = attachments
+
+    def put_gen_doc(self, gen, doc_id, trans_id):
+        """
+        Store a gen document the way CouchDatabase does, without counting it
+        as a request.
+        """
+        gen_doc_id = 'gen-%s' % str(gen).zfill(10)
+        self._sorted_ids = None
+        self.docs[gen_doc_id] = {
+            '_id': gen_doc_id, '_rev': '1-%s' % uuid.uuid4().hex,
+            couch.GENERATION_KEY: gen, couch.DOC_ID_KEY: doc_id,
+            couch.TRANSACTION_ID_KEY: trans_id}
+        self.attachments[gen_doc_id] = {}
+
+    def _couch_doc(self, doc_id, attachments):
+        couch_doc = copy.deepcopy(self.docs[doc_id])
+        if self.attachments[doc_id]:
+            couch_doc['_attachments'] = {}
+        for name, data in self.attachments[doc_id].items():
+            if attachments:
+                info = {'data': binascii.b2a_base64(data).strip()}
+            else:
+                info = {'stub': True, 'length': len(data)}
+            couch_doc['_attachments'][name] = info
+        return couch_doc
+
+    def _range(self, startkey, endkey, descending, limit):
+        if self._sorted_ids is None:
+            # local documents are not listed
+            self._sorted_ids = sorted(
+                doc_id for doc_id in self.docs
+                if not doc_id.startswith('_local/'))
+        ids = self._sorted_ids
+        if descending:
+            startkey, endkey = endkey, startkey
+        start = 0 if startkey is None else bisect.bisect_left(ids, startkey)
+        end = len(ids) if endkey is None else bisect.bisect_right(ids, endkey)
+        if descending:
+            keys = ids[end - 1:start - 1 if start else None:-1]
+        else:
+            keys = ids[start:end]
+        return keys[:limit]
+
+    def view(self, name, keys=None, include_docs=None, attachments=None,
+             startkey=None, endkey=None, descending=None, limit=None):
+        if name == couch.CHANGES_VIEW:
+            return self._changes_view(startkey, endkey, limit)
+        assert name in ('_all_docs', '_local_docs')
+        self._request()
+        with self._lock:
+            if name == '_local_docs':
+                keys = sorted(
+                    doc_id for doc_id in self.docs
+                    if doc_id.startswith('_local/') and
+                    startkey <= doc_id <= endkey)
+            elif keys is None:
+                keys = self._range(
+                    startkey, endkey, descending == 'true', limit)
+            rows = []
+            for key in keys:
+                if key not in self.docs:
+                    rows.append({'key': key, 'error': 'not_found'})
+                    continue
+                row = {'id': key, 'key': key,
+                       'value': {'rev': self.docs[key]['_rev']}}
+                if include_docs == 'true':
+                    row['doc'] = self._couch_doc(key, attachments == 'true')
+                rows.append(row)
+            self.rows += len(rows)
+            return _View(rows)
+
+    def _changes_view(self, startkey, endkey, limit):
+        self._request()
+        with self._lock:
+            if couch.CHANGES_DDOC['_id'] not in self.docs:
+                raise ResourceNotFound()
+            gen = couch.DOC_GENERATION_KEY
+            rows = [{'id': doc['_id'], 'key': doc[gen],
+                     'value': doc[couch.DOC_TRANSACTION_ID_KEY]}
+                    for doc in self.docs.values()
+                    if startkey <= doc.get(gen, 0) <= endkey]
+            rows = sorted(rows, key=lambda row: row['key'])[:limit]
+            self.rows += len(rows)
+            return _View(rows)
+
+    def update(self, documents):
+        """
+        Save many documents, as couch's `_bulk_docs` does.
+        """
+        self._request()
+        with self._lock:
+            return [self._update(doc) for doc in documents]
+
+    def _update(self, doc):
+        doc = copy.deepcopy(doc)
+        doc_id = doc['_id']
+        current = self.docs.get(doc_id)
+        if current is not None and current['_rev'] != doc.get('_rev'):
+            return False, doc_id, ResourceConflict()
+        if doc.get('_deleted'):
+            if current is None:
+                return False, doc_id, ResourceNotFound()
+            del self.docs[doc_id]
+            del self.attachments[doc_id]
+            self._sorted_ids = None
+            return True, doc_id, '2-%s' % uuid.uuid4().hex
+        attachments = doc.pop('_attachments', {})
+        doc['_rev'] = '1-%s' % uuid.uuid4().hex
+        if current is None and self._sorted_ids is not None \
+                and not doc_id.startswith('_local/'):
+            bisect.insort(self._sorted_ids, doc_id)
+        self.docs[doc_id] = doc
+        self.attachments[doc_id] = dict(
+            (name, binascii.a2b_base64(info['data']))
+            for name, info in attachments.items())
+        return True, doc_id, doc['_rev']
+
+    def get_attachment(self, id_or_doc, filename):
+        self._request()
+        doc_id = id_or_doc
+        if isinstance(id_or_doc, dict):
+            doc_id = id_or_doc['_id']
+        data = self.attachments.get(doc_id, {}).get(filename)
+        if data is None:
+            return None
+        return StringIO(data)
+
+
+def make_couch_database(fake_database):
+    """
+    Return a CouchDatabase that uses a fake couch database.
+    """
+    db = couch.CouchDatabase('http://localhost:5984', 'user-fake')
+    db._database = fake_database
+    return db
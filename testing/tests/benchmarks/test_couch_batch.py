@@ -0,0 +1,66 @@
+"""
+Benchmarks for the insertion of batches of uploaded documents in couch, as
+done by the server during a sync.
+"""
+import pytest
+
+from itertools import count
+
+from leap.soledad.common.backend import SoledadBackend
+from leap.soledad.common.document import ServerDocument
+from test_soledad.fake_couch import FakeCouchDatabase
+from test_soledad.fake_couch import make_couch_database
+
+
+# seconds each request to the couch stand-in takes, as on a local network
+LATENCY = 0.001
+
+# how many documents are uploaded in each batch
+BATCH_SIZE = 100
+
+
+def create_batch(db_size):
+    @pytest.mark.benchmark(group="test_couch_batch")
+    def test_batch(benchmark, monkeypatch):
+        monkeypatch.setattr(SoledadBackend, 'BATCH_SUPPORT', True)
+        fake = FakeCouchDatabase(latency=LATENCY)
+        for i in xrange(db_size):
+            fake.put_u1db_doc('doc-%d' % i, 'replica:1', '{}')
+            fake.docs['gen-%010d' % i] = {
+                '_id': 'gen-%010d' % i, '_rev': '1-rev', 'gen': i + 1,
+                'doc_id': 'doc-%d' % i, 'trans_id': 'trans-%d' % i}
+            fake.attachments['gen-%010d' % i] = {}
+        db = SoledadBackend(make_couch_database(fake))
+        # half of the uploaded documents are new
+        doc_ids = ['doc-%d' % i for i in xrange(BATCH_SIZE / 2)]
+        doc_ids += ['new-%d' % i for i in xrange(BATCH_SIZE / 2)]
+        revs = count(2)
+        source_gens = count(1)
+
+        def batch():
+            rev = 'replica:%d' % next(revs)
+            fake.requests = 0
+            db.batch_start(doc_ids)
+            for doc_id in doc_ids:
+                db._put_doc_if_newer(
+                    ServerDocument(doc_id, rev, '{}'), save_conflict=False,
+                    replica_uid='source', replica_gen=next(source_gens))
+            db.batch_end()
+            return fake.requests
+
+        requests = benchmark(batch)
+        benchmark.extra_info['requests'] = requests
+    return test_batch
+
+
+# Create the TESTS in the global namespace, they'll be picked by the benchmark
+# plugin.
+
+db_sizes = [
+    ('1k', 1000),
+    ('10k', 10 * 1000),
+    ('100k', 100 * 1000),
+]
+
+for name, db_size in db_sizes:
+    globals()['test_batch_' + name] = create_batch(db_size)
@@ -0,0 +1,53 @@
+"""
+Benchmarks for the download of documents from couch, as done by the server
+when sending documents to a syncing client.
+"""
+import pytest
+
+from leap.soledad.common import couch
+from test_soledad.fake_couch import FakeCouchDatabase
+from test_soledad.fake_couch import make_couch_database
+
+
+# seconds each request to the couch stand-in takes, as on a local network
+LATENCY = 0.001
+
+
+def create_get_docs(amount, size, bulk):
+    @pytest.mark.benchmark(group="test_couch_get_docs")
+    def test_get_docs(benchmark, monkeypatch):
+        if not bulk:
+            # stream every document, which takes one request per document
+            monkeypatch.setattr(couch, 'BULK_CONTENT_SIZE', 0)
+        fake = FakeCouchDatabase(latency=LATENCY)
+        content = '{"data": "%s"}' % ('x' * size)
+        doc_ids = ['doc-%d' % i for i in xrange(amount)]
+        for doc_id in doc_ids:
+            fake.put_u1db_doc(doc_id, 'replica:1', content)
+        db = make_couch_database(fake)
+
+        def get_docs():
+            fake.requests = 0
+            return [doc.get_json() for doc in db.get_docs(doc_ids)]
+
+        docs = benchmark(get_docs)
+        assert len(docs) == amount
+        benchmark.extra_info['requests'] = fake.requests
+        benchmark.extra_info['bytes'] = amount * len(content)
+    return test_get_docs
+
+
+# Create the TESTS in the global namespace, they'll be picked by the benchmark
+# plugin.
+
+get_docs_tests = [
+    ('1000_10k', 1000, 10 * 1000),
+    ('100_100k', 100, 100 * 1000),
+    ('10_1000k', 10, 1000 * 1000),
+]
+
+for name, amount, size in get_docs_tests:
+    globals()['test_get_docs_bulk_' + name] = create_get_docs(
+        amount, size, True)
+    globals()['test_get_docs_per_doc_' + name] = create_get_docs(
+        amount, size, False)
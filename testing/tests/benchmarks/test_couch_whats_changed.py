@@ -0,0 +1,61 @@
+"""
+Benchmarks for listing the changes a syncing device has not seen yet, as done
+by the server when a device syncs after being offline for some time.
+"""
+import pytest
+
+from leap.soledad.common import couch
+from test_soledad.fake_couch import FakeCouchDatabase
+from test_soledad.fake_couch import make_couch_database
+
+
+# seconds each request to the couch stand-in takes, as on a local network
+LATENCY = 0.001
+
+# how many documents are changed many times while the device is offline
+AMOUNT = 1000
+
+
+def create_whats_changed(changes_per_doc, indexed):
+    @pytest.mark.benchmark(group="test_couch_whats_changed")
+    def test_whats_changed(benchmark):
+        fake = FakeCouchDatabase(latency=LATENCY)
+        gen = 0
+        for i in xrange(changes_per_doc):
+            for j in xrange(AMOUNT):
+                gen += 1
+                fake.put_gen_doc(gen, 'doc-%d' % j, 'trans-%d' % gen)
+        for j in xrange(AMOUNT):
+            fake.put_u1db_doc('doc-%d' % j, 'replica:1', '{}')
+            last_gen = gen - AMOUNT + j + 1
+            fake.docs['doc-%d' % j].update({
+                couch.DOC_GENERATION_KEY: last_gen,
+                couch.DOC_TRANSACTION_ID_KEY: 'trans-%d' % last_gen})
+        fake.update([couch.CHANGES_DDOC])
+        if indexed:
+            # all documents hold their generation
+            fake.save({'_id': couch.GENERATION_DOC_ID,
+                       couch.GENERATION_KEY: gen,
+                       couch.INDEXED_SINCE_KEY: 1})
+        db = make_couch_database(fake)
+
+        def whats_changed():
+            fake.requests = fake.rows = 0
+            return db.whats_changed(0)[2]
+
+        changes = benchmark(whats_changed)
+        assert len(changes) == AMOUNT
+        benchmark.extra_info['requests'] = fake.requests
+        benchmark.extra_info['rows'] = fake.rows
+    return test_whats_changed
+
+
+# Create the TESTS in the global namespace, they'll be picked by the benchmark
+# plugin.
+
+for changes_per_doc in [1, 10, 50]:
+    name = '%dx' % changes_per_doc
+    globals()['test_whats_changed_gen_docs_' + name] = \
+        create_whats_changed(changes_per_doc, False)
+    globals()['test_whats_changed_view_' + name] = \
+        create_whats_changed(changes_per_doc, True)
@@ -0,0 +1,140 @@
+'''
+Compare the ways the local sqlite backend can store indexes.
+'''
+import os
+import pytest
+
+from leap.soledad.common.l2db.backends.sqlite_backend import \
+    SQLitePartialExpandDatabase, SQLiteExpressionIndexDatabase
+
+
+BACKENDS = {
+    'expand': SQLitePartialExpandDatabase,
+    'expression': SQLiteExpressionIndexDatabase,
+}
+
+
+def make_contents(amount):
+    return [{'a': 'a%d' % (i % 100), 'b': 'b%d' % (i % 37), 'c': 'C%d' % i,
+             'n': i, 'flag': bool(i % 2)} for i in xrange(amount)]
+
+
+def create_indexes(db):
+    db.create_index('by-a-b', 'a', 'b')
+    db.create_index('by-c', 'lower(c)')
+    db.create_index('by-n', 'number(n, 10)')
+    db.create_index('by-flag', 'bool(flag)')
+
+
+# Each test created with this function will:
+#
+#  - create a database with the given index storage and 4 indexes.
+#  - benchmark: create N docs with values for every indexed field.
+def build_test_index_storage_create_docs(backend, amount):
+    @pytest.mark.benchmark(group="test_index_storage_create_docs")
+    def test(tmpdir, benchmark):
+        contents = make_contents(amount)
+
+        def setup():
+            path = os.path.join(str(tmpdir), os.urandom(8).encode('hex'))
+            db = BACKENDS[backend](path)
+            create_indexes(db)
+            return (db,), {}
+
+        def create(db):
+            db.create_docs(contents)
+            db.close()
+        benchmark.pedantic(create, setup=setup, rounds=5)
+    return test
+
+
+# Each test created with this function will:
+#
+#  - create a database with the given index storage and N docs.
+#  - benchmark: create 4 indexes over the existing docs.
+def build_test_index_storage_create_index(backend, amount):
+    @pytest.mark.benchmark(group="test_index_storage_create_index")
+    def test(tmpdir, benchmark):
+        contents = make_contents(amount)
+
+        def setup():
+            path = os.path.join(str(tmpdir), os.urandom(8).encode('hex'))
+            db = BACKENDS[backend](path)
+            db.create_docs(contents)
+            return (db,), {}
+
+        def create(db):
+            create_indexes(db)
+            db.close()
+        benchmark.pedantic(create, setup=setup, rounds=5)
+    return test
+
+
+# Each test created with this function will:
+#
+#  - create a database with the given index storage, 4 indexes and N docs.
+#  - benchmark: run a query of the given kind.
+def build_test_index_storage_query(backend, query, amount):
+    @pytest.mark.benchmark(group="test_index_storage_query_" + query)
+    def test(tmpdir, benchmark):
+        db = BACKENDS[backend](os.path.join(str(tmpdir), 'test.db'))
+        create_indexes(db)
+        db.create_docs(make_contents(amount))
+
+        def get_exact():
+            return db.get_from_index('by-a-b', 'a5', 'b5')
+
+        def get_glob():
+            return db.get_from_index('by-c', 'c5*')
+
+        def get_range():
+            return db.get_range_from_index('by-n', '0000000100', '0000000200')
+
+        def get_keys():
+            return db.get_index_keys('by-a-b')
+
+        def get_pages():
+            after = None
+            while True:
+                _, after = db.get_from_index_page(
+                    'by-a-b', ('*', '*'), 1000, after)
+                if after is None:
+                    break
+
+        benchmark({
+            'exact': get_exact,
+            'glob': get_glob,
+            'range': get_range,
+            'keys': get_keys,
+            'pages': get_pages}[query])
+    return test
+
+
+test_create_docs_10000_expand = build_test_index_storage_create_docs(
+    'expand', 10 * 1000)
+test_create_docs_10000_expression = build_test_index_storage_create_docs(
+    'expression', 10 * 1000)
+test_create_index_10000_expand = build_test_index_storage_create_index(
+    'expand', 10 * 1000)
+test_create_index_10000_expression = \
+    build_test_index_storage_create_index('expression', 10 * 1000)
+test_exact_query_10000_expand = build_test_index_storage_query(
+    'expand', 'exact', 10 * 1000)
+test_exact_query_10000_expression = build_test_index_storage_query(
+    'expression', 'exact', 10 * 1000)
+test_glob_query_10000_expand = build_test_index_storage_query(
+    'expand', 'glob', 10 * 1000)
+test_glob_query_10000_expression = build_test_index_storage_query(
+    'expression', 'glob', 10 * 1000)
+test_range_query_10000_expand = build_test_index_storage_query(
+    'expand', 'range', 10 * 1000)
+test_range_query_10000_expression = build_test_index_storage_query(
+    'expression', 'range', 10 * 1000)
+test_keys_query_10000_expand = build_test_index_storage_query(
+    'expand', 'keys', 10 * 1000)
+test_keys_query_10000_expression = build_test_index_storage_query(
+    'expression', 'keys', 10 * 1000)
+test_pages_query_10000_expand = build_test_index_storage_query(
+    'expand', 'pages', 10 * 1000)
+test_pages_query_10000_expression = build_test_index_storage_query(
+    'expression', 'pages', 10 * 1000)
@@ -0,0 +1,64 @@
+"""
+Benchmarks for the server side sync session state.
+"""
+import pytest
+
+from uuid import uuid4
+
+from leap.soledad.common.document import ServerDocument
+from leap.soledad.server import caching
+from leap.soledad.server.sync import SyncExchange
+
+
+class _Database(object):
+    """
+    A database that inserts every document at its own generation.
+    """
+
+    def __init__(self, changes):
+        self._changes = changes
+
+    def _put_doc_if_newer(self, doc, **kwargs):
+        return 'inserted', int(doc.doc_id[4:])
+
+    def iter_whats_changed(self, old_generation):
+        gen = len(self._changes)
+        return gen, 'trans-%d' % gen, iter(self._changes)
+
+
+def create_upload(amount, sqlite):
+    @pytest.mark.benchmark(group="test_server_sync_state")
+    def test_upload(benchmark, tmpdir, monkeypatch):
+        if sqlite:
+            store = caching.SQLiteSyncStateStore(str(tmpdir.join('state')))
+            monkeypatch.setattr(caching, '_store', store)
+        # half of the changes to return were uploaded in this sync session
+        changes = [('doc-%d' % i, i, 'trans-%d' % i)
+                   for i in xrange(amount * 3 / 2)]
+        db = _Database(changes)
+        docs = [ServerDocument('doc-%d' % i, 'rev') for i in xrange(amount)]
+
+        def upload():
+            exch = SyncExchange(db, 'source', 0, str(uuid4()))
+            for i, doc in enumerate(docs):
+                exch.insert_doc_from_source(
+                    doc, i, 'trans', amount, i + 1, exch.sync_id)
+            return exch.find_changes_to_return()
+
+        new_gen, number_of_changes = benchmark(upload)
+        assert number_of_changes == len(changes) - amount
+    return test_upload
+
+
+# Create the TESTS in the global namespace, they'll be picked by the benchmark
+# plugin.
+
+upload_tests = [
+    ('1k', 1000),
+    ('10k', 10 * 1000),
+    ('50k', 50 * 1000),
+]
+
+for name, amount in upload_tests:
+    globals()['test_upload_memory_' + name] = create_upload(amount, False)
+    globals()['test_upload_sqlite_' + name] = create_upload(amount, True)
@@ -5,6 +5,8 @@ import pytest
 
 from twisted.internet.defer import gatherResults
 
+from leap.soledad.common.document import SoledadDocument
+
 
 def load_up(client, amount, payload, defer=True):
     results = [client.create_doc({'content': payload}) for _ in xrange(amount)]
@@ -36,3 +38,165 @@ test_async_create_1000_10k = build_test_sqlcipher_async_create(1000, 10 * 1000)
 test_create_20_500k = build_test_sqlcipher_create(20, 500 * 1000)
 test_create_100_100k = build_test_sqlcipher_create(100, 100 * 1000)
 test_create_1000_10k = build_test_sqlcipher_create(1000, 10 * 1000)
+
+
+# Each test created with this function will:
+#
+#  - get a fresh client and create one document.
+#  - benchmark: a single operation over the async api, so that results show
+#    the per-operation latency, including the connection pool overhead.
+def build_test_sqlcipher_single_op(op, size):
+    @pytest.inlineCallbacks
+    @pytest.mark.benchmark(group="test_sqlcipher_single_op")
+    def test(soledad_client, txbenchmark, payload):
+        client = soledad_client()
+        doc = yield client.create_doc({'content': payload(size)})
+
+        def get():
+            return client.get_doc(doc.doc_id)
+
+        def put():
+            return client.put_doc(doc)
+
+        yield txbenchmark({'get': get, 'put': put}[op])
+    return test
+
+
+test_get_doc_1k = build_test_sqlcipher_single_op('get', 1000)
+test_put_doc_1k = build_test_sqlcipher_single_op('put', 1000)
+test_get_doc_100k = build_test_sqlcipher_single_op('get', 100 * 1000)
+test_put_doc_100k = build_test_sqlcipher_single_op('put', 100 * 1000)
+
+
+# Each test created with this function will:
+#
+#  - get a fresh client and create a number of single-field indexes.
+#  - benchmark: create N docs that have a value for every indexed field.
+def build_test_sqlcipher_create_with_indexes(num_indexes, amount, size):
+    @pytest.mark.benchmark(group="test_sqlcipher_create_with_indexes")
+    def test(soledad_client, benchmark, payload):
+        client = soledad_client()._dbsyncer
+        content = {'content': payload(size)}
+        for i in xrange(num_indexes):
+            field = 'field%d' % i
+            content[field] = 'value%d' % i
+            client.create_index('by-' + field, field)
+
+        def create():
+            for _ in xrange(amount):
+                client.create_doc(content)
+        benchmark(create)
+    return test
+
+
+test_create_0_indexes = build_test_sqlcipher_create_with_indexes(0, 1000, 1000)
+test_create_5_indexes = build_test_sqlcipher_create_with_indexes(5, 1000, 1000)
+test_create_20_indexes = build_test_sqlcipher_create_with_indexes(
+    20, 1000, 1000)
+
+
+# Each test created with this function will:
+#
+#  - get a fresh client, create a two-field and a one-field index and
+#    100k docs with values for all of the indexed fields.
+#  - benchmark: one index query of the given kind.
+def build_test_sqlcipher_query_index(query, amount=100 * 1000):
+    @pytest.mark.benchmark(group="test_sqlcipher_query_index")
+    def test(soledad_client, benchmark):
+        client = soledad_client()._dbsyncer
+        client.create_index('by-a-b', 'a', 'b')
+        client.create_index('by-c', 'c')
+        client.create_docs(
+            [{'a': 'a%d' % (i % 100), 'b': 'b%d' % (i % 37), 'c': 'c%d' % i}
+             for i in xrange(amount)])
+
+        def get_exact():
+            return client.get_from_index('by-a-b', 'a5', 'b5')
+
+        def get_glob():
+            return client.get_from_index('by-c', 'c5*')
+
+        def get_range():
+            return client.get_range_from_index(
+                'by-a-b', ('a1', 'b1'), ('a2', 'b2'))
+
+        def get_keys():
+            return client.get_index_keys('by-a-b')
+
+        benchmark({
+            'exact': get_exact,
+            'glob': get_glob,
+            'range': get_range,
+            'keys': get_keys}[query])
+    return test
+
+
+test_get_from_index_exact = build_test_sqlcipher_query_index('exact')
+test_get_from_index_glob = build_test_sqlcipher_query_index('glob')
+test_get_range_from_index = build_test_sqlcipher_query_index('range')
+test_get_index_keys = build_test_sqlcipher_query_index('keys')
+
+
+# Each test created with this function will:
+#
+#  - get a fresh client, create N docs and update each of them 9 times, so
+#    that the transaction log has 10 entries per document.
+#  - benchmark: list what changed since the first update.
+def build_test_sqlcipher_whats_changed(amount):
+    @pytest.mark.benchmark(group="test_sqlcipher_whats_changed")
+    def test(soledad_client, benchmark):
+        client = soledad_client()._dbsyncer
+        docs = client.create_docs([{'n': 0} for _ in xrange(amount)])
+        for n in xrange(1, 10):
+            for doc in docs:
+                doc.content = {'n': n}
+            client.put_docs(docs)
+        benchmark(client.whats_changed, amount)
+    return test
+
+
+test_whats_changed_10000 = build_test_sqlcipher_whats_changed(10 * 1000)
+
+
+# Each test created with this function will:
+#
+#  - get a fresh client and create half of N docs, so that received docs are
+#    both new and updates of existing ones.
+#  - benchmark: apply N docs received from another replica, either one by
+#    one or all at once.
+def build_test_sqlcipher_insert_from_target(amount, bulk):
+    @pytest.mark.benchmark(group="test_sqlcipher_insert_from_target")
+    def test(soledad_client, benchmark):
+        client = soledad_client()._dbsyncer
+        client.create_docs([{'n': 0} for _ in xrange(amount / 2)])
+        existing = client.get_all_docs()[1]
+        received = []
+        for i in xrange(amount):
+            if i < len(existing):
+                doc = existing[i]
+                doc.rev += '|remote:1'
+            else:
+                doc = SoledadDocument('doc-%d' % i, 'remote:1')
+            doc.content = {'n': i}
+            received.append((doc, i + 1, 'T-%d' % (i + 1)))
+
+        def insert_one_by_one():
+            for doc, gen, trans_id in received:
+                client._put_doc_if_newer(
+                    doc, save_conflict=True, replica_uid='remote',
+                    replica_gen=gen, replica_trans_id=trans_id)
+            client.commit()
+
+        def insert_bulk():
+            client._put_docs_if_newer(
+                received, save_conflict=True, replica_uid='remote')
+
+        benchmark.pedantic(
+            insert_bulk if bulk else insert_one_by_one, rounds=1)
+    return test
+
+
+test_insert_from_target_one_by_one_1000 = \
+    build_test_sqlcipher_insert_from_target(1000, False)
+test_insert_from_target_bulk_1000 = \
+    build_test_sqlcipher_insert_from_target(1000, True)
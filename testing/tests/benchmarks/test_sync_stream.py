@@ -0,0 +1,87 @@
+"""
+Benchmarks for the sync stream framing.
+
+Each benchmark streams a batch of symmetrically encrypted documents the way
+the server answers a sync request, and parses the stream the way the client
+does, either with lines of JSON or with binary framing, up to the point where
+the ciphertext is ready to be decrypted. The number of bytes sent on the wire
+is recorded in the extra info of each benchmark.
+"""
+import base64
+import json
+import pytest
+
+from twisted.internet import defer
+
+from leap.soledad.common.l2db.remote import http_app
+from leap.soledad.common.l2db.remote import utils
+from leap.soledad.client.http_target.fetch_protocol import DocFrameReceiver
+from leap.soledad.client.http_target.fetch_protocol import DocStreamReceiver
+
+
+AMOUNT = 100
+
+
+def _encrypted_content(payload):
+    # the preamble is a placeholder, only its signature matters for framing
+    return '{"raw": "EzcBAAAA %s"}' % base64.urlsafe_b64encode(payload)
+
+
+def _stream(contents, binary_framing):
+    written = []
+    responder = http_app.HTTPResponder(lambda *_: written.append)
+    responder.binary_framing = binary_framing
+    responder.content_type = 'application/x-u1db-sync-response'
+    responder.start_response(200)
+    responder.start_stream()
+    responder.stream_entry({'new_generation': len(contents)})
+    for i, content in enumerate(contents):
+        responder.stream_entry(
+            {'id': 'doc-%d' % i, 'rev': 'rev', 'gen': i,
+             'trans_id': 'trans-%d' % i})
+        responder.stream_entry(content)
+    responder.end_stream()
+    return ''.join(written)
+
+
+def _read_ciphertext(doc_info, content, total):
+    if isinstance(content, utils.RawContent):
+        ciphertext = content.partition(' ')[2]
+    else:
+        armored = str(json.loads(content)['raw'])
+        ciphertext = base64.urlsafe_b64decode(armored.partition(' ')[2])
+    return defer.succeed(ciphertext)
+
+
+def _parse(stream, receiver):
+    parser = receiver(None, defer.Deferred(), _read_ciphertext)
+    # deliver the stream in chunks, like the transport does
+    for i in xrange(0, len(stream), 2 ** 16):
+        parser.dataReceived(stream[i:i + 2 ** 16])
+    parser.finish()
+
+
+def create_stream_roundtrip(size, binary_framing):
+    receiver = DocFrameReceiver if binary_framing else DocStreamReceiver
+
+    @pytest.mark.benchmark(group="test_sync_stream_roundtrip")
+    def test_stream_roundtrip(benchmark, payload):
+        contents = [_encrypted_content(payload(size))] * AMOUNT
+        benchmark.extra_info['bytes'] = len(_stream(contents, binary_framing))
+        benchmark(lambda: _parse(_stream(contents, binary_framing), receiver))
+    return test_stream_roundtrip
+
+
+# Create the TESTS in the global namespace, they'll be picked by the benchmark
+# plugin.
+
+stream_tests = [
+    ('1k', 1000),
+    ('10k', 10 * 1000),
+    ('100k', 100 * 1000),
+]
+
+for name, size in stream_tests:
+    for framing, binary_framing in [('lines', False), ('binary', True)]:
+        globals()['test_stream_%s_%s' % (framing, name)] = \
+            create_stream_roundtrip(size, binary_framing)
@@ -20,6 +20,8 @@ Tests for soledad api.
 
 from mock import MagicMock
 
+from twisted.internet import defer
+
 from test_soledad.util import BaseSoledadTest
 
 
@@ -34,3 +36,44 @@ class ApiTestCase(BaseSoledadTest):
         code = self._soledad.create_recovery_code()
 
         self.assertEqual(generated_code, code)
+
+    @defer.inlineCallbacks
+    def test_create_docs(self):
+        docs = yield self._soledad.create_docs([{'n': 1}, {'n': 2}])
+        gen, all_docs = yield self._soledad.get_all_docs()
+        self.assertEqual(2, gen)
+        self.assertEqual(
+            sorted(doc.doc_id for doc in docs),
+            sorted(doc.doc_id for doc in all_docs))
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        doc = yield self._soledad.create_doc({'n': 1})
+        doc.content = {'n': 2}
+        with self._soledad.batch() as batch:
+            batch.put_doc(doc)
+            batch.create_doc({'n': 3}, doc_id='other')
+        docs = yield batch.deferred
+        self.assertEqual([doc.doc_id, 'other'], [d.doc_id for d in docs])
+        stored = yield self._soledad.get_doc(doc.doc_id)
+        self.assertEqual({'n': 2}, stored.content)
+
+    @defer.inlineCallbacks
+    def test_get_from_index_limit(self):
+        yield self._soledad.create_index('by-n', 'n')
+        for n in range(3):
+            yield self._soledad.create_doc({'n': str(n)}, doc_id='d%d' % n)
+        docs, after = yield self._soledad.get_from_index(
+            'by-n', '*', limit=2)
+        self.assertEqual(['d0', 'd1'], [doc.doc_id for doc in docs])
+        docs, after = yield self._soledad.get_from_index(
+            'by-n', '*', limit=2, after=after)
+        self.assertEqual(['d2'], [doc.doc_id for doc in docs])
+        self.assertIsNone(after)
+
+    @defer.inlineCallbacks
+    def test_iter_all_docs(self):
+        yield self._soledad.create_docs([{'n': n} for n in range(5)])
+        pages = []
+        yield self._soledad.iter_all_docs(pages.append, page_size=2)
+        self.assertEqual([2, 2, 1], map(len, pages))
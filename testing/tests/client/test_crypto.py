@@ -212,6 +212,18 @@ class BlobTestCase(unittest.TestCase):
         assert len(decrypted) != 0
         assert json.loads(decrypted) == payload
 
+    @defer.inlineCallbacks
+    def test_decrypt_doc_blocking(self):
+        crypto = _crypto.SoledadCrypto('A' * 96)
+        payload = {'key': 'someval'}
+        doc1 = SoledadDocument('id1', '1', json.dumps(payload))
+
+        encrypted = yield crypto.encrypt_doc(doc1)
+        doc2 = SoledadDocument('id1', '1')
+        doc2.set_json(encrypted)
+        decrypted = crypto.decrypt_doc_blocking(doc2)
+        assert json.loads(decrypted) == payload
+
     @defer.inlineCallbacks
     def test_decrypt_with_wrong_tag_raises(self):
         """
@@ -18,13 +18,25 @@
 Test ObjectStore and Couch backend bits.
 """
 
+import itertools
+import threading
+import time
+
 from uuid import uuid4
+from couchdb.http import ResourceConflict
+from couchdb.http import ResourceNotFound
+from mock import Mock
 from six.moves.urllib.parse import urljoin
 from testscenarios import TestWithScenarios
 from twisted.trial import unittest
 
 from leap.soledad.common import couch
+from leap.soledad.common.backend import SoledadBackend
+from leap.soledad.common.document import ServerDocument
+from leap.soledad.common.l2db.errors import RevisionConflict
 
+from test_soledad.fake_couch import FakeCouchDatabase
+from test_soledad.fake_couch import make_couch_database
 from test_soledad.util import CouchDBTestCase
 from test_soledad.u1db_tests import test_backends
 
@@ -109,3 +121,397 @@ class DatabaseNameValidationTest(unittest.TestCase):
         inject = couch.state.is_db_name_valid("user-deadbeef | cat /secret")
         self.assertFalse(inject)
         self.assertTrue(couch.state.is_db_name_valid("user-cafe1337"))
+
+
+class GetDocsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeCouchDatabase()
+        for i in range(10):
+            self.fake.put_u1db_doc('doc-%d' % i, 'rev-%d' % i, '{"n": %d}' % i)
+        self.fake.put_u1db_doc('deleted', 'rev')
+        self.db = make_couch_database(self.fake)
+
+    def test_contents_are_fetched_in_bulk(self):
+        doc_ids = ['doc-%d' % i for i in range(10)]
+        docs = list(self.db.get_docs(doc_ids, check_for_conflicts=False))
+        self.assertEqual(doc_ids, [doc.doc_id for doc in docs])
+        self.assertEqual(
+            ['{"n": %d}' % i for i in range(10)],
+            [doc.get_json() for doc in docs])
+        self.assertEqual(2, self.fake.requests)
+
+    def test_contents_are_fetched_in_chunks(self):
+        self.patch(couch, 'BULK_CONTENT_SIZE', 20)
+        docs = list(self.db.get_docs(['doc-%d' % i for i in range(10)]))
+        self.assertEqual(10, len(docs))
+        # 8 bytes per document, 2 documents per request
+        self.assertEqual(6, self.fake.requests)
+
+    def test_large_contents_are_streamed(self):
+        self.patch(couch, 'BULK_CONTENT_SIZE', 5)
+        docs = list(self.db.get_docs(
+            ['doc-1', 'doc-2'], read_content=False))
+        self.assertEqual('{"n": 1}', docs[0].get_json().read())
+        self.assertEqual(3, self.fake.requests)
+
+    def test_unread_contents(self):
+        docs = list(self.db.get_docs(['doc-1'], read_content=False))
+        self.assertEqual('{"n": 1}', docs[0].get_json().read())
+
+    def test_documents_removed_while_fetching(self):
+        self.patch(couch, 'BULK_CONTENT_SIZE', 20)
+        docs = self.db.get_docs(['doc-%d' % i for i in range(4)])
+        self.assertEqual('doc-0', next(docs).doc_id)
+        self.fake.update([{'_id': 'doc-3', '_deleted': True,
+                           '_rev': self.fake.docs['doc-3']['_rev']}])
+        self.assertEqual('doc-1', next(docs).doc_id)
+        # the documents after a removed one must not be misplaced
+        self.assertRaises(ResourceNotFound, list, docs)
+
+    def test_tombstones(self):
+        docs = list(self.db.get_docs(['deleted', 'doc-1']))
+        self.assertEqual(['doc-1'], [doc.doc_id for doc in docs])
+        docs = list(self.db.get_docs(['deleted'], include_deleted=True))
+        self.assertTrue(docs[0].is_tombstone())
+        self.assertEqual(3, self.fake.requests)
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(SoledadBackend, 'BATCH_SUPPORT', True)
+        self.fake = FakeCouchDatabase()
+        for i in range(10):
+            self.fake.put_u1db_doc('doc-%d' % i, 'replica:1', '{}')
+        self.fake.put_u1db_doc(
+            'conflicted', 'replica:1', '{}', '[["other:1", {"a": 1}]]')
+        self.db = SoledadBackend(make_couch_database(self.fake))
+
+    def put_batch(self, docs):
+        self.fake.requests = 0
+        self.db.batch_start([doc.doc_id for doc in docs])
+        results = []
+        for i, doc in enumerate(docs):
+            results.append(self.db._put_doc_if_newer(
+                doc, save_conflict=False, replica_uid='source',
+                replica_gen=i + 1, replica_trans_id='trans-%d' % i)[0])
+        self.db.batch_end()
+        return results
+
+    def test_only_batch_documents_are_fetched(self):
+        couch_db = self.db._database
+        couch_db.reserve_generations(1)
+        self.fake.requests = 0
+        couch_db.batch_start(['doc-1', 'new'])
+        # get the generation, reserve generations and get the documents
+        self.assertEqual(3, self.fake.requests)
+        self.assertEqual(set(['doc-1']), couch_db.batched_ids)
+        self.assertIsNone(couch_db.get_doc('new'))
+        self.assertEqual('replica:1', couch_db.get_doc('doc-1').rev)
+        self.assertEqual(3, self.fake.requests)
+
+    def test_requests_do_not_depend_on_batch_size(self):
+        # the first batch also fetches what is known about the source
+        self.put_batch([ServerDocument('new', 'replica:1', '{}')])
+        self.put_batch([ServerDocument('doc-0', 'replica:2', '{}')])
+        requests = self.fake.requests
+        docs = [ServerDocument('doc-%d' % i, 'replica:2', '{"n": %d}' % i)
+                for i in range(1, 10)]
+        docs += [ServerDocument('new-%d' % i, 'replica:1', '{}')
+                 for i in range(10)]
+        self.assertEqual(['inserted'] * 19, self.put_batch(docs))
+        self.assertEqual(requests, self.fake.requests)
+        self.assertEqual('{"n": 9}', self.fake.attachments['doc-9'][
+            'u1db_content'])
+
+    def test_outcomes(self):
+        results = self.put_batch([
+            ServerDocument('doc-0', 'replica:1', '{}'),
+            ServerDocument('doc-1', 'other:1', '{"a": 1}'),
+            ServerDocument('doc-2', 'replica:2', None),
+            ServerDocument('conflicted', 'replica:2', '{}'),
+        ])
+        self.assertEqual(
+            ['converged', 'conflicted', 'inserted', 'inserted'], results)
+        # generations of inserted documents are saved with them
+        self.assertEqual(2, self.db._get_generation())
+        self.assertNotIn('u1db_content', self.fake.attachments['doc-2'])
+        # conflicts of the current version are kept
+        self.assertEqual(
+            '[["other:1", {"a": 1}]]',
+            self.fake.attachments['conflicted']['u1db_conflicts'])
+
+    def test_document_changed_twice(self):
+        results = self.put_batch([
+            ServerDocument('doc-0', 'replica:2', '{}'),
+            ServerDocument('doc-0', 'replica:3', '{"n": 3}'),
+        ])
+        self.assertEqual(['inserted', 'inserted'], results)
+        self.assertEqual('replica:3', self.fake.docs['doc-0']['u1db_rev'])
+        self.assertEqual(
+            '{"n": 3}', self.fake.attachments['doc-0']['u1db_content'])
+
+
+class GenerationReservationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(SoledadBackend, 'BATCH_SUPPORT', True)
+        self.fake = FakeCouchDatabase(latency=0.001)
+
+    def test_reserved_ranges_do_not_overlap(self):
+        db = make_couch_database(self.fake)
+        other = make_couch_database(self.fake)
+        self.assertEqual(1, db.reserve_generations(5))
+        self.assertEqual(6, other.reserve_generations(2))
+        # the cached reservation document is outdated and fetched again
+        self.assertEqual(8, db.reserve_generations(1))
+
+    def test_existing_generations_are_not_reserved(self):
+        db = make_couch_database(self.fake)
+        db._allocate_new_generation('doc', 'trans')
+        db._allocate_new_generation('doc', 'trans')
+        del self.fake.docs['_local/generation']
+        self.assertEqual(3, make_couch_database(self.fake)
+                         .reserve_generations(1))
+
+    def test_concurrent_writers(self):
+        errors = []
+
+        def batches(writer):
+            db = SoledadBackend(make_couch_database(self.fake))
+            try:
+                for i in range(5):
+                    docs = [ServerDocument('%s-%d-%d' % (writer, i, j),
+                                           'replica:1', '{}')
+                            for j in range(10)]
+                    db.batch_start([doc.doc_id for doc in docs])
+                    for doc in docs:
+                        db._put_doc_if_newer(
+                            doc, save_conflict=False, replica_uid=None,
+                            replica_gen=None)
+                    db.batch_end()
+            except Exception as e:
+                errors.append(e)
+
+        def single_writes(writer):
+            db = make_couch_database(self.fake)
+            try:
+                for i in range(20):
+                    db._allocate_new_generation('%s-%d' % (writer, i), 'tr')
+            except Exception as e:
+                errors.append(e)
+
+        self.patch(SoledadBackend, '_validate_source', lambda *args: None)
+        threads = [threading.Thread(target=batches, args=('batch-%d' % i,))
+                   for i in range(4)]
+        threads += [threading.Thread(target=single_writes,
+                                     args=('single-%d' % i,))
+                    for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        gen_docs = [doc for doc_id, doc in self.fake.docs.items()
+                    if doc_id.startswith('gen-')]
+        # every change got its own generation
+        self.assertEqual(4 * 5 * 10 + 2 * 20, len(gen_docs))
+        self.assertEqual(
+            set(doc_id for doc_id in self.fake.docs
+                if doc_id.startswith(('batch-', 'single-'))) |
+            set('single-%d-%d' % (w, i) for w in range(2) for i in range(20)),
+            set(doc['doc_id'] for doc in gen_docs))
+        self.assertEqual(
+            max(doc['gen'] for doc in gen_docs),
+            self.fake.docs['_local/generation']['gen'])
+        self.assertEqual([], self.fake.docs['_local/generation']['reserved'])
+
+    def test_generations_become_visible_in_order(self):
+        self.patch(SoledadBackend, '_validate_source', lambda *args: None)
+        writer = SoledadBackend(make_couch_database(self.fake))
+        other = SoledadBackend(make_couch_database(self.fake))
+        reader = SoledadBackend(make_couch_database(self.fake))
+        writer.batch_start(['x'])
+        other.batch_start(['y'])
+        other._put_doc_if_newer(
+            ServerDocument('y', 'replica:1', '{}'), save_conflict=False,
+            replica_uid=None, replica_gen=None)
+        other.batch_end()
+        # y got generation 2, which is hidden until generation 1 is written
+        self.assertEqual(0, reader._get_generation())
+        writer._put_doc_if_newer(
+            ServerDocument('x', 'replica:1', '{}'), save_conflict=False,
+            replica_uid=None, replica_gen=None)
+        self.assertEqual(0, reader._get_generation())
+        writer.batch_end()
+        self.assertEqual(2, reader._get_generation())
+        self.assertEqual(
+            ['x', 'y'], [doc_id for doc_id, _, _ in
+                         reader.whats_changed(0)[2]])
+
+    def test_document_holds_the_generation_of_its_change(self):
+        db = make_couch_database(self.fake)
+        resource = Mock()
+        self.patch(db, '_new_resource', lambda *path: resource)
+        db.release_generations([db.reserve_generations(1)])
+        # generation 2 is taken by a writer that does not reserve generations
+        self.fake.put_gen_doc(2, 'other', 'trans-2')
+        db.save_document(None, ServerDocument('doc', 'replica:1', '{}'), 't')
+        self.assertEqual('doc', self.fake.docs['gen-0000000003']['doc_id'])
+        self.assertIn('"u1db_gen": 3', resource.put_json.call_args[1]['body'])
+        self.assertEqual([], self.fake.docs['_local/generation']['reserved'])
+
+    def test_conflicting_changes_are_not_logged(self):
+        db = make_couch_database(self.fake)
+        resource = Mock()
+        resource.put_json.side_effect = ResourceConflict()
+        self.patch(db, '_new_resource', lambda *path: resource)
+        self.assertRaises(
+            RevisionConflict, db.save_document, None,
+            ServerDocument('doc', 'replica:1', '{}'), 't')
+        self.assertEqual([], db._get_transaction_log())
+        self.assertEqual([], self.fake.docs['_local/generation']['reserved'])
+
+    def test_reservations_of_dead_writers_expire(self):
+        db = make_couch_database(self.fake)
+        db.reserve_generations(1)
+        db._allocate_new_generation('doc', 'trans')
+        self.assertEqual(0, db.get_generation_info()[0])
+        later = time.time() + couch.RESERVATION_TIMEOUT + 1
+        self.patch(couch.time, 'time', lambda: later)
+        self.assertEqual(2, db.get_generation_info()[0])
+
+
+class WhatsChangedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(SoledadBackend, 'BATCH_SUPPORT', True)
+        self.fake = FakeCouchDatabase()
+        # changes made before documents held their generation
+        for gen, doc_id in [(1, 'doc-a'), (2, 'doc-b'), (3, 'doc-a')]:
+            self.fake.put_u1db_doc(doc_id, 'replica:%d' % gen, '{}')
+            self.fake.put_gen_doc(gen, doc_id, 'trans-%d' % gen)
+        self.db = SoledadBackend(make_couch_database(self.fake))
+        self.revs = itertools.count(10)
+
+    def put(self, *doc_ids):
+        self.db.batch_start(doc_ids)
+        for doc_id in doc_ids:
+            doc = ServerDocument(doc_id, 'replica:%d' % next(self.revs), '{}')
+            self.db._put_doc_if_newer(
+                doc, save_conflict=False, replica_uid=None, replica_gen=None)
+        self.db.batch_end()
+
+    def assertChanges(self, old_generation):
+        couch_db = self.db._database
+        expected = couch_db._get_logged_changes(old_generation + 1)
+        self.assertEqual(expected, couch_db.whats_changed(old_generation)[2])
+        return expected
+
+    def test_changes_before_documents_held_generations(self):
+        self.assertEqual(
+            [('doc-b', 2, 'trans-2'), ('doc-a', 3, 'trans-3')],
+            self.assertChanges(0))
+        self.assertNotIn('_design/changes', self.fake.docs)
+
+    def test_changes_are_listed_once_per_document(self):
+        self.patch(SoledadBackend, '_validate_source', lambda *args: None)
+        self.put('doc-b', 'doc-c')
+        self.put('doc-c')
+        changes = self.assertChanges(0)
+        self.assertEqual(['doc-a', 'doc-b', 'doc-c'],
+                         [doc_id for doc_id, _, _ in changes])
+        self.assertEqual([3, 4, 6], [gen for _, gen, _ in changes])
+        for old_generation in range(1, 7):
+            self.assertChanges(old_generation)
+        self.assertIn('_design/changes', self.fake.docs)
+
+    def test_changes_are_fetched_in_pages(self):
+        self.patch(SoledadBackend, '_validate_source', lambda *args: None)
+        self.patch(couch, 'CHANGES_PAGE_SIZE', 2)
+        self.put(*['doc-%d' % i for i in range(5)])
+        # the view is created when first used
+        self.db.whats_changed(7)
+        self.fake.requests = 0
+        gen, trans_id, changes = self.db.iter_whats_changed(3)
+        self.assertEqual(8, gen)
+        requests = self.fake.requests
+        self.assertEqual(('doc-0', 4), next(changes)[:2])
+        # pages are only fetched as changes are iterated over
+        self.assertEqual(requests + 1, self.fake.requests)
+        self.assertEqual(['doc-%d' % i for i in range(1, 5)],
+                         [doc_id for doc_id, _, _ in changes])
+        self.assertEqual(requests + 3, self.fake.requests)
+
+    def test_later_changes_are_not_listed(self):
+        self.patch(SoledadBackend, '_validate_source', lambda *args: None)
+        self.put('doc-b', 'doc-c')
+        gen, trans_id, changes = self.db.iter_whats_changed(3)
+        self.put('doc-d')
+        self.assertEqual(5, gen)
+        self.assertEqual([('doc-b', 4), ('doc-c', 5)],
+                         [change[:2] for change in changes])
+
+
+class CompactionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeCouchDatabase()
+        history = [(1, 'doc-a'), (2, 'doc-b'), (3, 'doc-a'), (4, 'doc-a'),
+                   (5, 'doc-c'), (6, 'doc-b'), (7, 'doc-c')]
+        for gen, doc_id in history:
+            self.fake.put_gen_doc(gen, doc_id, 'trans-%d' % gen)
+        self.db = make_couch_database(self.fake)
+
+    def gens(self):
+        return [gen for gen, _, _ in self.db._get_transaction_log()]
+
+    def test_nothing_is_removed_without_known_generations(self):
+        self.assertEqual((0, 0), self.db.compact_transaction_log())
+        self.assertEqual(range(1, 8), self.gens())
+
+    def test_known_generations_are_recorded(self):
+        self.db.set_replica_known_generation('replica-1', 3)
+        self.db.set_replica_known_generation('replica-2', 5)
+        self.db.set_replica_known_generation('replica-1', 6)
+        known = self.fake.docs[couch.KNOWN_GENERATIONS_DOC_ID]
+        self.assertEqual({'replica-1': 6, 'replica-2': 5},
+                         known[couch.REPLICAS_KEY])
+
+    def test_superseded_changes_older_than_all_replicas_are_removed(self):
+        self.db.set_replica_known_generation('replica-1', 7)
+        self.db.set_replica_known_generation('replica-2', 5)
+        removed, size = self.db.compact_transaction_log()
+        # gen 5 is superseded by gen 7, but replica-2 may still validate it
+        self.assertEqual(3, removed)
+        self.assertGreater(size, 0)
+        self.assertEqual([4, 5, 6, 7], self.gens())
+        for gen in [4, 5, 6, 7]:
+            self.assertEqual(
+                'trans-%d' % gen, self.db.get_trans_id_for_gen(gen))
+        self.assertEqual((7, 'trans-7'), self.db.get_generation_info())
+        self.assertEqual((0, 0), self.db.compact_transaction_log())
+
+    def test_replicas_in_the_sync_log_are_considered(self):
+        self.db.set_replica_known_generation('replica-1', 7)
+        self.db.set_replica_gen_and_trans_id('replica-2', 3, 'other-3')
+        # replica-2 synced, but what it knows about was not recorded
+        self.assertEqual((0, 0), self.db.compact_transaction_log())
+        self.db.set_replica_known_generation('replica-2', 5)
+        self.assertEqual(3, self.db.compact_transaction_log()[0])
+        self.assertEqual([4, 5, 6, 7], self.gens())
+
+    def test_dry_run_removes_nothing(self):
+        self.db.set_replica_known_generation('replica-1', 7)
+        removed, size = self.db.compact_transaction_log(dry_run=True)
+        self.assertEqual(4, removed)
+        self.assertEqual(range(1, 8), self.gens())
+        self.assertEqual((removed, size), self.db.compact_transaction_log())
+        self.assertEqual([4, 6, 7], self.gens())
+
+    def test_gen_docs_are_scanned_in_pages(self):
+        self.patch(couch, 'BULK_MAX_DOCS', 2)
+        self.db.set_replica_known_generation('replica-1', 7)
+        self.assertEqual(4, self.db.compact_transaction_log()[0])
+        self.assertEqual([4, 6, 7], self.gens())
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# test__changes.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the generation probe and the changes resource.
+"""
+import json
+
+from mock import Mock
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from leap.soledad.server._changes import ChangesResource
+from leap.soledad.server._changes import GenerationCache
+from leap.soledad.server._changes import SyncInfoProbeResource
+
+
+class _Pool(object):
+    """
+    A pool that runs calls synchronously.
+    """
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        onResult(True, f(*args, **kwargs))
+
+
+def _get_state():
+    state = Mock()
+    state.open_database.return_value._get_generation_info.return_value = \
+        (3, 'T-3')
+    return state
+
+
+class GenerationCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = GenerationCache(expire=60, clock=lambda: self.now)
+
+    def test_get_expired(self):
+        self.cache.update('db', 3, 'T-3')
+        self.assertEqual((3, 'T-3'), self.cache.get('db'))
+        self.now = 61
+        self.assertIsNone(self.cache.get('db'))
+
+    def test_update_ignores_older_generations(self):
+        self.cache.update('db', 3, 'T-3')
+        self.cache.update('db', 2, 'T-2')
+        self.assertEqual((3, 'T-3'), self.cache.get('db'))
+
+    def test_wait(self):
+        self.cache.update('db', 3, 'T-3')
+        d = self.cache.wait('db', 3)
+        self.cache.update('db', 3, 'T-3')
+        self.cache.update('db', 4, 'T-4')
+        d.addCallback(self.assertEqual, (4, 'T-4'))
+        return d
+
+    def test_cancel_wait(self):
+        d = self.cache.wait('db', 3)
+        d.cancel()
+        self.assertEqual({}, dict(self.cache._waiting))
+        return self.assertFailure(d, defer.CancelledError)
+
+
+class SyncInfoProbeResourceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = GenerationCache()
+        self.sync_resource = Mock()
+        self.resource = SyncInfoProbeResource(
+            self.sync_resource, _Pool(), _get_state, cache=self.cache)
+
+    def _request(self, etag):
+        request = DummyRequest(['user-db', 'sync-from', 'source-id'])
+        request.requestHeaders.setRawHeaders('if-none-match', [etag])
+        return request
+
+    def test_not_modified(self):
+        self.cache.update('user-db', 3, 'T-3')
+        request = self._request('"3-T-3"')
+        self.resource.render_GET(request)
+        self.assertEqual(304, request.responseCode)
+        self.assertEqual(1, request.finished)
+        self.assertFalse(self.sync_resource.render.called)
+
+    def test_modified(self):
+        self.cache.update('user-db', 4, 'T-4')
+        request = self._request('"3-T-3"')
+        self.resource.render_GET(request)
+        self.sync_resource.render.assert_called_once_with(request)
+
+    def test_not_modified_read_from_couch(self):
+        request = self._request('"3-T-3"')
+        d = request.notifyFinish()
+        self.resource.render_GET(request)
+
+        def check(_):
+            self.assertEqual(304, request.responseCode)
+            self.assertEqual((3, 'T-3'), self.cache.get('user-db'))
+
+        d.addCallback(check)
+        return d
+
+
+class ChangesResourceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = GenerationCache()
+        self.clock = task.Clock()
+        self.resource = ChangesResource(
+            _Pool(), _get_state, cache=self.cache, timeout=10,
+            clock=self.clock)
+
+    def _request(self, generation):
+        request = DummyRequest(['uuid'])
+        request.args = {'generation': [generation]}
+        return request
+
+    def _check_response(self, _, request, generation):
+        response = json.loads(''.join(request.written))
+        self.assertEqual(
+            {'generation': generation, 'transaction_id': 'T-%d' % generation},
+            response)
+
+    def test_generation_already_advanced(self):
+        self.cache.update('user-uuid', 3, 'T-3')
+        request = self._request('2')
+        self.resource.render_GET(request)
+        self._check_response(None, request, 3)
+
+    def test_wait_for_changes(self):
+        self.cache.update('user-uuid', 3, 'T-3')
+        request = self._request('3')
+        d = request.notifyFinish()
+        self.resource.render_GET(request)
+        self.assertEqual([], request.written)
+        self.cache.update('user-uuid', 4, 'T-4')
+        d.addCallback(self._check_response, request, 4)
+        return d
+
+    def test_timeout(self):
+        self.cache.update('user-uuid', 2, 'T-2')
+        request = self._request('2')
+        d = request.notifyFinish()
+        self.resource.render_GET(request)
+        self.clock.advance(10)
+        # the generation is read from couch after the timeout
+        d.addCallback(self._check_response, request, 3)
+        return d
+
+    def test_client_disconnected(self):
+        self.cache.update('user-uuid', 3, 'T-3')
+        request = self._request('3')
+        self.resource.render_GET(request)
+        request.processingFailed(Exception('connection lost'))
+        self.assertEqual({}, dict(self.cache._waiting))
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_bad_generation(self):
+        request = self._request('x')
+        self.resource.render_GET(request)
+        self.assertEqual(400, request.responseCode)
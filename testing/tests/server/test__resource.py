@@ -17,14 +17,18 @@
 """
 Tests for Soledad server main resource.
 """
+from mock import Mock
 from twisted.trial import unittest
 from twisted.web.test.test_web import DummyRequest
 from twisted.web.wsgi import WSGIResource
 from twisted.web.resource import getChildForRequest
 from twisted.internet import reactor
 
+from leap.soledad.server._changes import ChangesResource
+from leap.soledad.server._changes import SyncInfoProbeResource
 from leap.soledad.server._resource import SoledadResource
 from leap.soledad.server._server_info import ServerInfo
+from leap.soledad.server._wsgi import REQUEST_ID_HEADER
 from leap.soledad.server._blobs import BlobsResource
 from leap.soledad.server.gzip_middleware import GzipMiddleware
 
@@ -58,7 +62,7 @@ class SoledadResourceTestCase(unittest.TestCase):
         child = getChildForRequest(resource, request)
         # if blobs is disabled, the request should be routed to sync
         self.assertIsInstance(child, WSGIResource)
-        self.assertIsInstance(child._application, GzipMiddleware)
+        self.assertIsInstance(child._application.app, GzipMiddleware)
 
     def test_get_sync(self):
         blobs_resource = None  # doesn't matter
@@ -67,4 +71,34 @@ class SoledadResourceTestCase(unittest.TestCase):
         request = DummyRequest(['user-db', 'sync-from', 'source-id'])
         child = getChildForRequest(resource, request)
         self.assertIsInstance(child, WSGIResource)
-        self.assertIsInstance(child._application, GzipMiddleware)
+        self.assertIsInstance(child._application.app, GzipMiddleware)
+
+    def test_get_sync_info_conditionally(self):
+        resource = SoledadResource(sync_pool=_pool)
+        request = DummyRequest(['user-db', 'sync-from', 'source-id'])
+        request.requestHeaders.setRawHeaders('if-none-match', ['"1-T-1"'])
+        child = getChildForRequest(resource, request)
+        self.assertIsInstance(child, SyncInfoProbeResource)
+
+    def test_get_changes(self):
+        resource = SoledadResource(sync_pool=_pool)
+        request = DummyRequest(['changes', 'uuid'])
+        child = getChildForRequest(resource, request)
+        self.assertIsInstance(child, ChangesResource)
+
+    def test_user_db_is_throttled(self):
+        throttle = Mock()
+        resource = SoledadResource(sync_pool=_pool, throttle=throttle)
+        request = DummyRequest(['user-db', 'sync-from', 'source-id'])
+        getChildForRequest(resource, request)
+        throttle.throttle.assert_called_once_with(request, 'user-db')
+        # the body of throttled responses is produced from the reactor
+        self.assertTrue(request.getHeader(REQUEST_ID_HEADER))
+
+    def test_shared_db_is_not_throttled(self):
+        throttle = Mock()
+        resource = SoledadResource(sync_pool=_pool, throttle=throttle)
+        request = DummyRequest(['shared', 'doc', 'some-doc'])
+        getChildForRequest(resource, request)
+        self.assertFalse(throttle.throttle.called)
+        self.assertIsNone(request.getHeader(REQUEST_ID_HEADER))
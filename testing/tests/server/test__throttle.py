@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# test__throttle.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for rate limiting of responses.
+"""
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from leap.soledad.server._throttle import CHUNK_SIZE
+from leap.soledad.server._throttle import HIGH_WATER_MARK
+from leap.soledad.server._throttle import LOW_WATER_MARK
+from leap.soledad.server._throttle import Throttle
+from leap.soledad.server._throttle import TokenBucket
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_delay(self):
+        clock = task.Clock()
+        bucket = TokenBucket(100, clock=clock)
+        self.assertEqual(0, bucket.delay(100))
+        bucket.consume(300)
+        self.assertEqual(3, bucket.delay(100))
+        clock.advance(1)
+        self.assertEqual(1.5, bucket.delay(50))
+        # data larger than the burst size waits for a full bucket
+        self.assertEqual(2, bucket.delay(1000))
+        clock.advance(10)
+        self.assertEqual(0, bucket.delay(100))
+
+
+class ThrottleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def _request(self, throttle, user='user-db'):
+        request = _Request([''])
+        throttle.throttle(request, user)
+        return request
+
+    def test_rate_limit(self):
+        throttle = Throttle(user_rate=100, clock=self.clock)
+        request = self._request(throttle)
+        for _ in range(3):
+            request.write('a' * 100)
+        request.finish()
+        # writes return immediately, data is delivered by the reactor
+        self.assertEqual(0, request.finished)
+        self.clock.advance(0)
+        self.assertEqual(['a' * 100], request.written)
+        self.clock.advance(1)
+        self.assertEqual(['a' * 100] * 2, request.written)
+        self.clock.advance(1)
+        self.assertEqual(['a' * 100] * 3, request.written)
+        self.assertEqual(1, request.finished)
+
+    def test_global_rate_limit(self):
+        throttle = Throttle(global_rate=100, clock=self.clock)
+        first = self._request(throttle, 'user-1')
+        second = self._request(throttle, 'user-2')
+        first.write('a' * 100)
+        second.write('b' * 100)
+        self.clock.advance(0)
+        self.assertEqual(['a' * 100], first.written)
+        self.assertEqual([], second.written)
+        self.clock.advance(1)
+        self.assertEqual(['b' * 100], second.written)
+
+    def test_users_are_limited_separately(self):
+        throttle = Throttle(user_rate=100, clock=self.clock)
+        first = self._request(throttle, 'user-1')
+        second = self._request(throttle, 'user-2')
+        first.write('a' * 100)
+        second.write('b' * 100)
+        self.clock.advance(0)
+        self.assertEqual(['a' * 100], first.written)
+        self.assertEqual(['b' * 100], second.written)
+
+    def test_no_limit(self):
+        throttle = Throttle(clock=self.clock)
+        request = self._request(throttle)
+        request.write('a' * 1000)
+        request.finish()
+        self.assertEqual(['a' * 1000], request.written)
+        self.assertEqual(1, request.finished)
+
+    def test_connection_lost(self):
+        throttle = Throttle(user_rate=100, clock=self.clock)
+        request = self._request(throttle)
+        for _ in range(3):
+            request.write('a' * 100)
+        self.clock.advance(0)
+        request.processingFailed(Exception('connection lost'))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_full_queue_pauses_producer(self):
+        throttle = Throttle(user_rate=CHUNK_SIZE, clock=self.clock)
+        request = self._request(throttle)
+        producer = _Producer()
+        request.registerProducer(producer, True)
+        for _ in range(HIGH_WATER_MARK):
+            request.write('a' * CHUNK_SIZE)
+        self.assertEqual([], producer.calls)
+        request.write('a' * CHUNK_SIZE)
+        self.assertEqual(['pause'], producer.calls)
+        # the producer resumes once the queue is down to the low water mark
+        self.clock.advance(0)
+        for _ in range(HIGH_WATER_MARK - LOW_WATER_MARK):
+            self.assertEqual(['pause'], producer.calls)
+            self.clock.advance(1)
+        self.assertEqual(['pause', 'resume'], producer.calls)
+
+    def test_connection_lost_does_not_resume_producer(self):
+        throttle = Throttle(user_rate=CHUNK_SIZE, clock=self.clock)
+        request = self._request(throttle)
+        producer = _Producer()
+        request.registerProducer(producer, True)
+        for _ in range(HIGH_WATER_MARK + 1):
+            request.write('a' * CHUNK_SIZE)
+        request.processingFailed(Exception('connection lost'))
+        self.assertEqual(['pause'], producer.calls)
+
+    def test_producer_is_paused_by_transport_or_full_queue(self):
+        throttle = Throttle(user_rate=CHUNK_SIZE, clock=self.clock)
+        request = self._request(throttle)
+        producer = _Producer()
+        request.registerProducer(producer, True)
+        # the transport sees the throttle as the producer
+        transport = request.producer
+        transport.pauseProducing()
+        for _ in range(HIGH_WATER_MARK + 1):
+            request.write('a' * CHUNK_SIZE)
+        transport.resumeProducing()
+        self.assertEqual(['pause'], producer.calls)
+        self.clock.advance(0)
+        for _ in range(HIGH_WATER_MARK - LOW_WATER_MARK):
+            self.clock.advance(1)
+        self.assertEqual(['pause', 'resume'], producer.calls)
+
+
+class _Request(DummyRequest):
+
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class _Producer(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+    def resumeProducing(self):
+        self.calls.append('resume')
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# test__wsgi.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the production of response bodies from the reactor.
+"""
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from leap.soledad.server import _wsgi
+from leap.soledad.server._throttle import CHUNK_SIZE
+from leap.soledad.server._throttle import HIGH_WATER_MARK
+from leap.soledad.server._throttle import Throttle
+from leap.soledad.server._wsgi import BODY_CHUNK_SIZE
+from leap.soledad.server._wsgi import REQUEST_ID_ENVIRON
+from leap.soledad.server._wsgi import REQUEST_ID_HEADER
+from leap.soledad.server._wsgi import _ProducedBodies
+from leap.soledad.server._wsgi import produce_from_reactor
+
+
+class ProducedBodiesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = _Pool()
+        self.patch(_wsgi, 'reactor', _Reactor())
+        self.produced = []
+        self.closed = []
+
+    def _app(self, environ, start_response):
+        start_response('200 OK', [])
+        return self._body()
+
+    def _body(self):
+        try:
+            for _ in range(4 * HIGH_WATER_MARK):
+                self.produced.append(BODY_CHUNK_SIZE)
+                yield 'a' * BODY_CHUNK_SIZE
+        finally:
+            self.closed.append(True)
+
+    def _request(self):
+        request = _Request([''])
+        throttle = Throttle(user_rate=CHUNK_SIZE, clock=self.clock)
+        throttle.throttle(request, 'user-db')
+        produce_from_reactor(request)
+        return request
+
+    def _call(self, request):
+        environ = {REQUEST_ID_ENVIRON: request.getHeader(REQUEST_ID_HEADER)}
+        app = _ProducedBodies(self._app, self.pool)
+        return app(environ, lambda status, headers: None)
+
+    def test_throttled_download_releases_worker_thread(self):
+        request = self._request()
+        self.assertEqual([], self._call(request))
+        # the worker thread returns before the body is produced
+        self.assertEqual([], self.produced)
+        # and the body is read a chunk at a time when the response finishes
+        request.finish()
+        self.pool.run()
+        self.assertEqual(HIGH_WATER_MARK + 1, len(self.produced))
+        # no reads wait in the pool while the throttled queue is full
+        self.assertEqual([], self.pool.calls)
+        self.assertEqual(0, request.finished)
+        while not request.finished:
+            self.clock.advance(1)
+            self.pool.run()
+        self.assertEqual(4 * HIGH_WATER_MARK, len(self.produced))
+        self.assertEqual(
+            4 * HIGH_WATER_MARK * BODY_CHUNK_SIZE,
+            sum(len(data) for data in request.written))
+        self.assertEqual([True], self.closed)
+        self.assertIsNone(request.producer)
+
+    def test_connection_lost_stops_production(self):
+        request = self._request()
+        self._call(request)
+        request.finish()
+        self.pool.run()
+        request.processingFailed(Exception('connection lost'))
+        self.clock.advance(10)
+        self.pool.run()
+        self.assertEqual(HIGH_WATER_MARK + 1, len(self.produced))
+        self.assertEqual([True], self.closed)
+
+    def test_other_requests_are_not_handed_over(self):
+        body = self._call(_Request(['']))
+        self.assertEqual(4 * HIGH_WATER_MARK, len(list(body)))
+        self.assertEqual([], self.pool.calls)
+
+
+class _Request(DummyRequest):
+
+    producer = None
+    streamingProducer = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer, self.streamingProducer = producer, streaming
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class _Reactor(object):
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class _Pool(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.calls.append((onResult, f, args, kwargs))
+
+    def run(self):
+        while self.calls:
+            onResult, f, args, kwargs = self.calls.pop(0)
+            onResult(True, f(*args, **kwargs))
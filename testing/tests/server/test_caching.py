@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# test_caching.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the stores of sync session state.
+"""
+import os
+import pytest
+
+from twisted.trial import unittest
+from zope.interface.verify import verifyObject
+
+from leap.soledad.server.caching import ISyncStateStore
+from leap.soledad.server.caching import MemorySyncStateStore
+from leap.soledad.server.caching import SQLiteSyncStateStore
+
+
+class MemorySyncStateStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.store = MemorySyncStateStore(
+            max_size=10000, clock=lambda: self.now)
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(ISyncStateStore, self.store))
+
+    def test_namespace(self):
+        namespace = self.store.namespace('ns')
+        self.assertNotIn('key', namespace)
+        namespace['key'] = ('a', 1)
+        self.assertIs(namespace, self.store.namespace('ns'))
+        self.assertEqual(('a', 1), self.store.namespace('ns')['key'])
+        self.assertEqual({'key': ('a', 1)}, namespace.as_dict())
+        self.assertRaises(KeyError, namespace.__getitem__, 'other')
+
+    def test_memory_usage(self):
+        usage = self.store.memory_usage()
+        namespace = self.store.namespace('ns')
+        namespace['key'] = 'x' * 1000
+        self.assertGreater(self.store.memory_usage(), usage + 1000)
+        namespace['key'] = 'x'
+        self.assertLess(self.store.memory_usage(), usage + 1000)
+
+    def test_least_recently_used_are_evicted(self):
+        for name in ('first', 'second', 'third'):
+            self.store.namespace(name)['key'] = 'x' * 3000
+        # use the first namespace, so the second is the least recently used
+        self.store.namespace('first')['key']
+        self.store.namespace('fourth')['key'] = 'x' * 3000
+        self.assertIn('key', self.store.namespace('first'))
+        self.assertNotIn('key', self.store.namespace('second'))
+        self.assertLessEqual(self.store.memory_usage(), 10000)
+
+    def test_expire(self):
+        self.store.namespace('ns', expire=10)['key'] = 'value'
+        self.now = 5
+        self.assertIn('key', self.store.namespace('ns'))
+        self.now = 14
+        self.assertIn('key', self.store.namespace('ns'))
+        self.now = 30
+        self.assertNotIn('key', self.store.namespace('ns'))
+
+
+@pytest.mark.usefixtures('method_tmpdir')
+class SQLiteSyncStateStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.path = os.path.join(self.tempdir, 'sync-state.db')
+        self.store = SQLiteSyncStateStore(self.path, clock=lambda: self.now)
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(ISyncStateStore, self.store))
+
+    def test_namespace(self):
+        namespace = self.store.namespace('ns')
+        self.assertNotIn('key', namespace)
+        namespace['key'] = ('a', 1)
+        self.assertEqual(['a', 1], self.store.namespace('ns')['key'])
+        self.assertEqual({'key': ['a', 1]}, namespace.as_dict())
+        self.assertEqual({}, self.store.namespace('other').as_dict())
+        self.assertRaises(KeyError, namespace.__getitem__, 'other')
+
+    def test_shared_by_stores(self):
+        self.store.namespace('ns')['key'] = 'value'
+        other = SQLiteSyncStateStore(self.path, clock=lambda: self.now)
+        self.assertEqual('value', other.namespace('ns')['key'])
+
+    def test_expire(self):
+        self.store.namespace('ns', expire=10)['key'] = 'value'
+        self.now = 5
+        self.assertIn('key', self.store.namespace('ns'))
+        self.now = 100
+        self.assertNotIn('key', self.store.namespace('ns'))
+        rows = self.store._execute('SELECT * FROM state').fetchall()
+        self.assertEqual([], rows)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# test_compaction.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the compaction of transaction logs of user databases.
+"""
+from six import StringIO
+
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.trial import unittest
+
+from leap.soledad.server import compaction
+
+
+class _Database(object):
+
+    def __init__(self, removed, error=None):
+        self.removed = removed
+        self.error = error
+        self.calls = []
+
+    def compact_transaction_log(self, dry_run=False):
+        self.calls.append(('compact_transaction_log', dry_run))
+        if self.error is not None:
+            raise self.error
+        return self.removed, self.removed * 100
+
+    def compact_database(self):
+        self.calls.append(('compact_database',))
+
+
+class CompactionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dbs = {'user-a': _Database(3), 'user-b': _Database(0)}
+        self.patch(compaction, 'list_users_dbs',
+                   lambda couch_url: sorted(self.dbs))
+        self.patch(compaction, 'CouchDatabase',
+                   lambda couch_url, dbname: self.dbs[dbname])
+
+    def main(self, *argv):
+        out = StringIO()
+        status = compaction.main(
+            ['--couch-url', 'http://localhost:5984'] + list(argv), out=out)
+        return status, out.getvalue()
+
+    def test_report(self):
+        status, out = self.main()
+        self.assertEqual(0, status)
+        self.assertEqual('user-a: 3 gen docs, 300 bytes\n'
+                         'total: 3 gen docs, 300 bytes removed\n', out)
+        self.assertEqual([('compact_transaction_log', False)],
+                         self.dbs['user-a'].calls)
+
+    def test_dry_run(self):
+        _, out = self.main('--dry-run', '--compact')
+        self.assertIn('would be removed', out)
+        self.assertEqual([('compact_transaction_log', True)],
+                         self.dbs['user-a'].calls)
+
+    def test_databases_are_compacted(self):
+        self.main('--compact')
+        self.assertEqual(
+            [('compact_transaction_log', False), ('compact_database',)],
+            self.dbs['user-a'].calls)
+        # nothing was removed from this one
+        self.assertEqual([('compact_transaction_log', False)],
+                         self.dbs['user-b'].calls)
+
+    def test_errors_do_not_stop_compaction(self):
+        self.dbs['user-a'].error = ValueError()
+        self.dbs['user-c'] = _Database(2)
+        status, out = self.main()
+        self.assertEqual(1, status)
+        self.assertIn('user-a: error', out)
+        self.assertIn('total: 2 gen docs, 200 bytes removed', out)
+        self.flushLoggedErrors(ValueError)
+
+    def test_schedule(self):
+        self.patch(compaction.threads, 'deferToThread', defer.maybeDeferred)
+        clock = task.Clock()
+        conf = {'couch_url': 'http://localhost:5984', 'compaction_interval': 0}
+        self.assertIsNone(compaction.schedule_compaction(conf, clock=clock))
+        conf['compaction_interval'] = 60
+        call = compaction.schedule_compaction(conf, clock=clock)
+        self.addCleanup(call.stop)
+        self.assertEqual([], self.dbs['user-a'].calls)
+        clock.advance(60)
+        self.assertEqual([('compact_transaction_log', False)],
+                         self.dbs['user-a'].calls)
+        # a failed compaction does not stop the schedule
+        self.dbs['user-a'].error = ValueError()
+        clock.advance(60)
+        clock.advance(60)
+        self.assertEqual(3, len(self.dbs['user-a'].calls))
+        self.flushLoggedErrors(ValueError)
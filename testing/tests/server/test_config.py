@@ -65,5 +65,13 @@ class ConfigurationParsingTest(unittest.TestCase):
                     '/etc/couchdb/couchdb-soledad-admin.netrc',
                     'batching': False,
                     'blobs': False,
-                    'blobs_path': '/srv/leap/soledad/blobs'}
+                    'blobs_path': '/srv/leap/soledad/blobs',
+                    'gzip_level': 1,
+                    'gzip_min_size': 1024,
+                    'sync_user_rate': 5 * 1024 * 1024,
+                    'sync_global_rate': 0,
+                    'sync_state_store': 'memory',
+                    'sync_state_max_size': 128 * 1024 * 1024,
+                    'sync_state_path': '/srv/leap/soledad/sync-state.db',
+                    'compaction_interval': 0}
         self.assertDictEqual(expected, config['soledad-server'])
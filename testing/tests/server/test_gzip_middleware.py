@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# test_gzip_middleware.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the gzip middleware.
+"""
+import zlib
+
+from twisted.trial import unittest
+
+from leap.soledad.server.gzip_middleware import GzipMiddleware
+
+
+CHUNK = '{"id": "doc", "content": "%s"}\r\n' % ('a' * 100)
+
+
+def _decompress(data):
+    return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+
+
+class GzipMiddlewareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.written = []
+        self.headers = None
+
+    def start_response(self, status, headers, exc_info=None):
+        self.headers = dict((k.lower(), v) for k, v in headers)
+        return self.written.append
+
+    def call(self, app, accept_encoding='gzip, deflate', **kwargs):
+        middleware = GzipMiddleware(app, min_size=1024, **kwargs)
+        environ = {'HTTP_ACCEPT_ENCODING': accept_encoding}
+        body = list(middleware(environ, self.start_response))
+        return ''.join(self.written + body)
+
+    def streaming_app(self, headers, chunks=100):
+        def app(environ, start_response):
+            write = start_response('200 OK', headers)
+            for _ in range(chunks):
+                write(CHUNK)
+            return []
+        return app
+
+    def test_no_gzip_accepted(self):
+        body = self.call(
+            self.streaming_app([('content-type', 'application/json')]),
+            accept_encoding='')
+        self.assertEqual(CHUNK * 100, body)
+        self.assertNotIn('content-encoding', self.headers)
+
+    def test_stream_is_compressed(self):
+        body = self.call(
+            self.streaming_app([('content-type', 'application/json')]))
+        self.assertEqual('gzip', self.headers['content-encoding'])
+        self.assertNotIn('content-length', self.headers)
+        self.assertEqual(CHUNK * 100, _decompress(body))
+        self.assertLess(len(body), len(CHUNK) * 10)
+
+    def test_stream_is_flushed_while_written(self):
+        received = []
+
+        def app(environ, start_response):
+            write = start_response(
+                '200 OK', [('content-type', 'application/json')])
+            for _ in range(100):
+                write(CHUNK)
+            # compressed data reached the client before the response ended
+            received.append(_decompress(''.join(self.written)))
+            return []
+
+        body = self.call(app, flush_size=len(CHUNK) * 10)
+        self.assertEqual(CHUNK * 100, _decompress(body))
+        self.assertEqual(CHUNK * 100, received[0])
+
+    def test_compressed_iterable(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('content-type', 'application/json'),
+                                      ('content-length', '%d' % 2000)])
+            return ['a' * 1000, 'b' * 1000]
+
+        body = self.call(app)
+        self.assertEqual('gzip', self.headers['content-encoding'])
+        self.assertNotIn('content-length', self.headers)
+        self.assertEqual('a' * 1000 + 'b' * 1000, _decompress(body))
+
+    def test_small_response_is_not_compressed(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('content-type', 'application/json'),
+                                      ('content-length', '2')])
+            return ['{}']
+
+        self.assertEqual('{}', self.call(app))
+        self.assertEqual('2', self.headers['content-length'])
+        self.assertNotIn('content-encoding', self.headers)
+
+    def test_small_stream_is_not_compressed(self):
+        body = self.call(self.streaming_app(
+            [('content-type', 'application/json')], chunks=2))
+        self.assertEqual(CHUNK * 2, body)
+        self.assertNotIn('content-encoding', self.headers)
+
+    def test_encrypted_stream_is_not_compressed(self):
+        body = self.call(self.streaming_app(
+            [('content-type',
+              'application/x-u1db-sync-response; framing=binary')]))
+        self.assertEqual(CHUNK * 100, body)
+        self.assertNotIn('content-encoding', self.headers)
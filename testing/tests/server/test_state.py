@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# test_state.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the server side sync session state.
+"""
+import os
+import pytest
+
+from uuid import uuid4
+
+from twisted.trial import unittest
+
+from leap.soledad.server import caching
+from leap.soledad.server.state import ServerSyncState
+
+
+CHANGES = [('doc-%d' % i, i, 'trans-%d' % i) for i in range(1, 6)]
+
+
+class ServerSyncStateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sync_id = str(uuid4())
+        self.state = ServerSyncState('source', self.sync_id)
+
+    def test_seen_ids(self):
+        self.assertEqual({}, self.state.seen_ids())
+        self.state.put_seen_id('a', 2)
+        self.state.put_seen_id('b', 3)
+        self.state.put_seen_id('a', 1)
+        self.assertEqual({'a': 2, 'b': 3}, self.state.seen_ids())
+
+    def test_state_is_shared_by_the_session(self):
+        self.state.put_seen_id('a', 2)
+        self.state.put_changes_to_return(5, 'trans-5', CHANGES)
+        state = ServerSyncState('source', self.sync_id)
+        self.assertEqual({'a': 2}, state.seen_ids())
+        self.assertEqual((5, 'trans-5', 5), state.sync_info())
+        other = ServerSyncState('source', str(uuid4()))
+        self.assertEqual({}, other.seen_ids())
+        self.assertEqual((None, None, None), other.sync_info())
+
+    def test_changes_to_return(self):
+        self.assertIsNone(self.state.changes_to_return())
+        self.state.put_changes_to_return(5, 'trans-5', CHANGES)
+        self.assertEqual(CHANGES, self.state.changes_to_return())
+        self.assertEqual(CHANGES[2:], self.state.changes_to_return(2))
+
+    def test_next_change_to_return(self):
+        self.assertEqual(
+            (None, None, None), self.state.next_change_to_return(0))
+        self.state.put_changes_to_return(5, 'trans-5', CHANGES)
+        self.assertEqual(
+            (5, 'trans-5', CHANGES[3]), self.state.next_change_to_return(3))
+        self.assertEqual(
+            (5, 'trans-5', None), self.state.next_change_to_return(5))
+
+
+@pytest.mark.usefixtures('method_tmpdir')
+class SQLiteServerSyncStateTestCase(ServerSyncStateTestCase):
+
+    def setUp(self):
+        store = caching.SQLiteSyncStateStore(
+            os.path.join(self.tempdir, 'sync-state.db'))
+        self.patch(caching, '_store', store)
+        ServerSyncStateTestCase.setUp(self)
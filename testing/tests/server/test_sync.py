@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# test_sync.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for server side synchronization.
+"""
+import base64
+import json
+import os
+import pytest
+
+from six import StringIO
+from uuid import uuid4
+
+from mock import Mock
+from twisted.trial import unittest
+
+from leap.soledad.common.backend import SoledadBackend
+from leap.soledad.common.errors import SyncStateMismatchError
+from leap.soledad.common.l2db.remote import http_app
+from leap.soledad.common.l2db.remote import utils
+from leap.soledad.server import HTTPInvocationByMethodWithBody
+from leap.soledad.server import caching
+from leap.soledad.server.sync import SyncExchange
+from leap.soledad.server.sync import SyncResource
+from test_soledad.fake_couch import FakeCouchDatabase
+from test_soledad.fake_couch import make_couch_database
+
+
+CHANGES = [('doc-%d' % i, i, 'trans-%d' % i) for i in range(1, 6)]
+
+
+class SyncExchangeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Mock()
+        self.db.iter_whats_changed.side_effect = \
+            lambda gen: (5, 'trans-5', iter(CHANGES))
+        self.sync_id = str(uuid4())
+
+    def _exchange(self, last_known_generation):
+        return SyncExchange(
+            self.db, 'source', last_known_generation, self.sync_id)
+
+    def test_find_changes_to_return(self):
+        exch = self._exchange(0)
+        self.assertEqual((5, 5), exch.find_changes_to_return())
+        self.assertEqual(CHANGES, exch.changes_to_return)
+
+    def test_resumed_session_skips_received_changes(self):
+        self._exchange(0).find_changes_to_return()
+        # the source received 2 docs before the session was interrupted
+        exch = self._exchange(2)
+        self.assertEqual((5, 3), exch.find_changes_to_return(received=2))
+        self.assertEqual(CHANGES[2:], exch.changes_to_return)
+        self.assertEqual(1, self.db.iter_whats_changed.call_count)
+
+    def test_received_offset_is_bounded_by_known_generation(self):
+        self._exchange(0).find_changes_to_return()
+        exch = self._exchange(1)
+        self.assertEqual((5, 4), exch.find_changes_to_return(received=2))
+        self.assertEqual(CHANGES[1:], exch.changes_to_return)
+
+
+class SyncResourceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Mock(_replica_uid='target')
+        self.db._get_replica_gen_and_trans_id.return_value = (3, 'T-3')
+        self.resource = SyncResource('db', 'source', Mock(), Mock())
+
+    def test_record_source_info(self):
+        self.resource._record_source_info(
+            self.db, 'target', (3, 'T-3'), (None, None))
+        self.assertFalse(self.db._set_replica_gen_and_trans_id.called)
+        self.resource._record_source_info(
+            self.db, 'target', (3, 'T-3'), (5, 'T-5'))
+        self.db._set_replica_gen_and_trans_id.assert_called_once_with(
+            'source', 5, 'T-5')
+
+    def test_record_source_info_already_recorded(self):
+        self.resource._record_source_info(
+            self.db, 'target', (1, 'T-1'), (3, 'T-3'))
+        self.assertFalse(self.db._set_replica_gen_and_trans_id.called)
+
+    def test_record_source_info_mismatch(self):
+        self.assertRaises(
+            SyncStateMismatchError, self.resource._record_source_info,
+            self.db, 'target', (2, 'T-2'), (None, None))
+        self.assertRaises(
+            SyncStateMismatchError, self.resource._record_source_info,
+            self.db, 'other', (3, 'T-3'), (None, None))
+        self.assertFalse(self.db._set_replica_gen_and_trans_id.called)
+
+    def test_known_generation_is_recorded_when_the_sync_finishes(self):
+        self.resource.sync_exch = Mock(
+            _db=self.db, source_last_known_generation=4, new_trans_id='T-5')
+        self.resource.sync_exch.find_changes_to_return.return_value = (5, 0)
+        self.resource.sync_exch.iter_docs.return_value = iter([])
+        self.resource.responder = Mock()
+        self.resource._received = 0
+        self.resource.post_get()
+        # the changes are returned as the response body is consumed
+        self.assertFalse(self.db.set_replica_known_generation.called)
+        list(self.resource.responder.content)
+        self.db.set_replica_known_generation.assert_called_once_with(
+            'source', 4)
+
+
+@pytest.mark.usefixtures('method_tmpdir')
+class SQLiteSyncResourceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        store = caching.SQLiteSyncStateStore(
+            os.path.join(self.tempdir, 'sync-state.db'))
+        self.patch(caching, '_store', store)
+        self.fake = FakeCouchDatabase()
+        self.resource = SyncResource('db', 'source', Mock(), Mock())
+
+    def _db(self):
+        # each request of a sync opens the database and shares its cache
+        db = SoledadBackend(
+            make_couch_database(self.fake), replica_uid='target')
+        db.init_caching(caching.get_cache_for('db-sync-id'))
+        return db
+
+    def test_record_source_info_from_shared_cache(self):
+        self.resource._record_source_info(
+            self._db(), 'target', (0, ''), (3, 'T-3'))
+        # a resumed request whose pending generation was already recorded
+        self.resource._record_source_info(
+            self._db(), 'target', (1, 'T-1'), (3, 'T-3'))
+        self.resource._record_source_info(
+            self._db(), 'target', (3, 'T-3'), (None, None))
+        self.assertEqual(
+            (3, 'T-3'), self._db()._get_replica_gen_and_trans_id('source'))
+
+
+RAW = utils.RawContent('EzcBpreamble \x00\xff\r\nciphertext')
+ARMORED = '{"raw": "EzcBpreamble %s"}' % base64.urlsafe_b64encode(
+    '\x00\xff\r\nciphertext')
+
+
+class BinaryFramingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.written = []
+        self.resource = Mock(max_request_size=2 ** 20, max_entry_size=2 ** 20)
+        self.resource.responder = http_app.HTTPResponder(self.start_response)
+
+    def start_response(self, status, headers):
+        self.status = status
+        self.headers = dict(headers)
+        return self.written.append
+
+    def invoke(self, frames, content_type):
+        body = ''.join(frames)
+        environ = {
+            'QUERY_STRING': '', 'REQUEST_METHOD': 'POST',
+            'CONTENT_LENGTH': str(len(body)), 'CONTENT_TYPE': content_type,
+            'wsgi.input': StringIO(body)}
+        HTTPInvocationByMethodWithBody(
+            self.resource, environ, self.resource)()
+
+    def test_unarmor_content(self):
+        self.assertEqual(RAW, utils.unarmor_content(ARMORED))
+        self.assertEqual(ARMORED, utils.armor_content(RAW))
+        # contents that would not be armored back exactly are kept as they are
+        self.assertIsNone(utils.unarmor_content('{"raw": "EzcB a\nb"}'))
+        self.assertIsNone(utils.unarmor_content('{"raw": "EzcB"}'))
+        self.assertIsNone(utils.unarmor_content('{"raw": "other YQ=="}'))
+
+    def test_put_docs(self):
+        self.invoke([
+            utils.frame_entry({'last_known_generation': 0}),
+            utils.frame_entry({'id': 'a'}),
+            utils.frame(utils.FRAME_RAW, RAW),
+            utils.frame_entry({'id': 'b'}),
+            utils.frame(utils.FRAME_JSON),
+            utils.frame(utils.FRAME_END)],
+            'application/x-soledad-sync-put; framing=binary')
+        self.resource.post_args.assert_called_once_with(
+            {}, '{"last_known_generation": 0}')
+        self.assertEqual([
+            (({'content': ARMORED}, '{"id": "a"}'),),
+            (({'content': None}, '{"id": "b"}'),)],
+            self.resource.post_put.call_args_list)
+        self.assertTrue(self.resource.post_end.called)
+        self.assertTrue(self.resource.responder.binary_framing)
+
+    def test_put_bad_raw_content(self):
+        self.assertRaises(
+            http_app.BadRequest, self.invoke, [
+                utils.frame_entry({'last_known_generation': 0}),
+                utils.frame_entry({'id': 'a'}),
+                utils.frame(utils.FRAME_RAW, 'no preamble'),
+                utils.frame(utils.FRAME_END)],
+            'application/x-soledad-sync-put; framing=binary')
+
+    def test_put_truncated_stream(self):
+        self.assertRaises(
+            http_app.BadRequest, self.invoke, [
+                utils.frame_entry({'last_known_generation': 0}),
+                utils.frame_entry({'id': 'a'})],
+            'application/x-soledad-sync-put; framing=binary')
+
+    def test_stream_response(self):
+        responder = self.resource.responder
+        responder.binary_framing = True
+        responder.content_type = 'application/x-u1db-sync-response'
+        responder.start_response(200)
+        responder.start_stream()
+        responder.stream_entry({'new_generation': 1})
+        responder.stream_entry({'id': 'a'})
+        responder.stream_entry(ARMORED)
+        responder.stream_entry({'id': 'b'})
+        responder.stream_entry('{"b": 1}')
+        responder.end_stream()
+        self.assertEqual(
+            'application/x-u1db-sync-response; framing=binary',
+            self.headers['content-type'])
+        self.assertEqual(''.join([
+            utils.frame(utils.FRAME_JSON, json.dumps({'new_generation': 1})),
+            utils.frame(utils.FRAME_JSON, json.dumps({'id': 'a'})),
+            utils.frame(utils.FRAME_RAW, RAW),
+            utils.frame(utils.FRAME_JSON, json.dumps({'id': 'b'})),
+            utils.frame(utils.FRAME_JSON, '{"b": 1}'),
+            utils.frame(utils.FRAME_END)]), ''.join(self.written))
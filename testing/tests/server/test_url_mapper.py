@@ -129,3 +129,13 @@ class URLMapperTestCase(unittest.TestCase):
         dbname = self._dbname
         self.assertIsNone(
             self._urlmap.match('/%s/sync-from/x' % dbname, 'DELETE'))
+
+    def test_changes_authorized(self):
+        match = self._urlmap.match('/changes/%s' % self._uuid, 'GET')
+        self.assertEqual(self._uuid, match.get('uuid'))
+
+    def test_changes_unauthorized(self):
+        path = '/changes/%s' % self._uuid
+        self.assertIsNone(self._urlmap.match(path, 'PUT'))
+        self.assertIsNone(self._urlmap.match(path, 'DELETE'))
+        self.assertIsNone(self._urlmap.match(path, 'POST'))
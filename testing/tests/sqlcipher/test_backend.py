@@ -289,7 +289,7 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
         c.execute("SELECT * FROM u1db_config")
         config = dict([(r[0], r[1]) for r in c.fetchall()])
         replica_uid = self.db._replica_uid
-        self.assertEqual({'sql_schema': '0', 'replica_uid': replica_uid,
+        self.assertEqual({'sql_schema': '4', 'replica_uid': replica_uid,
                           'index_storage': 'expand referenced encrypted'},
                          config)
 
@@ -306,6 +306,269 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
         self.db.put_doc(doc)
         self.assertEqual(True, self.db.get_doc(doc.doc_id).syncable)
 
+    def test_apply_batch(self):
+        self.db.create_index('idx1', 'key')
+        doc1, doc2 = self.db.create_docs([{'key': 'a'}, {'key': 'b'}])
+        doc1.content = {'key': 'c'}
+        doc1.syncable = False
+        docs = self.db.apply_batch([
+            ('put', doc1),
+            ('delete', doc2),
+            ('create', {'key': 'd'}, 'new-doc')])
+        self.assertEqual([doc1.doc_id, doc2.doc_id, 'new-doc'],
+                         [d.doc_id for d in docs])
+        self.assertEqual(
+            [doc1.doc_id, doc2.doc_id, doc1.doc_id, doc2.doc_id, 'new-doc'],
+            [doc_id for doc_id, _ in self.db._get_transaction_log()])
+        self.assertEqual(
+            [doc1.doc_id, 'new-doc'],
+            [d.doc_id for d in self.db.get_from_index('idx1', '*')])
+        self.assertEqual(False, self.db.get_doc(doc1.doc_id).syncable)
+        self.assertIsNone(self.db.get_doc(doc2.doc_id))
+
+    def test_apply_batch_is_atomic(self):
+        doc = self.db.create_doc({'key': 'a'})
+        stale = self.db._factory(doc.doc_id, 'other:1', '{}')
+        self.assertRaises(
+            errors.RevisionConflict, self.db.apply_batch,
+            [('create', {'key': 'b'}, 'new-doc'), ('put', stale)])
+        self.assertIsNone(self.db.get_doc('new-doc'))
+        self.assertEqual(1, self.db._get_generation())
+
+    def test_apply_batch_conflict_leaves_docs_unchanged(self):
+        doc1, doc2 = self.db.create_docs([{'n': 1}, {'n': 2}])
+        rev1, rev2 = doc1.rev, doc2.rev
+        stale = self.db._factory(doc1.doc_id, 'other:1', '{}')
+        self.assertRaises(
+            errors.RevisionConflict, self.db.apply_batch,
+            [('put', doc1), ('delete', doc2), ('put', stale)])
+        self.assertEqual((rev1, {'n': 1}), (doc1.rev, doc1.content))
+        self.assertEqual((rev2, {'n': 2}), (doc2.rev, doc2.content))
+        self.assertEqual(doc1, self.db.get_doc(doc1.doc_id))
+        self.assertEqual(doc2, self.db.get_doc(doc2.doc_id))
+
+    def test_whats_changed_returns_latest_generations(self):
+        doc1, doc2 = self.db.create_docs([{'n': 1}, {'n': 2}])
+        self.db.put_doc(doc1)
+        self.db.put_docs([doc2, doc1])
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_id, generation, transaction_id"
+                  " FROM doc_latest_generation ORDER BY generation")
+        self.assertEqual(
+            [(doc2.doc_id, 4), (doc1.doc_id, 5)],
+            [(doc_id, gen) for doc_id, gen, _ in c.fetchall()])
+        cur_gen, trans_id, changes = self.db.whats_changed(2)
+        self.assertEqual(5, cur_gen)
+        self.assertEqual(self.db._get_trans_id_for_gen(5), trans_id)
+        self.assertEqual(
+            [(doc2.doc_id, 4), (doc1.doc_id, 5)],
+            [(doc_id, gen) for doc_id, gen, _ in changes])
+
+    def test_compact_transaction_log(self):
+        doc1, doc2 = self.db.create_docs([{'n': 1}, {'n': 2}])
+        self.db.put_doc(doc1)
+        self.db.put_doc(doc2)
+        self.db.put_doc(doc1)
+        expected = self.db.whats_changed()
+        # nothing is known about what the sync targets have seen
+        self.assertEqual(0, self.db.compact_transaction_log())
+        self.db._set_sync_target_info('url-1', 'target-1', 4, 'T-4')
+        self.db._set_sync_target_info('url-2', 'target-2', 3, 'T-3')
+        # generation 3 is superseded but target-2 may still validate it
+        self.assertEqual(2, self.db.compact_transaction_log())
+        self.assertEqual(
+            [doc1.doc_id, doc2.doc_id, doc1.doc_id],
+            [doc_id for doc_id, _ in self.db._get_transaction_log()])
+        self.assertEqual(expected, self.db.whats_changed())
+        self.assertEqual(0, self.db.compact_transaction_log())
+        self.assertEqual(5, self.db._get_generation())
+
+    def get_pages(self, get_page, *args):
+        pages = []
+        after = None
+        while True:
+            docs, after = get_page(*(args + (after,)))
+            pages.append([doc.doc_id for doc in docs])
+            if after is None:
+                return pages
+
+    def test_get_from_index_page(self):
+        self.db.create_index('idx', 'key', 'sub')
+        self.db.create_doc({'key': 'b', 'sub': 'x'}, doc_id='d1')
+        self.db.create_doc({'key': 'a', 'sub': 'x'}, doc_id='d2')
+        self.db.create_doc({'key': ['a', 'c'], 'sub': 'x'}, doc_id='d3')
+        self.db.create_doc({'key': 'a', 'sub': 'y'}, doc_id='d4')
+        self.db.create_doc({'key': 'b', 'sub': 'x'}, doc_id='d5')
+        self.assertEqual(
+            [['d2', 'd3'], ['d4', 'd1'], ['d5']],
+            self.get_pages(
+                self.db.get_from_index_page, 'idx', ('*', '*'), 2))
+        self.assertEqual(
+            [['d2'], ['d3'], []],
+            self.get_pages(
+                self.db.get_from_index_page, 'idx', ('a', 'x'), 1))
+        self.assertEqual(
+            [['d3']],
+            self.get_pages(
+                self.db.get_from_index_page, 'idx', ('c*', '*'), 2))
+
+    def test_get_range_from_index_page(self):
+        self.db.create_index('idx', 'key')
+        for i in range(5):
+            self.db.create_doc({'key': 'k%d' % (4 - i)}, doc_id='d%d' % i)
+        self.assertEqual(
+            [['d3', 'd2'], ['d1']],
+            self.get_pages(
+                self.db.get_range_from_index_page, 'idx', 'k1', 'k3', 2))
+
+    def test_get_docs_in_chunks(self):
+        self.db._max_doc_ids_per_statement = 2
+        for i in range(5):
+            self.db.create_doc({'n': i}, doc_id='d%d' % i)
+        doc = self.db.get_doc('d3')
+        doc.syncable = False
+        self.db.put_doc(doc)
+        alt = SoledadDocument('d1', 'alternate:1', '{}')
+        self.db._put_doc_if_newer(
+            alt, save_conflict=True, replica_uid='r', replica_gen=1,
+            replica_trans_id='T-r')
+        docs = list(self.db.get_docs(['d4', 'd3', 'missing', 'd1', 'd0']))
+        self.assertEqual(['d4', 'd3', 'd1', 'd0'], [d.doc_id for d in docs])
+        self.assertEqual(
+            [False, False, True, False], [d.has_conflicts for d in docs])
+        self.assertEqual(
+            [True, False, True, True], [d.syncable for d in docs])
+
+    def test__put_docs_if_newer_matches_put_doc_if_newer(self):
+        def make_db():
+            db = sqlcipher_open(':memory:', PASSWORD)
+            self.addCleanup(db.close)
+            db._set_replica_uid('local')
+            for doc_id in ('older', 'same', 'conflicted', 'converged'):
+                db.create_doc({'v': 1}, doc_id=doc_id)
+            db.put_doc(db.get_doc('older'))
+            return db
+
+        def batches():
+            return [
+                [('new', 'remote:1', {'v': 1}),
+                 ('older', 'local:1', {'v': 1}),
+                 ('same', 'remote:1', {'v': 1}),
+                 ('conflicted', 'remote:1', {'v': 2}),
+                 ('converged', 'local:1', {'v': 1})],
+                [('conflicted', 'local:1|remote:2', {'v': 3}),
+                 ('new', 'remote:2', {'v': 2})]]
+
+        def apply_docs(db, batches, bulk):
+            states, gen = [], 0
+            for batch in batches:
+                docs = []
+                for doc_id, rev, content in batch:
+                    gen += 1
+                    doc = SoledadDocument(doc_id, rev)
+                    doc.content = content
+                    docs.append((doc, gen, 'T-%d' % gen))
+                if bulk:
+                    states.extend(db._put_docs_if_newer(
+                        docs, save_conflict=True, replica_uid='remote'))
+                else:
+                    for doc, gen, trans_id in docs:
+                        state, _ = db._put_doc_if_newer(
+                            doc, save_conflict=True, replica_uid='remote',
+                            replica_gen=gen, replica_trans_id=trans_id)
+                        states.append(state)
+                yield states, self.get_state(db)
+
+        self.assertEqual(
+            list(apply_docs(make_db(), batches(), False)),
+            list(apply_docs(make_db(), batches(), True)))
+
+    def get_state(self, db):
+        docs = db.get_all_docs(include_deleted=True)[1]
+        return (
+            [(doc.doc_id, doc.rev, doc.content, doc.has_conflicts)
+             for doc in sorted(docs, key=lambda doc: doc.doc_id)],
+            [[(c.rev, c.content) for c in db.get_doc_conflicts(doc.doc_id)]
+             for doc in docs],
+            [doc_id for doc_id, _, _ in db.whats_changed()[2]],
+            db._get_replica_gen_and_trans_id('remote'))
+
+    def test__put_docs_if_newer_validates_source_generation(self):
+        doc = SoledadDocument('doc', 'remote:1')
+        doc.content = {}
+        self.db._put_docs_if_newer(
+            [(doc, 2, 'T-2')], save_conflict=True, replica_uid='remote')
+        self.assertRaises(
+            errors.InvalidGeneration, self.db._put_docs_if_newer,
+            [(doc, 1, 'T-1')], save_conflict=True, replica_uid='remote')
+        self.assertRaises(
+            errors.InvalidTransactionId, self.db._put_docs_if_newer,
+            [(doc, 2, 'T-other')], save_conflict=True, replica_uid='remote')
+
+    def test_sync_checkpoint(self):
+        self.assertIsNone(self.db._get_sync_checkpoint('remote'))
+        self.db._set_sync_checkpoint('remote', 'sync-id')
+        docs = []
+        for i in range(3):
+            doc = SoledadDocument('doc-%d' % i, 'remote:1')
+            doc.content = {}
+            docs.append((doc, i + 1, 'T-%d' % i))
+        self.db._put_docs_if_newer(
+            docs[:2], save_conflict=True, replica_uid='remote',
+            sync_id='sync-id')
+        self.db._put_docs_if_newer(
+            docs[2:], save_conflict=True, replica_uid='remote',
+            sync_id='sync-id')
+        self.assertEqual(
+            ('sync-id', 3), self.db._get_sync_checkpoint('remote'))
+        self.db._clear_sync_checkpoint('remote')
+        self.assertIsNone(self.db._get_sync_checkpoint('remote'))
+
+    def test_sync_target_info(self):
+        self.assertIsNone(self.db._get_sync_target_info('url'))
+        self.db._set_sync_target_info('url', 'remote', 2, 'T-2')
+        self.assertEqual(
+            ('remote', 2, 'T-2', None, None),
+            self.db._get_sync_target_info('url'))
+        self.db._set_sync_target_info('url', 'remote', 2, 'T-2', 3, 'T-3')
+        self.assertEqual(
+            ('remote', 2, 'T-2', 3, 'T-3'),
+            self.db._get_sync_target_info('url'))
+        self.db._clear_sync_target_info('url')
+        self.assertIsNone(self.db._get_sync_target_info('url'))
+
+    def test_get_all_docs_page(self):
+        for i in range(5):
+            self.db.create_doc({}, doc_id='d%d' % i)
+        self.db.delete_doc(self.db.get_doc('d1'))
+        self.assertEqual(
+            [['d0', 'd2'], ['d3', 'd4'], []],
+            self.get_pages(self.db.get_all_docs_page, 2))
+        self.assertEqual(
+            [['d0', 'd1', 'd2'], ['d3', 'd4']],
+            self.get_pages(
+                lambda limit, after: self.db.get_all_docs_page(
+                    limit, after, include_deleted=True), 3))
+
+    def test__ensure_schema_migrates_doc_latest_generation(self):
+        path = self.tempdir + '/migrate.db'
+        db = sqlcipher_open(path, PASSWORD)
+        doc = db.create_doc({'n': 1})
+        db.put_doc(db.create_doc({'n': 2}))
+        db.put_doc(doc)
+        expected = db.whats_changed()
+        c = db._get_sqlite_handle().cursor()
+        c.execute("DROP TABLE doc_latest_generation")
+        c.execute("UPDATE u1db_config SET value = '1'"
+                  " WHERE name = 'sql_schema'")
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlcipher_open(path, PASSWORD, create=False)
+        c = db._get_sqlite_handle().cursor()
+        self.assertEqual(db._schema_version, db._get_schema_version(c))
+        self.assertEqual(expected, db.whats_changed())
+        db.close()
+
     def test__close_sqlite_handle(self):
         raw_db = self.db._get_sqlite_handle()
         self.db._close_sqlite_handle()
@@ -439,6 +702,20 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
         self.db.create_index('idx2', 'b', 'c')
         self.assertEqual(set(['a', 'b', 'c']), self.db._get_indexed_fields())
 
+    def test__get_index_getters(self):
+        self.db.create_index('idx1', 'a')
+        getters = self.db._get_index_getters()
+        self.assertEqual(['a'], [field for field, _ in getters])
+        # getters are cached until the index definitions change
+        self.assertIs(getters, self.db._get_index_getters())
+        self.db.create_index('idx2', 'b')
+        self.assertEqual(
+            set(['a', 'b']),
+            set(field for field, _ in self.db._get_index_getters()))
+        self.db.delete_index('idx1')
+        self.assertEqual(
+            ['b'], [field for field, _ in self.db._get_index_getters()])
+
     def test_indexed_fields_expanded(self):
         self.db.create_index('idx1', 'key1')
         doc1 = self.db.create_doc_from_json('{"key1": "val1", "key2": "val2"}')
@@ -466,16 +743,16 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
     def test__format_query(self):
         self.assertFormatQueryEquals(
             "SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM "
-            "document d, document_fields d0 LEFT OUTER JOIN conflicts c ON "
-            "c.doc_id = d.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name "
-            "= ? AND d0.value = ? GROUP BY d.doc_id, d.doc_rev, d.content "
-            "ORDER BY d0.value;", ["key1", "a"],
+            "document_fields d0 CROSS JOIN document d LEFT OUTER JOIN "
+            "conflicts c ON c.doc_id = d.doc_id WHERE d.doc_id = d0.doc_id "
+            "AND d0.field_name = ? AND d0.value = ? GROUP BY d.doc_id, "
+            "d.doc_rev, d.content ORDER BY d0.value;", ["key1", "a"],
             ["key1"], ["a"])
 
     def test__format_query2(self):
         self.assertFormatQueryEquals(
             'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
-            'document d, document_fields d0, document_fields d1, '
+            'document_fields d0 CROSS JOIN document d, document_fields d1, '
             'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
             'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
             'd0.value = ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
@@ -488,16 +765,49 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
     def test__format_query_wildcard(self):
         self.assertFormatQueryEquals(
             'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
-            'document d, document_fields d0, document_fields d1, '
+            'document_fields d0 CROSS JOIN document d, document_fields d1, '
             'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
             'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
             'd0.value = ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
-            'd1.value GLOB ? AND d.doc_id = d2.doc_id AND d2.field_name = ? '
-            'AND d2.value NOT NULL GROUP BY d.doc_id, d.doc_rev, d.content '
-            'ORDER BY d0.value, d1.value, d2.value;',
-            ["key1", "a", "key2", "b*", "key3"], ["key1", "key2", "key3"],
+            'd1.value >= ? AND d1.value GLOB ? AND d.doc_id = d2.doc_id AND '
+            'd2.field_name = ? AND d2.value NOT NULL GROUP BY d.doc_id, '
+            'd.doc_rev, d.content ORDER BY d0.value, d1.value, d2.value;',
+            ["key1", "a", "key2", "b", "b*", "key3"], ["key1", "key2", "key3"],
             ["a", "b*", "*"])
 
+    def test__format_query_glob_pattern_prefix(self):
+        self.assertFormatQueryEquals(
+            'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
+            'document_fields d0 CROSS JOIN document d LEFT OUTER JOIN '
+            'conflicts c ON c.doc_id = d.doc_id WHERE d.doc_id = d0.doc_id '
+            'AND d0.field_name = ? AND d0.value GLOB ? GROUP BY d.doc_id, '
+            'd.doc_rev, d.content ORDER BY d0.value;',
+            ["key1", "[Aa]1*"], ["key1"], ["[Aa]1*"])
+
+    def test_get_from_index_glob_pattern_prefix(self):
+        self.db.create_index('idx', 'key')
+        doc1 = self.db.create_doc({'key': 'A1x'})
+        doc2 = self.db.create_doc({'key': 'a1y'})
+        self.db.create_doc({'key': 'b1z'})
+        self.assertEqual(
+            [doc1, doc2], self.db.get_from_index('idx', '[Aa]1*'))
+
+    def test__format_query_reuses_statement(self):
+        statement1, _ = self.db._format_query(['key1'], ['a'])
+        statement2, args = self.db._format_query(['key2'], ['b'])
+        self.assertIs(statement1, statement2)
+        self.assertEqual(['key2', 'b'], args)
+        statement3, _ = self.db._format_query(['key1'], ['a*'])
+        self.assertNotEqual(statement1, statement3)
+
+    def test__get_index_definition_is_invalidated(self):
+        self.db.create_index('idx', 'key1')
+        self.assertEqual(['key1'], self.db._get_index_definition('idx'))
+        self.db.delete_index('idx')
+        self.db.create_index('idx', 'key1', 'key2')
+        self.assertEqual(
+            ['key1', 'key2'], self.db._get_index_definition('idx'))
+
     def assertFormatRangeQueryEquals(self, exp_statement, exp_args, definition,
                                      start_value, end_value):
         statement, args = self.db._format_range_query(
@@ -508,7 +818,7 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
     def test__format_range_query(self):
         self.assertFormatRangeQueryEquals(
             'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
-            'document d, document_fields d0, document_fields d1, '
+            'document_fields d0 CROSS JOIN document d, document_fields d1, '
             'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
             'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
             'd0.value >= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
@@ -525,7 +835,7 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
     def test__format_range_query_no_start(self):
         self.assertFormatRangeQueryEquals(
             'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
-            'document d, document_fields d0, document_fields d1, '
+            'document_fields d0 CROSS JOIN document d, document_fields d1, '
             'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
             'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
             'd0.value <= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
@@ -538,7 +848,7 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
     def test__format_range_query_no_end(self):
         self.assertFormatRangeQueryEquals(
             'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
-            'document d, document_fields d0, document_fields d1, '
+            'document_fields d0 CROSS JOIN document d, document_fields d1, '
             'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
             'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
             'd0.value >= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
@@ -551,7 +861,7 @@ class TestSQLCipherPartialExpandDatabase(tests.TestCase):
     def test__format_range_query_wildcard(self):
         self.assertFormatRangeQueryEquals(
             'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
-            'document d, document_fields d0, document_fields d1, '
+            'document_fields d0 CROSS JOIN document d, document_fields d1, '
             'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
             'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
             'd0.value >= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# test_expression_index.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Test the sqlite backend that stores indexes as sqlite expression indexes.
+"""
+import os
+import pytest
+
+from StringIO import StringIO
+
+from testscenarios import TestWithScenarios
+
+from leap.soledad.common.l2db.backends import sqlite_backend
+from leap.soledad.common.l2db.backends.sqlite_backend import \
+    SQLiteDatabase, SQLitePartialExpandDatabase, SQLiteExpressionIndexDatabase
+
+from test_soledad import u1db_tests as tests
+from test_soledad.u1db_tests import test_backends
+
+
+def has_json1():
+    # the sqlite module may have been replaced by pysqlcipher, which might
+    # be built without the JSON1 extension.
+    try:
+        sqlite_backend.dbapi2.connect(':memory:').execute(
+            "SELECT json_type('{}')")
+    except sqlite_backend.dbapi2.OperationalError:
+        return False
+    return True
+
+
+pytestmark = pytest.mark.skipif(
+    not has_json1(), reason="needs the JSON1 extension of SQLite")
+
+
+def make_expression_index_database_for_test(test, replica_uid):
+    db = SQLiteExpressionIndexDatabase(':memory:')
+    db._set_replica_uid(replica_uid)
+    return db
+
+
+def copy_expression_index_database_for_test(test, db):
+    # DO NOT COPY OR REUSE THIS CODE OUTSIDE TESTS: COPYING U1DB DATABASES IS
+    # THE WRONG THING TO DO, THE ONLY REASON WE DO SO HERE IS TO TEST THAT WE
+    # CORRECTLY DETECT IT HAPPENING SO THAT WE CAN RAISE ERRORS RATHER THAN
+    # CORRUPT USER DATA. USE SYNC INSTEAD, OR WE WILL SEND NINJA TO YOUR
+    # HOUSE.
+    new_db = SQLiteExpressionIndexDatabase(':memory:')
+    tmpfile = StringIO()
+    for line in db._db_handle.iterdump():
+        if 'sqlite_sequence' not in line:  # work around bug in iterdump
+            tmpfile.write('%s\n' % line)
+    tmpfile.seek(0)
+    new_db._db_handle = sqlite_backend.dbapi2.connect(':memory:')
+    new_db._db_handle.cursor().executescript(tmpfile.read())
+    new_db._db_handle.commit()
+    new_db._set_replica_uid(db._replica_uid)
+    new_db._factory = db._factory
+    return new_db
+
+
+EXPRESSION_INDEX_SCENARIOS = [
+    ('sql-expression', {
+        'make_database_for_test': make_expression_index_database_for_test,
+        'copy_database_for_test': copy_expression_index_database_for_test,
+        'make_document_for_test': tests.make_document_for_test}),
+]
+
+
+class ExpressionIndexDatabaseTests(TestWithScenarios,
+                                   test_backends.LocalDatabaseTests):
+    scenarios = EXPRESSION_INDEX_SCENARIOS
+
+
+class ExpressionIndexWithConflictsTests(
+        TestWithScenarios,
+        test_backends.LocalDatabaseWithConflictsTests):
+    scenarios = EXPRESSION_INDEX_SCENARIOS
+
+
+class ExpressionIndexIndexTests(
+        TestWithScenarios, test_backends.DatabaseIndexTests):
+    scenarios = EXPRESSION_INDEX_SCENARIOS
+
+
+class TestSQLiteExpressionIndexDatabase(tests.TestCase):
+
+    def setUp(self):
+        self.db = SQLiteExpressionIndexDatabase(':memory:')
+
+    def tearDown(self):
+        self.db.close()
+
+    def get_expression_indexes(self, db):
+        c = db._get_sqlite_handle().cursor()
+        c.execute("SELECT name FROM sqlite_master"
+                  " WHERE type = 'index' AND name GLOB 'document_expr_*'")
+        return [row[0] for row in c.fetchall()]
+
+    def get_document_fields(self, db):
+        c = db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_id, field_name, value FROM document_fields"
+                  " ORDER BY doc_id, field_name, value")
+        return c.fetchall()
+
+    def test_create_index_creates_expression_indexes(self):
+        self.db.create_doc({'key': 'value'}, doc_id='doc')
+        self.db.create_index('idx', 'key', 'lower(name)')
+        self.assertEqual(2, len(self.get_expression_indexes(self.db)))
+        self.assertEqual([], self.get_document_fields(self.db))
+
+    def test_query_uses_expression_index(self):
+        self.db.create_index('idx', 'key')
+        statement, args = self.db._format_query(['key'], ['value'])
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute('EXPLAIN QUERY PLAN ' + statement, args)
+        plan = ' '.join(row[-1] for row in c.fetchall())
+        self.assertIn(self.get_expression_indexes(self.db)[0], plan)
+
+    def test_put_doc_expands_lists(self):
+        self.db.create_index('idx', 'key')
+        self.db.create_doc({'key': 'value'}, doc_id='scalar')
+        self.db.create_doc({'key': ['v1', 'v2']}, doc_id='list')
+        self.assertEqual(
+            [('list', 'key', 'v1'), ('list', 'key', 'v2')],
+            self.get_document_fields(self.db))
+        self.assertEqual(
+            ['list'], [d.doc_id for d in self.db.get_from_index('idx', 'v2')])
+        self.assertEqual(
+            ['list', 'scalar'],
+            sorted(d.doc_id for d in self.db.get_from_index('idx', '*')))
+        self.assertEqual(
+            [('v1',), ('v2',), ('value',)],
+            sorted(self.db.get_index_keys('idx')))
+
+    def test_lower_expands_non_ascii_strings(self):
+        self.db.create_index('idx', 'lower(name)')
+        self.db.create_doc({'name': u'\xc5ngstr\xf6m'}, doc_id='non-ascii')
+        self.db.create_doc({'name': 'ASCII'}, doc_id='ascii')
+        self.assertEqual(
+            [('non-ascii', 'lower(name)', u'\xe5ngstr\xf6m')],
+            self.get_document_fields(self.db))
+        self.assertEqual(
+            ['non-ascii'],
+            [d.doc_id for d in self.db.get_from_index('idx', u'\xe5*')])
+        self.assertEqual(
+            ['ascii'],
+            [d.doc_id for d in self.db.get_from_index('idx', 'ascii')])
+
+    def test_split_words_is_expanded(self):
+        self.db.create_doc({'text': 'one two'}, doc_id='doc')
+        self.db.create_index('idx', 'split_words(text)')
+        self.assertEqual([], self.get_expression_indexes(self.db))
+        self.assertEqual(
+            [('doc', 'split_words(text)', 'one'),
+             ('doc', 'split_words(text)', 'two')],
+            self.get_document_fields(self.db))
+
+    def test_range_bounds_match_the_same_value(self):
+        self.db.create_index('idx', 'key')
+        self.db.create_doc({'key': ['a', 'z']})
+        self.assertEqual(
+            [], self.db.get_range_from_index('idx', 'b', 'c'))
+
+    def test_glob_with_pattern_prefix(self):
+        self.db.create_index('idx', 'key')
+        self.db.create_doc({'key': 'A1x'}, doc_id='d1')
+        self.db.create_doc({'key': 'a1y'}, doc_id='d2')
+        self.db.create_doc({'key': 'b1z'}, doc_id='d3')
+        self.assertEqual(
+            ['d1', 'd2'],
+            [d.doc_id for d in self.db.get_from_index('idx', '[Aa]1*')])
+        self.assertEqual(
+            ['d1', 'd2'],
+            [d.doc_id for d in self.db.get_range_from_index(
+                'idx', None, '[Aa]1*')])
+        docs, _ = self.db.get_from_index_page('idx', ('[Aa]1*',), 10)
+        self.assertEqual(['d1', 'd2'], [d.doc_id for d in docs])
+
+    def test_get_from_index_page_merges_expanded_values(self):
+        self.db.create_index('idx', 'key')
+        self.db.create_doc({'key': 'b'}, doc_id='d1')
+        self.db.create_doc({'key': ['c', 'a']}, doc_id='d2')
+        self.db.create_doc({'key': 'a'}, doc_id='d3')
+        self.db.create_doc({'key': ['b', 'd']}, doc_id='d4')
+        pages = []
+        after = None
+        while True:
+            docs, after = self.db.get_from_index_page('idx', ('*',), 3, after)
+            pages.append([doc.doc_id for doc in docs])
+            if after is None:
+                break
+        self.assertEqual([['d2', 'd3', 'd1'], ['d4']], pages)
+
+    def test_delete_index_drops_unused_expression_indexes(self):
+        self.db.create_index('idx1', 'key')
+        self.db.create_index('idx2', 'key', 'other')
+        self.db.delete_index('idx2')
+        self.assertEqual(1, len(self.get_expression_indexes(self.db)))
+        self.db.delete_index('idx1')
+        self.assertEqual([], self.get_expression_indexes(self.db))
+
+    def test_convert_index_storage(self):
+        path = os.path.join(self.createTempDir(), 'test.db')
+        db = SQLitePartialExpandDatabase(path)
+        db.create_index('idx', 'key')
+        doc = db.create_doc({'key': 'value'})
+        db.close()
+        db = SQLiteExpressionIndexDatabase(path)
+        db.convert_index_storage()
+        db.close()
+        db = SQLiteDatabase.open_database(path, create=False)
+        self.assertIsInstance(db, SQLiteExpressionIndexDatabase)
+        self.assertEqual([], self.get_document_fields(db))
+        self.assertEqual([doc], db.get_from_index('idx', 'value'))
+        db.close()
+        db = SQLitePartialExpandDatabase(path)
+        db.convert_index_storage()
+        self.assertEqual([], self.get_expression_indexes(db))
+        self.assertEqual(
+            [(doc.doc_id, 'key', 'value')], self.get_document_fields(db))
+        db.close()
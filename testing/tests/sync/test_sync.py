@@ -25,6 +25,7 @@ from twisted.internet import defer
 from testscenarios import TestWithScenarios
 
 from leap.soledad.common import couch
+from leap.soledad.common.errors import SyncStateMismatchError
 from leap.soledad.client import sync
 
 from test_soledad import u1db_tests as tests
@@ -218,6 +219,8 @@ class TestSoledadSynchronizer(BaseSoledadTest):
     def setUp(self):
         BaseSoledadTest.setUp(self)
         self.db = Mock()
+        # test_sync_mutex wraps sync() to record its timing in the source
+        self.db.sync_times = {}
         self.target = Mock()
         self.synchronizer = sync.SoledadSynchronizer(
             self.db,
@@ -225,7 +228,89 @@ class TestSoledadSynchronizer(BaseSoledadTest):
 
     def test_docs_by_gen_includes_deleted(self):
         changes = [('id', 'gen', 'trans')]
+        self.db.get_docs.return_value = [Mock(doc_id='id')]
         docs_by_gen = self.synchronizer._docs_by_gen_from_changes(changes)
         f, args, kwargs = docs_by_gen[0][0]
+        f(*args, **kwargs)
+        _, kwargs = self.db.get_docs.call_args
         self.assertIn('include_deleted', kwargs)
         self.assertTrue(kwargs['include_deleted'])
+
+    def test_docs_by_gen_reads_docs_in_chunks(self):
+        self.synchronizer.get_docs_chunk_size = 2
+        changes = [('id%d' % i, i, 'trans') for i in range(5)]
+        self.db.get_docs.side_effect = \
+            lambda doc_ids, **kwargs: [Mock(doc_id=i) for i in doc_ids]
+        docs_by_gen = self.synchronizer._docs_by_gen_from_changes(changes)
+        docs = [f(*args, **kwargs) for (f, args, kwargs), _, _ in docs_by_gen]
+        self.assertEqual(
+            ['id0', 'id1', 'id2', 'id3', 'id4'], [doc.doc_id for doc in docs])
+        self.assertEqual(
+            [['id0', 'id1'], ['id2', 'id3'], ['id4']],
+            [args[0] for args, _ in self.db.get_docs.call_args_list])
+
+    def test_start_sync_session_resumes_interrupted_session(self):
+        self.synchronizer.target_replica_uid = 'target'
+        self.db._get_sync_checkpoint.return_value = ('sync-id', 3)
+        self.assertEqual(
+            ('sync-id', 3), self.synchronizer._start_sync_session())
+        self.assertFalse(self.db._set_sync_checkpoint.called)
+
+    def test_start_sync_session_persists_new_session(self):
+        self.synchronizer.target_replica_uid = 'target'
+        self.db._get_sync_checkpoint.return_value = None
+        sync_id, received = self.synchronizer._start_sync_session()
+        self.assertEqual(0, received)
+        self.db._set_sync_checkpoint.assert_called_once_with(
+            'target', sync_id)
+
+    @defer.inlineCallbacks
+    def test_sync_in_single_request(self):
+        self.target._url = 'url'
+        self.db._get_sync_target_info.return_value = (
+            'target', 3, 'T-3', None, None)
+        self.db.whats_changed.return_value = (4, 'T-4', [('id', 4, 'T-4')])
+        self.db._get_replica_gen_and_trans_id.return_value = (7, 'TT-7')
+        self.db._get_sync_checkpoint.return_value = None
+        self.db._get_generation_info.return_value = (4, 'T-4')
+        self.target.sync_in_single_request.return_value = \
+            defer.succeed((8, 'TT-8', 4, 'T-4'))
+        self.target.single_request_sync = True
+        my_gen = yield self.synchronizer.sync()
+        self.assertEqual(4, my_gen)
+        self.db.whats_changed.assert_called_with(3)
+        self.db._set_replica_gen_and_trans_id.assert_called_once_with(
+            'target', 8, 'TT-8')
+        self.db._set_sync_target_info.assert_called_once_with(
+            'url', 'target', 4, 'T-4', None, None)
+        self.assertFalse(self.target.get_sync_info.called)
+        self.db.compact_transaction_log.assert_called_once_with()
+
+    @defer.inlineCallbacks
+    def test_sync_skipped_when_nothing_changed(self):
+        self.db._get_sync_target_info.return_value = (
+            'target', 3, 'T-3', None, None)
+        self.db._get_generation.return_value = 3
+        self.db._get_replica_gen_and_trans_id.return_value = (7, 'TT-7')
+        self.target.has_changes.return_value = defer.succeed(False)
+        my_gen = yield self.synchronizer.sync()
+        self.assertEqual(3, my_gen)
+        self.target.has_changes.assert_called_once_with(7, 'TT-7')
+        self.assertFalse(self.target.sync_in_single_request.called)
+        self.assertFalse(self.db.compact_transaction_log.called)
+
+    @defer.inlineCallbacks
+    def test_sync_falls_back_to_many_requests(self):
+        self.db._get_sync_target_info.return_value = (
+            'target', 3, 'T-3', None, None)
+        self.db.whats_changed.return_value = (3, 'T-3', [])
+        self.db._get_replica_gen_and_trans_id.return_value = (7, 'TT-7')
+        self.db._get_sync_checkpoint.return_value = None
+        self.target.sync_in_single_request.return_value = \
+            defer.fail(SyncStateMismatchError())
+        self.synchronizer._sync_in_many_requests = Mock(
+            return_value=defer.succeed(3))
+        my_gen = yield self.synchronizer.sync()
+        self.assertEqual(3, my_gen)
+        self.assertTrue(self.synchronizer._sync_in_many_requests.called)
+        self.db.compact_transaction_log.assert_called_once_with()
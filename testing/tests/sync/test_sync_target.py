@@ -23,14 +23,22 @@ import json
 import random
 import string
 import shutil
+import threading
 
 from six import StringIO as cStringIO
 from uuid import uuid4
 
+from mock import Mock
 from testscenarios import TestWithScenarios
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
 
 from leap.soledad.client import http_target as target
+from leap.soledad.client.http_target.fetch import HTTPDocFetcher
+from leap.soledad.client.http_target.send import HTTPDocSender
+from leap.soledad.client.http_target.fetch_protocol import DocFrameReceiver
 from leap.soledad.client.http_target.fetch_protocol import DocStreamReceiver
 from leap.soledad.client.sqlcipher import SQLCipherU1DBSync
 from leap.soledad.client.sqlcipher import SQLCipherOptions
@@ -40,6 +48,8 @@ from leap.soledad.client import _crypto
 from leap.soledad.common import l2db
 
 from leap.soledad.common.document import SoledadDocument
+from leap.soledad.common.errors import SyncStateMismatchError
+from leap.soledad.common.l2db.remote import utils
 from test_soledad import u1db_tests as tests
 from test_soledad.util import make_sqlcipher_database_for_test
 from test_soledad.util import make_soledad_app
@@ -121,6 +131,259 @@ class TestSoledadParseReceivedDocResponse(unittest.TestCase):
         with self.assertRaises(l2db.errors.BrokenSyncStream):
             self.parse('[\r\n{"error": "?"}\r\n')
 
+    def test_error_response(self):
+        response = Mock(code=409, phrase='Conflict', headers={})
+        d = defer.Deferred()
+        parser = DocStreamReceiver(
+            response, d, lambda *_: defer.succeed(42))
+        parser.dataReceived('{"error": "sync state mismatch"}\r\n')
+        parser.connectionLost(Failure(ResponseDone()))
+        return self.assertFailure(d, SyncStateMismatchError)
+
+
+class TestDocFrameReceiver(unittest.TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.parser = DocFrameReceiver(
+            None, defer.Deferred(), self.doc_reader)
+
+    def doc_reader(self, doc_info, content, total):
+        self.received.append((doc_info['id'], content, type(content), total))
+        return defer.succeed(None)
+
+    def parse(self, frames, chunk_size=3):
+        stream = ''.join(frames)
+        for i in xrange(0, len(stream), chunk_size):
+            self.parser.dataReceived(stream[i:i + chunk_size])
+        self.parser.finish()
+
+    def test_parse(self):
+        self.parse([
+            utils.frame_entry({'number_of_changes': 3}),
+            utils.frame_entry({'id': 'a'}),
+            utils.frame(utils.FRAME_RAW, 'EzcB \r\n\x00raw'),
+            utils.frame_entry({'id': 'b'}),
+            utils.frame(utils.FRAME_JSON, '{"b": 1}'),
+            utils.frame_entry({'id': 'c'}),
+            utils.frame(utils.FRAME_JSON),
+            utils.frame(utils.FRAME_END)])
+        self.assertEqual(
+            {'number_of_changes': 3}, json.loads(self.parser.metadata))
+        self.assertEqual([
+            ('a', 'EzcB \r\n\x00raw', utils.RawContent, 3),
+            ('b', '{"b": 1}', str, 3),
+            ('c', None, type(None), 3)], self.received)
+
+    def test_parse_whole_stream(self):
+        self.parse([
+            utils.frame_entry({'number_of_changes': 1}),
+            utils.frame_entry({'id': 'a'}),
+            utils.frame(utils.FRAME_RAW, 'EzcB raw'),
+            utils.frame(utils.FRAME_END)], chunk_size=1024)
+        self.assertEqual(
+            [('a', 'EzcB raw', utils.RawContent, 1)], self.received)
+
+    def test_wrong_end(self):
+        with self.assertRaises(l2db.errors.BrokenSyncStream):
+            self.parse([utils.frame_entry({'number_of_changes': 0})])
+
+    def test_raw_doc_info(self):
+        with self.assertRaises(l2db.errors.BrokenSyncStream):
+            self.parse([
+                utils.frame_entry({'number_of_changes': 1}),
+                utils.frame(utils.FRAME_RAW, 'EzcB raw')])
+
+    def test_error_in_stream(self):
+        with self.assertRaises(l2db.errors.BrokenSyncStream):
+            self.parse([
+                utils.frame_entry({'new_generation': 0}),
+                utils.frame_entry({'error': 'unavailable'})])
+
+
+class TestHTTPDocFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.crypto = _crypto.SoledadCrypto('A' * 96)
+        self.inserted = []
+        self.fetcher = HTTPDocFetcher()
+        self.fetcher._crypto = self.crypto
+        self.fetcher._insert_doc_cb = \
+            lambda doc, gen, trans_id: self.inserted.append((doc, gen))
+        self.fetcher._insert_docs_cb = None
+        self.fetcher.insert_batch_size = 2
+
+    @defer.inlineCallbacks
+    def encrypt(self, amount):
+        entries = []
+        for gen in xrange(1, amount + 1):
+            doc = SoledadDocument('doc-%d' % gen, 'rev')
+            doc.content = {'gen': gen}
+            content = yield self.crypto.encrypt_doc(doc)
+            info = {'id': doc.doc_id, 'rev': doc.rev, 'gen': gen,
+                    'trans_id': 'T-%d' % gen}
+            entries.append((info, content))
+        defer.returnValue(entries)
+
+    def receive(self, entries):
+        def fetch_all(*args):
+            for info, content in entries:
+                d = self.fetcher._doc_parser(info, content, len(entries))
+                d.addErrback(lambda _: None)
+            return json.dumps({'number_of_changes': len(entries),
+                               'new_generation': len(entries),
+                               'new_transaction_id': 'T-last'})
+        self.fetcher._fetch_all = fetch_all
+        self.fetcher._ensure_callback = None
+        self.fetcher._received_docs = 0
+        return self.fetcher._receive_docs(0, '', None, 'sync-id')
+
+    @defer.inlineCallbacks
+    def test_receive_docs_inserts_in_order(self):
+        entries = yield self.encrypt(5)
+        decrypt = self.crypto.decrypt_doc_blocking
+
+        def slow_first_decrypt(doc):
+            if doc.doc_id == 'doc-1':
+                time.sleep(0.1)
+            return decrypt(doc)
+        self.crypto.decrypt_doc_blocking = slow_first_decrypt
+        new_gen, trans_id = yield self.receive(entries)
+        self.assertEqual((5, 'T-last'), (new_gen, trans_id))
+        self.assertEqual(
+            [(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)],
+            [(doc.content['gen'], gen) for doc, gen in self.inserted])
+        self.assertEqual(5, self.fetcher._received_docs)
+
+    @defer.inlineCallbacks
+    def test_receive_docs_fails_on_decryption_error(self):
+        entries = yield self.encrypt(3)
+        info, content = entries[1]
+        entries[1] = (dict(info, rev='other'), content)
+        decrypt = self.crypto.decrypt_doc_blocking
+        insert = self.fetcher._insert_doc_cb
+        first_inserted = threading.Event()
+
+        def insert_and_signal(doc, gen, trans_id):
+            insert(doc, gen, trans_id)
+            first_inserted.set()
+
+        def fail_after_first_insert(doc):
+            # decryptions run concurrently, so make sure the failure comes
+            # after the first doc was inserted
+            if doc.doc_id == 'doc-2':
+                first_inserted.wait(5)
+            return decrypt(doc)
+        self.fetcher._insert_doc_cb = insert_and_signal
+        self.crypto.decrypt_doc_blocking = fail_after_first_insert
+        with self.assertRaises(_crypto.InvalidBlob):
+            yield self.receive(entries)
+        self.assertEqual(
+            [1], [doc.content['gen'] for doc, _ in self.inserted])
+
+    @defer.inlineCallbacks
+    def test_receive_raw_docs(self):
+        entries = []
+        for gen in xrange(1, 4):
+            doc = SoledadDocument('doc-%d' % gen, 'rev')
+            doc.content = {'gen': gen}
+            content = utils.RawContent(self.crypto.encrypt_raw_blocking(doc))
+            info = {'id': doc.doc_id, 'rev': doc.rev, 'gen': gen,
+                    'trans_id': 'T-%d' % gen}
+            entries.append((info, content))
+        yield self.receive(entries)
+        self.assertEqual(
+            [(1, 1), (2, 2), (3, 3)],
+            [(doc.content['gen'], gen) for doc, gen in self.inserted])
+
+
+class TestHTTPDocSender(unittest.TestCase):
+
+    def setUp(self):
+        self.crypto = _crypto.SoledadCrypto('A' * 96)
+        self.sender = HTTPDocSender()
+        self.sender._crypto = self.crypto
+        self.sender._ensure_callback = None
+        self.sender._url = 'url'
+        self.sender.encrypt_workers = 3
+        self.sender.send_queue_size = 4
+        self.written = []
+        self.sender._http_request = self.http_request
+
+    def http_request(self, url, method, body, content_type, body_producer):
+        self.content_type = content_type
+        producer = body_producer(body)
+        written = self.written
+
+        class Consumer(object):
+
+            def write(self, data):
+                written.append(data)
+                # pause after every write, like a slow connection would
+                producer.pauseProducing()
+                reactor.callLater(0, producer.resumeProducing)
+
+        d = producer.startProducing(Consumer())
+        d.addCallback(lambda _: json.dumps(
+            [{'new_generation': 5, 'new_transaction_id': 'T-5'}]))
+        return d
+
+    @defer.inlineCallbacks
+    def test_send_docs_writes_entries_in_order(self):
+        encrypt = self.crypto.encrypt_doc_blocking
+
+        def slow_first_encrypt(doc):
+            if doc.doc_id == 'doc-1':
+                time.sleep(0.1)
+            return encrypt(doc)
+        self.crypto.encrypt_doc_blocking = slow_first_encrypt
+        docs_by_gen = []
+        for gen in xrange(1, 6):
+            doc = SoledadDocument('doc-%d' % gen, 'rev')
+            doc.content = {'gen': gen}
+            get_doc = (lambda doc: doc, (doc,), {})
+            docs_by_gen.append((get_doc, gen, 'T-%d' % gen))
+        result = yield self.sender._send_docs(docs_by_gen, 0, '', 'sync-id')
+        self.assertEqual([5, 'T-5'], result)
+        lines = ''.join(self.written).split('\r\n')
+        self.assertEqual(['[', ']'], [lines[0], lines[-1]])
+        entries = [json.loads(line.rstrip(',')) for line in lines[2:-1:2]]
+        self.assertEqual(
+            [(gen, gen) for gen in xrange(1, 6)],
+            [(entry['gen'], entry['doc_idx']) for entry in entries])
+        for entry, content in zip(entries, lines[3:-1:2]):
+            doc = SoledadDocument(entry['id'], entry['rev'])
+            doc.set_json(content.rstrip(','))
+            cleartext = self.crypto.decrypt_doc_blocking(doc)
+            self.assertEqual({'gen': entry['gen']}, json.loads(cleartext))
+
+    @defer.inlineCallbacks
+    def test_send_docs_with_binary_framing(self):
+        self.sender.binary_framing = True
+        docs_by_gen = []
+        for gen in xrange(1, 4):
+            doc = SoledadDocument('doc-%d' % gen, 'rev')
+            doc.content = {'gen': gen}
+            get_doc = (lambda doc: doc, (doc,), {})
+            docs_by_gen.append((get_doc, gen, 'T-%d' % gen))
+        yield self.sender._send_docs(docs_by_gen, 0, '', 'sync-id')
+        self.assertIn('framing=binary', self.content_type)
+        received = []
+        parser = DocFrameReceiver(
+            None, defer.Deferred(),
+            lambda *args: defer.succeed(received.append(args)))
+        parser.dataReceived(''.join(self.written))
+        parser.finish()
+        self.assertEqual('sync-id', json.loads(parser.metadata)['sync_id'])
+        self.assertEqual([1, 2, 3], [info['gen'] for info, _, _ in received])
+        for info, content, _ in received:
+            self.assertNotIn('content', info)
+            self.assertIsInstance(content, utils.RawContent)
+            doc = SoledadDocument(info['id'], info['rev'])
+            cleartext = self.crypto.decrypt_raw_blocking(doc, content)
+            self.assertEqual({'gen': info['gen']}, json.loads(cleartext))
+
+
 #
 # functions for TestRemoteSyncTargets
 #